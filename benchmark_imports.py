@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# dependencies that dominate the start-up time, only imported where they are used
+HEAVY_MODULES = ['torchvision', 'wandb', 'sklearn', 'cv2', 'matplotlib']
+# heavy modules every entry point may import at start-up: the inference path (models, checkpoints,
+# exported graphs) and the motion-only training only need torch, evaluation / training also read and
+# transform the frames
+ALLOWED_HEAVY = {
+    'src.checkpoint': [],
+    'src.model.models': [],
+    'src.model.export': [],
+    'src.runtime': [],
+    'eval_hybrid': ['torchvision'],
+    'export_model': ['torchvision'],
+    'train_hybrid': ['torchvision'],
+    'train_rnn': [],
+}
+INFERENCE_MODULES = ['src.checkpoint', 'src.model.models', 'src.model.export', 'src.runtime']
+# run in a fresh interpreter, nothing is cached by a previous import
+IMPORT_CODE = '''
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+print(json.dumps({'time': time.perf_counter() - start, 'modules': list(sys.modules)}))
+'''
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Import time of the entry points, fails when the start-up budget is exceeded')
+    parser.add_argument('--modules', nargs='+', default=list(ALLOWED_HEAVY),
+                        help='modules to import (default: inference modules and entry-point scripts)')
+    parser.add_argument('--repeat', default=5, type=int,
+                        help='fresh interpreters per module, the median time is reported')
+    parser.add_argument('--budget', default=0.5, type=float,
+                        help='maximum import time (s) of the inference modules on top of "import torch"')
+    return parser.parse_args()
+
+
+def time_import(module, repeat):
+    """
+    :return: median import time (s) of module and the heavy modules it loaded
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')]))}
+    times, loaded = [], set()
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', IMPORT_CODE, module], cwd=root, env=env,
+                             capture_output=True, text=True, check=True)
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+        times.append(result['time'])
+        loaded.update(m.split('.')[0] for m in result['modules'])
+    return statistics.median(times), sorted(loaded.intersection(HEAVY_MODULES))
+
+
+def main():
+    args = get_args()
+    torch_time, _ = time_import('torch', args.repeat)
+    print(f'import torch: {torch_time:.2f}s (baseline)')
+    failures = []
+    for module in args.modules:
+        import_time, heavy = time_import(module, args.repeat)
+        print(f'import {module}: {import_time:.2f}s (+{import_time - torch_time:.2f}s over torch), '
+              f'heavy modules: {", ".join(heavy) or "-"}')
+        unexpected = [m for m in heavy if m not in ALLOWED_HEAVY.get(module, HEAVY_MODULES)]
+        if unexpected:
+            failures.append(f'{module} imports {", ".join(unexpected)} at start-up')
+        if module in INFERENCE_MODULES and import_time - torch_time > args.budget:
+            failures.append(f'{module} takes {import_time - torch_time:.2f}s on top of torch (budget {args.budget}s)')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
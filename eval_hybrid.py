@@ -1,12 +1,17 @@
 import argparse
+import copy
+import math
+import numpy as np
 import torch
+from torch.utils.data.dataloader import default_collate
 from tqdm import tqdm
 from src.dataset.intention.jaad_dataset import build_pedb_dataset_jaad, unpack_batch
 from src.early_stopping import load_from_checkpoint
+from src.model.precision import PRECISIONS, autocast, setup_precision
 from src.model.models import Res18Classifier, RNNClassifier, DecoderRNN_IMBS, build_encoder_res18
-from src.dataset.loader import define_path, IntentionSequenceDataset
+from src.dataset.loader import define_path, IntentionSequenceDataset, order_windows
 from src.transform.preprocess import ImageTransform, Compose, CropBoxWithBackgroud
-from src.utils import prep_pred_storage, print_eval_metrics
+from src.utils import LRUCache, prep_pred_storage, print_eval_metrics
 import torchvision.transforms as transforms
 
 MEAN = [0.3104, 0.2813, 0.2973]
@@ -14,6 +19,9 @@ STD = [0.1761, 0.1722, 0.1673]
 
 EMBEDDING_DIM = 256
 EVAL_MODES = ['cnn_only', 'rnn_only', 'hybrid']
+# motion-only model first, hybrid model only for uncertain samples (evaluation only, not exportable)
+CASCADE_MODE = 'cascade'
+POS_VEL_DIM = 8
 
 IMAGE_TRANSFORM = Compose([
     CropBoxWithBackgroud(size=224),
@@ -49,137 +57,293 @@ def get_args():
                         help='path to the checkpoint for loading pretrained weights')
     parser.add_argument('-nw', '--num-workers', type=int, default=4, 
                         help='number of workers for data loading')
+    parser.add_argument('--io-threads', type=int, default=0,
+                        help='number of threads reading frames inside every loader worker')
     parser.add_argument("--mode", type=str)
     parser.add_argument("--backbone", type=str, default="resnet18")
+    parser.add_argument('--fused-decoder', default=False, action='store_true',
+                        help='run the hybrid decoder branches concurrently with a single sort/pack permutation')
+    parser.add_argument('--precision', default='fp32', type=str, choices=PRECISIONS,
+                        help='autocast precision of the forward passes (bf16 on cpu, fp16 on gpu)')
+    parser.add_argument('--channels-last', default=False, action='store_true',
+                        help='run the CNN encoder in channels-last memory format')
+    parser.add_argument('--compare-fp32', default=False, action='store_true',
+                        help='also evaluate in fp32 and print the metrics side by side')
+    parser.add_argument('--rnn-checkpoint-path', type=str, default='',
+                        help='cascade mode: checkpoint of the motion-only RNNClassifier')
+    parser.add_argument('--cascade-band', default=0.2, type=float,
+                        help='cascade mode: the hybrid model is run when |p_motion - best_thr_motion| <= band')
+    parser.add_argument('--reuse-embeddings', default=False, action='store_true',
+                        help='hybrid mode: only compute the CNN embedding of the frames a window does not share with '
+                             'the previous window of the same pedestrian')
+    parser.add_argument('--embedding-cache-size', default=256, type=int,
+                        help='number of frame embeddings kept by --reuse-embeddings')
     args = parser.parse_args()
 
     return args
 
 
 def build_loader(args, intent_seqs, TRANSFORM, image_dir, load_image=True):
-    ds = IntentionSequenceDataset(intent_seqs, image_dir=image_dir, hflip_p = 0, preprocess=TRANSFORM, load_image=load_image)
+    if getattr(args, 'reuse_embeddings', False):
+        # overlapping windows of a pedestrian one after another, see eval_hybrid_reuse
+        intent_seqs = order_windows(intent_seqs)
+    ds = IntentionSequenceDataset(intent_seqs, image_dir=image_dir, hflip_p = 0, preprocess=TRANSFORM, load_image=load_image,
+                                  io_threads=args.io_threads)
     loader = torch.utils.data.DataLoader(ds, batch_size=1, num_workers=args.num_workers, shuffle=False)
     return loader
 
     
+def build_test_loaders(args, transform, load_image=True):
+    """
+    Loaders of the full test set and of the transition only test set
+    """
+    # loading data
+    anns_paths_eval, image_dir_eval = define_path(use_jaad=args.jaad, use_pie=False, use_titan=False)
+
+    normal_intent_sequences = build_pedb_dataset_jaad(
+        anns_paths_eval["JAAD"]["anns"], 
+        anns_paths_eval["JAAD"]["split"], 
+        image_set = "test", 
+        fps=args.fps,
+        prediction_frames=args.pred, 
+        max_frames=args.max_frames,
+        verbose=True)
+
+    hard_intent_sequences = build_pedb_dataset_jaad(
+        anns_paths_eval["JAAD"]["anns"], 
+        anns_paths_eval["JAAD"]["split"], 
+        image_set = "test", 
+        fps=args.fps,
+        prediction_frames=args.pred, 
+        max_frames=args.max_frames,
+        verbose=True,
+        transition_only=True)
+
+    normal_loader = build_loader(args, normal_intent_sequences, transform, image_dir_eval, load_image=load_image)
+    hard_loader = build_loader(args, hard_intent_sequences, transform, image_dir_eval, load_image=load_image)
+    return normal_loader, hard_loader
+
+
 @torch.no_grad()
-def eval_cnn(loader, model, device):
+def eval_cnn(loader, model, device, precision='fp32'):
     # swith to evaluate mode
     encoder_CNN = model['encoder']
     preds, tgts, _, _ = prep_pred_storage(loader)
 
     for step, inputs in enumerate(tqdm(loader)):
         images, seq_len, _, _, _, targets = unpack_batch(inputs, device)
-        outputs_CNN = encoder_CNN(images, seq_len).squeeze(-1)
+        with autocast(device, precision):
+            outputs_CNN = encoder_CNN(images, seq_len).squeeze(-1)
+        outputs_CNN = outputs_CNN.float()
         
         preds[step] = outputs_CNN.detach().cpu().squeeze()
         tgts[step] = targets.detach().cpu().squeeze()
 
-    print_eval_metrics(tgts, preds, model['best_thr'])
+    return print_eval_metrics(tgts, preds, model['best_thr'])
 
 
 @torch.no_grad()
-def eval_rnn(loader, model, device):
+def eval_rnn(loader, model, device, precision='fp32'):
     # swith to evaluate mode
     decoder_RNN = model['decoder']
     preds, tgts, _, _ = prep_pred_storage(loader)
 
     for step, inputs in enumerate(tqdm(loader)):
         _, seq_len, pos_vel, _, _, targets = unpack_batch(inputs, device)
-        outputs_CNN = decoder_RNN(pos_vel, seq_len).squeeze(-1)
+        with autocast(device, precision):
+            outputs_CNN = decoder_RNN(pos_vel, seq_len).squeeze(-1)
+        outputs_CNN = outputs_CNN.float()
         
         preds[step] = outputs_CNN.detach().cpu().squeeze()
         tgts[step] = targets.detach().cpu().squeeze()
 
-    print_eval_metrics(tgts, preds, model['best_thr'])
+    return print_eval_metrics(tgts, preds, model['best_thr'])
 
 
 @torch.no_grad()
-def eval_hybrid(loader, model, device):
+def eval_hybrid(loader, model, device, precision='fp32'):
     encoder_CNN, decoder_RNN = model['encoder'], model['decoder']
 
     preds, tgts, _, _ = prep_pred_storage(loader)
 
     for step, inputs in enumerate(tqdm(loader)):
         images, seq_len, pv, scene, behavior, targets = unpack_batch(inputs, device)
-        outputs_CNN = encoder_CNN(images, seq_len)
-        outputs_RNN = decoder_RNN(xc_3d=outputs_CNN, xp_3d=pv, 
-                                    xb_3d=behavior, xs_2d=scene, x_lengths=seq_len)
+        with autocast(device, precision):
+            outputs_CNN = encoder_CNN(images, seq_len)
+            outputs_RNN = decoder_RNN(xc_3d=outputs_CNN, xp_3d=pv, 
+                                        xb_3d=behavior, xs_2d=scene, x_lengths=seq_len)
+        outputs_RNN = outputs_RNN.float()
         
         preds[step] = outputs_RNN.detach().cpu().squeeze()
         tgts[step] = targets.detach().cpu().squeeze()
 
-    print_eval_metrics(tgts, preds, model['best_thr'])
+    return print_eval_metrics(tgts, preds, model['best_thr'])
 
 
-EVAL_FUNCTIONS = {'cnn_only': eval_cnn, 'rnn_only': eval_rnn, 'hybrid': eval_hybrid}
+@torch.no_grad()
+def eval_hybrid_reuse(loader, model, device, precision='fp32'):
+    """
+    Same predictions as eval_hybrid, but the CNN embeddings are cached per (video, frame, pedestrian):
+    windows are ordered by pedestrian and start frame, so only their last frame goes through the backbone.
+    Frames are still read: the crop transform also squarifies the boxes the motion features are computed from.
+    """
+    assert loader.batch_size == 1, "embedding reuse works sample by sample"
+    encoder_CNN, decoder_RNN, cache = model['encoder'], model['decoder'], model['embedding_cache']
+    samples = loader.dataset.samples
+    # embeddings of another run may come from another precision
+    cache.clear()
 
-def main():
-    args = get_args()
-    if args.mode == 'cnn_only':
-        args.max_frames = 1
-    if args.mode not in EVAL_MODES:
-        raise ValueError(f'invalid mode, please choose from {", ".join(EVAL_MODES)}')
-    # loading data
-    anns_paths_eval, image_dir_eval = define_path(use_jaad=args.jaad, use_pie=False, use_titan=False)
+    preds, tgts, _, _ = prep_pred_storage(loader)
+    n_frames = n_computed = 0
+    for step, inputs in enumerate(tqdm(loader)):
+        images, seq_len, pv, scene, behavior, targets = unpack_batch(inputs, device)
+        sample = samples[step]
+        keys = [(sample['video_number'], f, sample['ped_id']) for f in sample['frames']]
+        embed_seq = [cache.get(k) for k in keys]
+        missing = [t for t, embedding in enumerate(embed_seq) if embedding is None]
+        with autocast(device, precision):
+            if missing:
+                embeddings = encoder_CNN.embed_frames(images[0, missing])
+                for t, embedding in zip(missing, embeddings):
+                    cache.put(keys[t], embedding)
+                    embed_seq[t] = embedding
+            outputs_CNN = torch.stack(embed_seq).unsqueeze(0)
+            outputs_RNN = decoder_RNN(xc_3d=outputs_CNN, xp_3d=pv, 
+                                        xb_3d=behavior, xs_2d=scene, x_lengths=seq_len)
+        outputs_RNN = outputs_RNN.float()
+        n_frames += len(keys)
+        n_computed += len(missing)
 
-    normal_intent_sequences = build_pedb_dataset_jaad(
-        anns_paths_eval["JAAD"]["anns"], 
-        anns_paths_eval["JAAD"]["split"], 
-        image_set = "test", 
-        fps=args.fps,
-        prediction_frames=args.pred, 
-        max_frames=args.max_frames,
-        verbose=True)
+        preds[step] = outputs_RNN.detach().cpu().squeeze()
+        tgts[step] = targets.detach().cpu().squeeze()
 
-    hard_intent_sequences = build_pedb_dataset_jaad(
-        anns_paths_eval["JAAD"]["anns"], 
-        anns_paths_eval["JAAD"]["split"], 
-        image_set = "test", 
-        fps=args.fps,
-        prediction_frames=args.pred, 
-        max_frames=args.max_frames,
-        verbose=True,
-        transition_only=True)
-    
+    print(f'Embedding reuse: {n_computed} / {n_frames} frames through the backbone '
+          f'({n_frames / max(n_computed, 1):.1f}x less backbone work)')
+    return print_eval_metrics(tgts, preds, model['best_thr'])
 
-    # load model
 
+def recenter(probs, thr, eps=1e-6):
+    # shift probabilities so that the decision threshold thr maps to 0.5
+    thr = min(max(thr, eps), 1 - eps)
+    return torch.sigmoid(torch.logit(probs, eps=eps) - math.log(thr / (1 - thr)))
+
+
+@torch.no_grad()
+def eval_cascade(loader, model, device, precision='fp32'):
+    """
+    Early-exit cascade: the motion-only model decides alone when it is confident, frames are
+    only read and fed to the hybrid model when its probability is within the band around its threshold.
+    Scores of both stages are recentered on their own threshold, the cascade threshold is 0.5.
+    """
+    assert loader.batch_size == 1, "cascade evaluation works sample by sample"
+    encoder_CNN, decoder_RNN = model['encoder'], model['decoder']
+    motion_RNN, motion_thr = model['motion']['decoder'], model['motion']['best_thr']
+    # the loader does not read frames, the image dataset is only used for uncertain samples
+    image_ds = copy.copy(loader.dataset)
+    image_ds.load_image = True
+
+    preds, tgts, n_steps, _ = prep_pred_storage(loader)
+    motion_preds = np.zeros_like(preds)
+    n_hybrid = 0
+    for step, inputs in enumerate(tqdm(loader)):
+        _, seq_len, pv, _, _, targets = unpack_batch(inputs, device)
+        with autocast(device, precision):
+            p_motion = motion_RNN(pv, seq_len)
+        p_motion = p_motion.float().view(-1)
+        motion_preds[step] = p_motion.item()
+        score = recenter(p_motion, motion_thr)
+
+        if abs(p_motion.item() - motion_thr) <= model['band']:
+            n_hybrid += 1
+            batch = default_collate([image_ds[step]])
+            images, seq_len, pv, scene, behavior, _ = unpack_batch(batch, device)
+            with autocast(device, precision):
+                outputs_CNN = encoder_CNN(images, seq_len)
+                outputs_RNN = decoder_RNN(xc_3d=outputs_CNN, xp_3d=pv, 
+                                            xb_3d=behavior, xs_2d=scene, x_lengths=seq_len)
+            score = recenter(outputs_RNN.float().view(-1), model['best_thr'])
+
+        preds[step] = score.item()
+        tgts[step] = targets.detach().cpu().squeeze()
+
+    print(f'Cascade: hybrid model run on {n_hybrid} / {n_steps} samples, '
+          f'{100 * (1 - n_hybrid / max(n_steps, 1)):.1f}% of CNN calls avoided (band {model["band"]})')
+    print('Motion-only model:')
+    print_eval_metrics(tgts, motion_preds, motion_thr)
+    print('Cascade:')
+    return print_eval_metrics(tgts, preds, 0.5)
+
+
+def build_model(args):
+    """
+    Construct the model of the evaluation mode, weights are loaded separately from the checkpoint
+    (no ImageNet weights for the backbones)
+    :return: model dict, image transform and whether images should be loaded
+    """
     if args.mode == 'cnn_only':
-        encoder_res18 = Res18Classifier(CNN_embed_dim=EMBEDDING_DIM, activation="sigmoid").to(device)
+        encoder_res18 = Res18Classifier(CNN_embed_dim=EMBEDDING_DIM, activation="sigmoid", pretrained=False).to(device)
         encoder_res18.eval()
         model = {'encoder': encoder_res18}
         transform, load_image  = IMAGE_TRANSFORM, True
     
     elif args.mode == 'rnn_only':
 
-        POS_VEL_DIM = 8
         rnn_classifier = RNNClassifier(input_size=POS_VEL_DIM, rnn_embeding_size=EMBEDDING_DIM, classification_head_size=128).to(device)
         model = {'decoder': rnn_classifier}
         transform, load_image = None, False
 
-    elif args.mode == 'hybrid':
-        encoder_CNN = build_encoder_res18(args)
+    elif args.mode in ['hybrid', CASCADE_MODE]:
+        encoder_CNN = build_encoder_res18(args, pretrained=False)
         decoder_RNN = DecoderRNN_IMBS(CNN_embeded_size=256, h_RNN_0=256, h_RNN_1=64, h_RNN_2=16,
-                                    h_FC0_dim=128, h_FC1_dim=64, h_FC2_dim=86, drop_p=0.2).to(device)
+                                    h_FC0_dim=128, h_FC1_dim=64, h_FC2_dim=86, drop_p=0.2, fused=args.fused_decoder).to(device)
         encoder_CNN.eval()
         decoder_RNN.eval()
         model = {'encoder': encoder_CNN, 'decoder': decoder_RNN}
 
         transform, load_image = IMAGE_TRANSFORM, True
+        if args.mode == CASCADE_MODE:
+            rnn_classifier = RNNClassifier(input_size=POS_VEL_DIM, rnn_embeding_size=EMBEDDING_DIM, classification_head_size=128).to(device)
+            rnn_classifier.eval()
+            model['motion'] = {'decoder': rnn_classifier}
+            model['band'] = args.cascade_band
+            # frames are read by eval_cascade for the uncertain samples only
+            load_image = False
+
+    return model, transform, load_image
 
+
+EVAL_FUNCTIONS = {'cnn_only': eval_cnn, 'rnn_only': eval_rnn, 'hybrid': eval_hybrid, CASCADE_MODE: eval_cascade}
+
+def main():
+    args = get_args()
+    if args.mode == 'cnn_only':
+        args.max_frames = 1
+    if args.mode not in EVAL_MODES + [CASCADE_MODE]:
+        raise ValueError(f'invalid mode, please choose from {", ".join(EVAL_MODES + [CASCADE_MODE])}')
+    # load model
+    model, transform, load_image = build_model(args)
     load_from_checkpoint(model, args.checkpoint_path)    
+    if args.mode == CASCADE_MODE:
+        load_from_checkpoint(model['motion'], args.rnn_checkpoint_path)
+    precision, _ = setup_precision(args, device, encoder=model.get('encoder'))
+    if args.reuse_embeddings and args.mode != 'hybrid':
+        raise ValueError('--reuse-embeddings is only supported in hybrid mode')
 
-    normal_loader = build_loader(args, normal_intent_sequences, transform, image_dir_eval, load_image=load_image)
-    hard_loader = build_loader(args, hard_intent_sequences, transform, image_dir_eval, load_image=load_image)
+    normal_loader, hard_loader = build_test_loaders(args, transform, load_image=load_image)
 
     eval_function = EVAL_FUNCTIONS[args.mode]
+    if args.reuse_embeddings:
+        model['embedding_cache'] = LRUCache(args.embedding_cache_size)
+        eval_function = eval_hybrid_reuse
 
     print(f'Normal test loader : {len(normal_loader)}, Hard (transition only) test loader : {len(hard_loader)}')
-    print(f'Evaluation on full test set')
-    eval_function(normal_loader, model, device)
-    print(f'Evaluation on transition only test set')
-    eval_function(hard_loader, model, device)
+    for name, loader in [('full test set', normal_loader), ('transition only test set', hard_loader)]:
+        print(f'Evaluation on {name}')
+        f1, ap = eval_function(loader, model, device, precision=precision)
+        if args.compare_fp32 and precision != 'fp32':
+            print(f'fp32 reference on {name}')
+            f1_ref, ap_ref = eval_function(loader, model, device)
+            print(f'{precision} vs fp32 on {name}: F1 {f1:.3f} / {f1_ref:.3f}, AP {ap:.3f} / {ap_ref:.3f}')
     
 
 if __name__ == '__main__':
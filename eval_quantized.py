@@ -0,0 +1,115 @@
+import argparse
+import torch
+from eval_hybrid import build_model, build_test_loaders, EVAL_FUNCTIONS, EVAL_MODES, IMAGE_TRANSFORM
+from src.dataset.intention.jaad_dataset import build_pedb_dataset_jaad
+from src.dataset.loader import define_path, IntentionSequenceDataset
+from src.early_stopping import load_from_checkpoint
+from src.model.export import build_export_module, example_inputs, export
+from src.model.quantize import calibration_frames, quantize_model, model_size_mb, benchmark
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='post-training int8 quantization and evaluation')
+
+    parser.add_argument('--jaad', default=True, action='store_true',
+                        help='use JAAD dataset')
+    parser.add_argument('--fps', default=5, type=int,
+                        metavar='FPS', help='sampling rate(fps)')
+    parser.add_argument('--max-frames', default=5, type=int,
+                        help='maximum number of frames in histroy sequence')
+    parser.add_argument('--pred', default=5, type=int,
+                        help='prediction length, predicting-ahead time')
+    parser.add_argument('-s', '--seed', type=int, default=99,
+                        help='set random seed for sampling')
+    parser.add_argument('-cp', '--checkpoint-path', type=str,
+                        help='path to the checkpoint for loading pretrained weights')
+    parser.add_argument('-nw', '--num-workers', type=int, default=4,
+                        help='number of workers for data loading')
+    parser.add_argument('--io-threads', type=int, default=0,
+                        help='number of threads reading frames inside every loader worker')
+    parser.add_argument("--mode", type=str)
+    parser.add_argument("--backbone", type=str, default="resnet18")
+    parser.add_argument('--engine', type=str, default='x86', choices=torch.backends.quantized.supported_engines,
+                        help='quantized engine of the target cpu (x86/fbgemm for servers, qnnpack for arm)')
+    parser.add_argument('--calib-batches', type=int, default=32,
+                        help='number of validation batches used to calibrate the conv backbone')
+    parser.add_argument('--calib-batch-size', type=int, default=8,
+                        help='batch size of the calibration loader')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='number of cpu threads of the speed report, torch default if None')
+    parser.add_argument('--bench-iters', type=int, default=20,
+                        help='number of timed calls of the speed report')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='export the quantized model as a torchscript graph (see export_model.py)')
+    args = parser.parse_args()
+    args.fused_decoder = False
+
+    return args
+
+
+def build_calibration_loader(args):
+    anns_paths, image_dir = define_path(use_jaad=args.jaad, use_pie=False, use_titan=False)
+    val_sequences = build_pedb_dataset_jaad(
+        anns_paths["JAAD"]["anns"],
+        anns_paths["JAAD"]["split"],
+        image_set = "val",
+        fps=args.fps,
+        prediction_frames=args.pred,
+        max_frames=args.max_frames,
+        verbose=True)
+    ds = IntentionSequenceDataset(val_sequences, image_dir=image_dir, hflip_p=0, preprocess=IMAGE_TRANSFORM,
+                                  io_threads=args.io_threads)
+    generator = torch.Generator().manual_seed(args.seed)
+    return torch.utils.data.DataLoader(ds, batch_size=args.calib_batch_size, num_workers=args.num_workers,
+                                       shuffle=True, generator=generator)
+
+
+def main():
+    args = get_args()
+    if args.mode == 'cnn_only':
+        args.max_frames = 1
+    if args.mode not in EVAL_MODES:
+        raise ValueError(f'invalid mode, please choose from {", ".join(EVAL_MODES)}')
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device('cpu')
+
+    model, transform, load_image = build_model(args)
+    load_from_checkpoint(model, args.checkpoint_path)
+    for k in ['encoder', 'decoder']:
+        if k in model:
+            model[k].cpu().eval()
+
+    calib_frames = None
+    if 'encoder' in model:
+        calib_frames = calibration_frames(build_calibration_loader(args), args.calib_batches)
+    q_model = quantize_model(model, calib_frames, engine=args.engine)
+
+    normal_loader, hard_loader = build_test_loaders(args, transform, load_image=load_image)
+    eval_function = EVAL_FUNCTIONS[args.mode]
+    inputs = example_inputs(args.mode, batch_size=1, max_frames=args.max_frames)
+
+    report = {}
+    for name, m in [('fp32', model), ('int8', q_model)]:
+        print(f'Evaluation of the {name} model on full test set')
+        f1, ap = eval_function(normal_loader, m, device)
+        print(f'Evaluation of the {name} model on transition only test set')
+        f1_hard, ap_hard = eval_function(hard_loader, m, device)
+        latency = benchmark(build_export_module(args.mode, m), inputs, n_iter=args.bench_iters)
+        report[name] = (f1, ap, f1_hard, ap_hard, latency, model_size_mb(m))
+
+    print(f'\n{"model":<6} {"F1":>6} {"AP":>6} {"F1 tr.":>7} {"AP tr.":>7} {"ms/seq":>8} {"MB":>7}')
+    for name, (f1, ap, f1_hard, ap_hard, latency, size) in report.items():
+        print(f'{name:<6} {f1:6.3f} {ap:6.3f} {f1_hard:7.3f} {ap_hard:7.3f} {latency:8.1f} {size:7.1f}')
+    print(f'int8 speedup: {report["fp32"][4] / report["int8"][4]:.2f}x ({args.engine} engine, {torch.get_num_threads()} threads)')
+
+    if args.output is not None:
+        metadata = {'mode': args.mode, 'best_thr': float(model['best_thr']), 'backbone': args.backbone,
+                    'quantized': args.engine}
+        export(build_export_module(args.mode, q_model), example_inputs(args.mode, batch_size=2, max_frames=args.max_frames),
+               args.output, metadata=metadata)
+        print(f'Exported int8 {args.mode} model to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
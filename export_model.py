@@ -0,0 +1,80 @@
+import argparse
+import time
+import torch
+from eval_hybrid import build_model, EVAL_MODES
+from src.early_stopping import load_from_checkpoint
+from src.checkpoint import export_inference_checkpoint
+from src.model.export import EXPORT_FORMATS, build_export_module, example_inputs, export
+from src.runtime import load_exported
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='export a trained model to a single inference graph')
+
+    parser.add_argument('-cp', '--checkpoint-path', type=str,
+                        help='path to the checkpoint for loading pretrained weights')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='output graph path, <mode>.pt / <mode>.onnx by default')
+    parser.add_argument('--format', type=str, default='torchscript', choices=EXPORT_FORMATS + ['weights'],
+                        help='export format, weights: memory-mappable weights-only checkpoint (<checkpoint>.weights.pt)')
+    parser.add_argument('--opset', type=int, default=17,
+                        help='onnx opset version')
+    parser.add_argument('--max-frames', default=5, type=int,
+                        help='number of frames of the tracing example, the time axis stays dynamic')
+    parser.add_argument("--mode", type=str)
+    parser.add_argument("--backbone", type=str, default="resnet18")
+    parser.add_argument('--no-check', default=False, action='store_true',
+                        help='skip the comparison of the exported graph with the eager model')
+    args = parser.parse_args()
+    # options of eval_hybrid.build_model that do not matter for an exported graph
+    args.fused_decoder = False
+
+    return args
+
+
+def check_export(model, module, save_path, inputs):
+    """
+    Compare the exported graph with the eager model on a batch of different size than the tracing example
+    """
+    with torch.no_grad():
+        reference = module(*inputs.values())
+        exported = load_exported(save_path, device='cpu')
+        start = time.perf_counter()
+        outputs = exported(*inputs.values())
+        elapsed = time.perf_counter() - start
+    max_diff = (outputs.to(reference.device) - reference).abs().max().item()
+    print(f'Exported graph check: max abs difference {max_diff:.2e}, {elapsed * 1000:.1f} ms per call')
+    return max_diff
+
+
+def main():
+    args = get_args()
+    if args.format == 'weights':
+        # checkpoints written before the training saved the inference checkpoints
+        print(f'Exported weights to {export_inference_checkpoint(args.checkpoint_path, args.output)}')
+        return
+    if args.mode == 'cnn_only':
+        args.max_frames = 1
+    if args.mode not in EVAL_MODES:
+        raise ValueError(f'invalid mode, please choose from {", ".join(EVAL_MODES)}')
+    save_path = args.output or f'{args.mode}.{"onnx" if args.format == "onnx" else "pt"}'
+
+    model, _, _ = build_model(args)
+    load_from_checkpoint(model, args.checkpoint_path)
+    # trace on cpu, the torchscript graph is moved to the serving device at load time
+    for k in ['encoder', 'decoder']:
+        if k in model:
+            model[k].cpu().eval()
+    module = build_export_module(args.mode, model)
+
+    metadata = {'mode': args.mode, 'best_thr': float(model['best_thr']), 'backbone': args.backbone}
+    export(module, example_inputs(args.mode, batch_size=2, max_frames=args.max_frames), save_path,
+           export_format=args.format, metadata=metadata, opset=args.opset)
+    print(f'Exported {args.mode} model to {save_path}')
+
+    if not args.no_check:
+        check_export(model, module, save_path, example_inputs(args.mode, batch_size=3, max_frames=args.max_frames + 2))
+
+
+if __name__ == '__main__':
+    main()
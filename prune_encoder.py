@@ -0,0 +1,192 @@
+import argparse
+import copy
+import json
+from pathlib import Path
+import torch
+from tqdm import tqdm
+from eval_hybrid import build_model
+from train_hybrid import HybridAdapter, prepare_data
+from src.dataset.intention.jaad_dataset import unpack_batch
+from src.dataset.utils import build_dataloaders
+from src.early_stopping import EarlyStopping, load_from_checkpoint
+from src.model.export import build_export_module, example_inputs
+from src.model.pruning import prunable_units, prune_backbone
+from src.model.quantize import benchmark
+from src.logger import LOGGERS
+from src.trainer import Trainer
+from src.utils import count_parameters, count_flops, find_best_threshold, seed_torch, setup_logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='structured channel pruning of the hybrid model CNN encoder')
+    parser.add_argument('--jaad', default=True, action='store_true',
+                        help='use JAAD dataset')
+    parser.add_argument('--fps', default=5, type=int,
+                        metavar='FPS', help='sampling rate(fps)')
+    parser.add_argument('--max-frames', default=5, type=int,
+                        help='maximum number of frames in histroy sequence')
+    parser.add_argument('--pred', default=5, type=int,
+                        help='prediction length, predicting-ahead time')
+    parser.add_argument('--balancing-ratio', default=1.0, type=float,
+                        help='ratio of balanced instances(1/0)')
+    parser.add_argument('--seed', default=99, type=int,
+                        help='random seed for sampling')
+    parser.add_argument('-cp', '--checkpoint-path', type=str,
+                        help='path to the trained hybrid model checkpoint')
+    parser.add_argument("--backbone", type=str, default="resnet18")
+    parser.add_argument('--ratios', default='0.25,0.5,0.75', type=str,
+                        help='fractions of channels removed in the sensitivity analysis of every layer')
+    parser.add_argument('--tolerances', default='0.005,0.01,0.02,0.05', type=str,
+                        help='val F1 drops allowed per layer, one pruned candidate per tolerance')
+    parser.add_argument('--sensitivity-batches', default=0, type=int,
+                        help='number of val batches used for the sensitivity analysis (0: full val set)')
+    parser.add_argument('--finetune-epochs', default=3, type=int,
+                        help='epochs of fc + decoder fine-tuning of every pruned candidate')
+    parser.add_argument('-lr', '--learning-rate', default=1e-5, type=float,
+                        metavar='LR', help='fine-tuning learning rate', dest='lr')
+    parser.add_argument('-b', '--batch-size', default=4, type=int,
+                        metavar='N', help='mini-batch size (default: 4)')
+    parser.add_argument('-wd', '--weight-decay', metavar='WD', type=float, default=1e-4,
+                        help='Weight decay', dest='wd')
+    parser.add_argument('--bench-iters', default=10, type=int,
+                        help='number of timed calls of the latency measure')
+    parser.add_argument('-nw', '--num-workers', default=4, type=int, help='number of workers for data loading')
+    parser.add_argument('--io-threads', default=0, type=int, help='number of threads reading frames inside every loader worker')
+    parser.add_argument('--logger', default='wandb', type=str, choices=LOGGERS,
+                        help='metrics logging backend of the fine-tuning runs (none: no logging)')
+    args = parser.parse_args()
+    # options of train_hybrid / eval_hybrid not used by the pruning workflow
+    args.mode, args.fused_decoder = 'hybrid', False
+    args.epoch_balancing, args.balance_strata, args.locality_window = False, 'none', 0
+    args.read_ahead, args.shared_index = 0, False
+
+    return args
+
+
+@torch.no_grad()
+def val_f1(loader, model, device, max_batches=0):
+    # F1 at the best threshold on (part of) the validation set
+    encoder_CNN, decoder_RNN = model['encoder'].eval(), model['decoder'].eval()
+    preds, tgts = [], []
+    for step, inputs in enumerate(tqdm(loader)):
+        if max_batches and step >= max_batches:
+            break
+        images, seq_len, pv, scene, behavior, targets = unpack_batch(inputs, device)
+        outputs_RNN = decoder_RNN(xc_3d=encoder_CNN(images, seq_len), xp_3d=pv, xb_3d=behavior, xs_2d=scene, x_lengths=seq_len)
+        preds.append(outputs_RNN.detach().cpu().view(-1))
+        tgts.append(targets.detach().cpu().view(-1))
+    _, f1 = find_best_threshold(torch.cat(preds).numpy(), torch.cat(tgts).numpy())
+    return f1
+
+
+def measure(model, max_frames, n_iter):
+    """
+    Parameter count, FLOPs and cpu latency of the full hybrid model for one sequence
+    """
+    cpu_model = {k: copy.deepcopy(model[k]).cpu().eval() for k in ['encoder', 'decoder']}
+    module = build_export_module('hybrid', cpu_model)
+    inputs = example_inputs('hybrid', batch_size=1, max_frames=max_frames)
+    params = count_parameters(module, trainable_only=False)
+    flops = count_flops(module, *inputs.values())
+    latency = benchmark(module, inputs, n_iter=n_iter)
+    return params, flops, latency
+
+
+def sensitivity_analysis(loader, model, device, ratios, max_batches=0):
+    """
+    Val F1 drop when a single unit of the backbone is pruned, without fine-tuning
+    :return: dict unit name -> {ratio: F1 drop}
+    """
+    encoder = model['encoder']
+    backbone = encoder.backbone
+    base_f1 = val_f1(loader, model, device, max_batches)
+    print(f'Sensitivity analysis, unpruned val F1: {base_f1:.3f}')
+    sensitivity = {}
+    for name in prunable_units(backbone):
+        sensitivity[name] = {}
+        for ratio in ratios:
+            encoder.backbone, _ = prune_backbone(backbone, {name: ratio})
+            sensitivity[name][ratio] = base_f1 - val_f1(loader, model, device, max_batches)
+        print(f'{name:<16}' + ' '.join(f'{r:.2f}: {d:+.3f}' for r, d in sensitivity[name].items()))
+    encoder.backbone = backbone
+    return base_f1, sensitivity
+
+
+def candidate_ratios(sensitivity, tolerances):
+    """
+    One pruning config per tolerance: every unit gets the largest ratio whose F1 drop stays below it
+    """
+    candidates = []
+    for tol in tolerances:
+        ratios = {name: max([r for r, drop in drops.items() if drop <= tol], default=0.0)
+                  for name, drops in sensitivity.items()}
+        if any(ratios.values()) and ratios not in [c for _, c in candidates]:
+            candidates.append((tol, ratios))
+    return candidates
+
+
+def pareto_front(rows):
+    # rows that no other row beats on both latency and F1
+    return [r for r in rows if not any(o['latency_ms'] <= r['latency_ms'] and o['val_f1'] > r['val_f1'] or
+                                       o['latency_ms'] < r['latency_ms'] and o['val_f1'] >= r['val_f1'] for o in rows)]
+
+
+def main():
+    args = get_args()
+    seed_torch(args.seed)
+    run_name = setup_logging(args, 'prune')
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    ratios = [float(r) for r in args.ratios.split(',')]
+    tolerances = [float(t) for t in args.tolerances.split(',')]
+
+    train_loader, val_loader, _ = build_dataloaders(args, prepare_data, load_image=True)
+    model, _, _ = build_model(args)
+    load_from_checkpoint(model, args.checkpoint_path)
+    model['encoder'].freeze_backbone()
+
+    base_f1, sensitivity = sensitivity_analysis(val_loader, model, device, ratios, args.sensitivity_batches)
+    params, flops, latency = measure(model, args.max_frames, args.bench_iters)
+    rows = [{'name': 'unpruned', 'tolerance': None, 'val_f1': base_f1, 'params': params, 'flops': flops,
+             'latency_ms': latency, 'prune_config': {}, 'checkpoint': args.checkpoint_path}]
+
+    cp_dir = Path(f'./checkpoints/{run_name}')
+    cp_dir.mkdir(parents=True, exist_ok=True)
+    for k, (tol, unit_ratios) in enumerate(candidate_ratios(sensitivity, tolerances)):
+        print(f'Candidate {k}: tolerance {tol}, ratios {unit_ratios}')
+        candidate = {'encoder': copy.deepcopy(model['encoder']), 'decoder': copy.deepcopy(model['decoder']),
+                     'best_thr': model['best_thr']}
+        candidate['encoder'].backbone, candidate['prune_config'] = prune_backbone(model['encoder'].backbone, unit_ratios)
+
+        # recover the accuracy lost by pruning in the layers after the backbone
+        params_ft = list(candidate['encoder'].fc.parameters()) + list(candidate['decoder'].parameters())
+        optimizer = torch.optim.Adam(params_ft, lr=args.lr, weight_decay=args.wd)
+        save_path = cp_dir / f'pruned_{k}_tol{tol}.pt'
+        early_stopping = EarlyStopping(checkpoint=save_path, patience=args.finetune_epochs, verbose=True)
+        trainer = Trainer(HybridAdapter(), candidate, optimizer, device)
+        for epoch in range(args.finetune_epochs):
+            trainer.train_epoch(train_loader, epoch)
+            _, f1 = trainer.val_epoch(val_loader, epoch)
+            early_stopping(f1, candidate, optimizer, epoch)
+        if args.finetune_epochs == 0:
+            early_stopping(val_f1(val_loader, candidate, device), candidate, optimizer, 0)
+        load_from_checkpoint(candidate, save_path)
+
+        params, flops, latency = measure(candidate, args.max_frames, args.bench_iters)
+        rows.append({'name': f'pruned_{k}', 'tolerance': tol, 'val_f1': float(early_stopping.best_score), 'params': params,
+                     'flops': flops, 'latency_ms': latency, 'prune_config': candidate['prune_config'],
+                     'checkpoint': str(save_path)})
+
+    front = pareto_front(rows)
+    print(f'\n{"model":<12} {"tol":>6} {"val F1":>7} {"params (M)":>11} {"GFLOPs":>8} {"ms/seq":>8} pareto')
+    for r in sorted(rows, key=lambda r: r['latency_ms']):
+        tol = '-' if r['tolerance'] is None else f'{r["tolerance"]:.3f}'
+        print(f'{r["name"]:<12} {tol:>6} {r["val_f1"]:7.3f} {r["params"] / 1e6:11.2f} {r["flops"] / 1e9:8.2f} '
+              f'{r["latency_ms"]:8.1f} {"*" if r in front else ""}')
+    report_path = cp_dir / 'pruning_report.json'
+    with open(report_path, 'w') as f:
+        json.dump({'sensitivity': sensitivity, 'candidates': rows}, f, indent=2)
+    print(f'Pruning report saved to {report_path}, pruned checkpoints load with eval_hybrid.py -cp')
+
+
+if __name__ == '__main__':
+    main()
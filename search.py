@@ -0,0 +1,195 @@
+import argparse
+import datetime
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from pathlib import Path
+from src.checkpoint import read_resume_meta
+
+ROOT = Path(__file__).resolve().parent
+# searched options of the train_*.py scripts: search flag -> script flag
+SEARCH_SPACE = {'lr': '-lr', 'wd': '-wd', 'max_frames': '--max-frames', 'pred': '--pred', 'backbone': '--backbone'}
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Hyperparameter search with asynchronous successive halving (ASHA): '
+                                                 'trials run as local processes, the weakest ones are stopped after '
+                                                 'each rung of epochs. Unknown options are passed to the training script.')
+    parser.add_argument('--script', default='train_hybrid.py', type=str,
+                        help='training script of the trials (any train_*.py)')
+    parser.add_argument('--lr', default='1e-5,5e-5,1e-4,5e-4', type=str,
+                        help='comma separated learning rates')
+    parser.add_argument('--wd', default='1e-4,1e-3,1e-2', type=str,
+                        help='comma separated weight decays')
+    parser.add_argument('--max-frames', default='', type=str,
+                        help='comma separated observation lengths (default: the one of the script)')
+    parser.add_argument('--pred', default='', type=str,
+                        help='comma separated prediction lengths (default: the one of the script)')
+    parser.add_argument('--backbone', default='', type=str,
+                        help='comma separated CNN backbones (default: the one of the script)')
+    parser.add_argument('--trials', default=0, type=int,
+                        help='number of configurations drawn from the grid (0: the whole grid)')
+    parser.add_argument('--min-epochs', default=1, type=int,
+                        help='epochs of the first rung')
+    parser.add_argument('--max-epochs', default=27, type=int,
+                        help='epochs of a trial reaching the last rung')
+    parser.add_argument('--eta', default=3, type=int,
+                        help='reduction factor: the best 1/eta trials of a rung continue, for eta times more epochs')
+    parser.add_argument('--workers', default=2, type=int,
+                        help='number of trials running at the same time')
+    parser.add_argument('--devices', default='', type=str,
+                        help='comma separated gpus assigned to the workers in turn (CUDA_VISIBLE_DEVICES)')
+    parser.add_argument('--threads-per-trial', default=0, type=int,
+                        help='cpu threads of every trial (0: cpu count / workers)')
+    parser.add_argument('--anns-cache-dir', default='./DATA/cache', type=str,
+                        help='annotation sequences built once and shared by the trials')
+    parser.add_argument('--name', default='', type=str,
+                        help='name of the search: logs/<name>/ holds search.json and the trial outputs')
+    parser.add_argument('--seed', default=99, type=int,
+                        help='random seed of the configuration draw')
+    args, script_args = parser.parse_known_args()
+    args.name = args.name or f'search-{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}'
+    return args, script_args
+
+
+def build_rungs(min_epochs, max_epochs, eta):
+    """
+    Cumulative epochs at the end of every rung: min_epochs * eta^k, then max_epochs
+    """
+    rungs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= eta
+    return rungs + [max_epochs]
+
+
+def draw_configs(args):
+    space = {k: getattr(args, k).split(',') for k in SEARCH_SPACE if getattr(args, k)}
+    configs = [dict(zip(space, values)) for values in itertools.product(*space.values())]
+    random.Random(args.seed).shuffle(configs)
+    return configs[:args.trials] if args.trials else configs
+
+
+def next_promotion(trials, n_rungs, eta):
+    """
+    ASHA: a paused trial of rung k continues to rung k + 1 when it is in the best 1/eta of the trials
+    that finished rung k, higher rungs first
+    :return: trial to continue, None if no trial can be promoted yet
+    """
+    for k in reversed(range(n_rungs - 1)):
+        finished = [t for t in trials if len(t['scores']) > k]
+        ranked = sorted(finished, key=lambda t: t['scores'][k], reverse=True)[:len(finished) // eta]
+        for trial in ranked:
+            if trial['status'] == 'paused' and len(trial['scores']) == k + 1:
+                return trial
+    return None
+
+
+class Search:
+    def __init__(self, args, script_args):
+        self.args = args
+        self.script_args = script_args
+        self.rungs = build_rungs(args.min_epochs, args.max_epochs, args.eta)
+        self.configs = draw_configs(args)
+        self.trials = []
+        self.running = {}
+        self.log_dir = ROOT / 'logs' / args.name
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self.devices = args.devices.split(',') if args.devices else []
+        self.threads = args.threads_per_trial or max(1, (os.cpu_count() or 1) // args.workers)
+
+    def next_job(self):
+        trial = next_promotion(self.trials, len(self.rungs), self.args.eta)
+        if trial is None and len(self.trials) < len(self.configs):
+            trial = {'name': f'{self.args.name}-t{len(self.trials):03d}', 'config': self.configs[len(self.trials)],
+                     'scores': [], 'epochs': 0, 'status': 'new', 'resume': ''}
+            self.trials.append(trial)
+        return trial
+
+    def launch(self, trial, slot):
+        rung = len(trial['scores'])
+        cmd = [sys.executable, self.args.script] + self.script_args
+        for k, v in trial['config'].items():
+            cmd += [SEARCH_SPACE[k], v]
+        cmd += ['--epochs', str(self.rungs[rung]), '--run-name', trial['name'], '--logger', 'jsonl', '--skip-test',
+                '--anns-cache-dir', self.args.anns_cache_dir]
+        if trial['resume']:
+            cmd += ['--resume', trial['resume']]
+        env = {**os.environ, 'OMP_NUM_THREADS': str(self.threads), 'MKL_NUM_THREADS': str(self.threads)}
+        if self.devices:
+            env['CUDA_VISIBLE_DEVICES'] = self.devices[slot % len(self.devices)]
+        output = open(self.log_dir / f'{trial["name"]}.out', 'a')
+        trial['status'] = 'running'
+        print(f'{trial["name"]}: rung {rung}, {self.rungs[rung]} epochs, {trial["config"]}')
+        self.running[trial['name']] = (subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=output, stderr=subprocess.STDOUT),
+                                       trial, slot, output)
+
+    def finish(self, name):
+        process, trial, slot, output = self.running.pop(name)
+        output.close()
+        resume_files = sorted((ROOT / 'checkpoints' / name).glob('*.resume.pt'))
+        if process.returncode != 0 or not resume_files:
+            trial['status'] = 'failed'
+            print(f'{name}: failed (exit code {process.returncode}), see {self.log_dir / (name + ".out")}')
+            return slot
+        meta = read_resume_meta(resume_files[0])
+        trial['resume'], trial['checkpoint'] = str(resume_files[0]), meta['checkpoint']
+        trial['scores'].append(meta['best_f1'])
+        trial['epochs'] = meta['epoch']
+        # stopped by its own early stopping or done with the last rung
+        stopped = meta['early_stop'] or len(trial['scores']) == len(self.rungs)
+        trial['status'] = 'stopped' if stopped else 'paused'
+        print(f'{name}: val/best_f1 {meta["best_f1"]:.4f} after {meta["epoch"]} epochs')
+        return slot
+
+    def save(self):
+        state = {'args': vars(self.args), 'script_args': self.script_args, 'rungs': self.rungs, 'trials': self.trials}
+        (self.log_dir / 'search.json').write_text(json.dumps(state, indent=2))
+
+    def run(self):
+        print(f'{len(self.configs)} configurations, rungs at {self.rungs} epochs, {self.args.workers} workers')
+        free_slots = list(range(self.args.workers))
+        while True:
+            while free_slots:
+                trial = self.next_job()
+                if trial is None:
+                    break
+                self.launch(trial, free_slots.pop(0))
+            if not self.running:
+                break
+            time.sleep(1.0)
+            for name in [n for n, (p, _, _, _) in self.running.items() if p.poll() is not None]:
+                free_slots.append(self.finish(name))
+                self.save()
+        # trials waiting for a promotion that can no longer come
+        for trial in self.trials:
+            if trial['status'] == 'paused':
+                trial['status'] = 'stopped'
+        self.save()
+
+    def report(self):
+        print('------------------------------------------------')
+        print(f'Search {self.args.name}, {len(self.trials)} trials:')
+        done = [t for t in self.trials if t['scores']]
+        for trial in sorted(done, key=lambda t: t['scores'][-1], reverse=True):
+            print(f'{trial["name"]}: val/best_f1 {trial["scores"][-1]:.4f}, {trial["epochs"]} epochs, {trial["config"]}')
+        if done:
+            best = max(done, key=lambda t: t['scores'][-1])
+            print(f'Best configuration: {best["config"]}, checkpoint: {best["checkpoint"]}')
+        print(f'Search state: {self.log_dir / "search.json"}')
+
+
+def main():
+    args, script_args = get_args()
+    search = Search(args, script_args)
+    search.run()
+    search.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+import copy
+import os
+import queue
+import random
+import threading
+from pathlib import Path
+import numpy as np
+import torch
+
+# format of the resume state files written by the Trainer
+RESUME_VERSION = 1
+# weights-only checkpoints of evaluation / serving, next to the training checkpoints
+INFERENCE_FORMAT = 'inference'
+INFERENCE_SUFFIX = '.weights.pt'
+
+
+def resume_path(checkpoint):
+    """
+    Resume state file of a run, next to its best-model checkpoint (<name>.pt -> <name>.resume.pt)
+    """
+    checkpoint = Path(checkpoint)
+    return checkpoint.with_name(checkpoint.stem + '.resume.pt')
+
+
+def capture_rng_state():
+    # every generator the training draws from: dropout, augmentation of single process loaders, samplers
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    # generator states are cpu ByteTensors, whatever device the state file was mapped to
+    torch.set_rng_state(state['torch'].cpu())
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def snapshot_to_cpu(obj):
+    """
+    Copy of the tensors of a (nested) state dict in cpu memory, the training can go on modifying the originals
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    # e.g. the metrics accumulator of a mid-epoch snapshot
+    return copy.deepcopy(obj)
+
+
+def to_device(obj, device):
+    """
+    The tensors of a (nested) state moved to device, counterpart of snapshot_to_cpu for the accumulators
+    of a mid-epoch snapshot (the metrics accumulator objects are updated in place)
+    """
+    if torch.is_tensor(obj):
+        return obj.to(device)
+    if isinstance(obj, dict):
+        return type(obj)((k, to_device(v, device)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_device(v, device) for v in obj)
+    if hasattr(obj, '__dict__'):
+        vars(obj).update({k: to_device(v, device) for k, v in vars(obj).items()})
+    return obj
+
+
+def atomic_save(obj, path, dump=torch.save):
+    """
+    torch.save to a temporary file, fsync and rename: the file at path is always a complete checkpoint,
+    a job killed while saving keeps the previous one
+    :params: dump: serialization function (obj, file), e.g. pickle.dump
+    """
+    path = Path(path)
+    # one temporary file per process: concurrent runs may write the same shared cache
+    tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    try:
+        # persist the rename
+        dir_fd = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError:
+        pass
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints in a background thread, in submission order: the training thread only copies the
+    tensors to cpu memory, serialization and (network) file system I/O run next to the training
+    """
+    def __init__(self, max_pending=2):
+        """
+        :params: max_pending: number of checkpoints waiting to be written before submit blocks (bounds the
+                    cpu memory held by the copies)
+        """
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            fn, args = self.jobs.get()
+            try:
+                if self.error is None:
+                    fn(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('checkpoint writing failed') from error
+
+    def submit(self, fn, *args):
+        # fn(*args) runs in the writer thread, after the previously submitted jobs
+        self._raise()
+        self.jobs.put((fn, args))
+
+    def save(self, obj, path):
+        self.submit(atomic_save, snapshot_to_cpu(obj), path)
+
+    def wait(self):
+        # block until every submitted checkpoint is on disk
+        self.jobs.join()
+        self._raise()
+
+
+def save_resume_state(path, state, writer=None):
+    state = {'version': RESUME_VERSION, **state}
+    if writer is not None:
+        writer.save(state, path)
+    else:
+        atomic_save(state, path)
+
+
+def load_resume_state(path):
+    """
+    Resume state mapped to the cpu: load_state_dict of the modules / optimizer moves the tensors to their
+    device, the random generator states must stay on the cpu
+    """
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    assert state.get('version') == RESUME_VERSION, f'{path} is not a resume state file (version {state.get("version")})'
+    return state
+
+
+def read_resume_meta(path):
+    """
+    Run information of a resume state file (best-model checkpoint, logging run id, progress), the tensors are
+    memory mapped, not read
+    """
+    state = torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    # states written before the logging backends hold the wandb run id
+    return {'checkpoint': state['checkpoint'], 'run_id': state.get('run_id', state.get('wandb_id')),
+            'epoch': state['epoch'], 'best_f1': state['best_f1'], 'early_stop': state['early_stopping']['early_stop']}
+
+
+def inference_path(checkpoint):
+    """
+    Inference checkpoint of a training checkpoint (<name>.pt -> <name>.weights.pt)
+    """
+    checkpoint = Path(checkpoint)
+    return checkpoint.with_name(checkpoint.stem + INFERENCE_SUFFIX)
+
+
+def to_inference(cp_dict):
+    """
+    Inference checkpoint of an EarlyStopping checkpoint dict: flat table of the module tensors
+    ('encoder.<param>', 'decoder.<param>') and plain python metadata, no optimizer state.
+    It only holds tensors and builtin types, so that it loads with weights_only=True.
+    """
+    tensors = {}
+    for name in ['encoder', 'decoder']:
+        for k, v in cp_dict.get(f'{name}_state_dict', {}).items():
+            tensors[f'{name}.{k}'] = v
+    prune_config = cp_dict.get('prune_config')
+    metadata = {'best_thr': float(cp_dict['best_thr']), 'epoch': int(cp_dict['epoch']), 'score': float(cp_dict['score']),
+                'prune_config': {k: int(v) for k, v in prune_config.items()} if prune_config else None}
+    return {'format': INFERENCE_FORMAT, 'metadata': metadata, 'tensors': tensors}
+
+
+def load_checkpoint(path):
+    """
+    Memory-mapped checkpoint (training or inference format): tensors are only read from disk when used,
+    e.g. the optimizer state of a training checkpoint is never read by the evaluation
+    """
+    # inference checkpoints hold no python objects
+    weights_only = str(path).endswith(INFERENCE_SUFFIX)
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=weights_only)
+    except RuntimeError:
+        # files of the legacy (non zip) serialization cannot be memory mapped
+        return torch.load(path, map_location='cpu', weights_only=weights_only)
+
+
+def module_state(checkpoint, name):
+    """
+    State dict of the module name ('encoder' / 'decoder') in a checkpoint of either format, None if absent
+    """
+    if checkpoint.get('format') == INFERENCE_FORMAT:
+        prefix = name + '.'
+        state = {k[len(prefix):]: v for k, v in checkpoint['tensors'].items() if k.startswith(prefix)}
+        return state or None
+    return checkpoint.get(f'{name}_state_dict')
+
+
+def checkpoint_metadata(checkpoint):
+    if checkpoint.get('format') == INFERENCE_FORMAT:
+        return checkpoint['metadata']
+    return {'best_thr': checkpoint['best_thr'], 'epoch': checkpoint.get('epoch'), 'score': checkpoint.get('score'),
+            'prune_config': checkpoint.get('prune_config')}
+
+
+def export_inference_checkpoint(checkpoint_path, output=None):
+    """
+    Write the inference checkpoint of an existing training checkpoint
+    :return: path of the inference checkpoint
+    """
+    output = Path(output) if output else inference_path(checkpoint_path)
+    checkpoint = load_checkpoint(checkpoint_path)
+    atomic_save(to_inference(checkpoint), output)
+    return output
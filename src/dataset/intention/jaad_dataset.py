@@ -1,15 +1,17 @@
+import os
+import hashlib
 import numpy as np
 import torch
 import pickle
-import copy
 import random
-from src.dataset.trans.jaad_trans import get_split_vids, get_pedb_ids_jaad
+from pathlib import Path
+from src.dataset.trans.jaad_trans import get_split_vids, get_pedb_tracks_jaad, get_behavior_vectors
 from collections import Counter
 from src.utils import reshape_bbox, bbox_to_pv
+from src.checkpoint import atomic_save
 import torch
-from src.dataset.loader import IntentionSequenceDataset
+from src.dataset.loader import IntentionSequenceDataset, tte_bucket
 from src.transform.preprocess import ImageTransform, Compose, ResizeFrame
-import torchvision
 
 
 
@@ -18,69 +20,48 @@ MAX_FRAMES = 5
 PREDICTION_FRAMES = 5
 SEED = 42
 
-def get_pedb_info_jaad(annotations, vid):
+def get_pedb_info_jaad(annotations, vid, max_occlusion=None, min_height=None):
     """
     Get pedb information,i.e. frames,bbox,occlusion, actions(walking or not),cross behavior.
     :param: annotations: JAAD annotations in dictionary form
             vid : single video id (str)
+            max_occlusion, min_height: optional frame filters, see get_track_mask
     :return: information of all pedestrians in one video
     """
-    ids = get_pedb_ids_jaad(annotations, vid)
-    dataset = annotations
+    tracks = get_pedb_tracks_jaad(annotations, vid, max_occlusion, min_height)
     pedb_info = {}
-    for idx in ids:
+    for idx, track in tracks.items():
         pedb_info[idx] = {}
-        pedb_info[idx]['frames'] = []
-        pedb_info[idx]['bbox'] = []
-        pedb_info[idx]['occlusion'] = []
-        pedb_info[idx]['action'] = []
-        pedb_info[idx]['cross'] = []
-        # process atomic behavior label
-        pedb_info[idx]['behavior'] = []
-        pedb_info[idx]['traffic_light'] = []
-
-        frames = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['frames'])
-        bbox = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['bbox'])
-        occlusion = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['occlusion'])
-
-        # behavioural data
-        action = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['behavior']['action'])
-        cross = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['behavior']['cross'])
-        nod = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['behavior']['nod'])
-        look = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['behavior']['look'])
-        hand_gesture = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['behavior']['hand_gesture'])
-
-
-        for i in range(len(frames)):
-            if action[i] in [0, 1]:  # sanity check if behavior label exists
-                # standing / walking
-                pedb_info[idx]['action'].append(action[i])
-                pedb_info[idx]['frames'].append(frames[i])
-                pedb_info[idx]['bbox'].append(bbox[i])
-                pedb_info[idx]['occlusion'].append(occlusion[i])
-                pedb_info[idx]['cross'].append(cross[i])
-                beh_vec = [0, 0, 0, 0]
-                # change for testing the influence of walking/non-walking to training
-                # beh_vec[0] = action[i]
-                beh_vec[1] = look[i]
-                beh_vec[2] = nod[i]
-                # TODO: maybe include it as a category?
-                hg = hand_gesture[i]
-                if hg > 0:
-                    beh_vec[3] = 1
-                pedb_info[idx]['behavior'].append(beh_vec)
-                # traffic light: {'n/a': 0, 'red': 1, 'green': 2}
-                pedb_info[idx]['traffic_light'].append(dataset[vid]['traffic_annotations'][frames[i]]['traffic_light'])
+        # standing / walking, traffic light: {'n/a': 0, 'red': 1, 'green': 2}
+        for key in ['frames', 'bbox', 'occlusion', 'action', 'cross', 'traffic_light']:
+            pedb_info[idx][key] = track[key].tolist()
+        # change for testing the influence of walking/non-walking to training
+        # TODO: maybe include hand gesture as a category?
+        pedb_info[idx]['behavior'] = get_behavior_vectors(track, use_action=False)
 
         # scene description
         atr_vec = [0, 0, 0, 0, 0]
-        pedb_info[idx]['attributes'] = copy.deepcopy(atr_vec)
+        pedb_info[idx]['attributes'] = atr_vec
     return pedb_info
 
 
+def time_to_crossing(frames, cross, j):
+    """
+    Time (s) from frame index j to the next crossing onset of the track, nan when the
+    pedestrian is already crossing at j or does not cross afterwards
+    """
+    if cross[j] == 1:
+        return float('nan')
+    for k in range(j + 1, len(cross)):
+        if cross[k] == 1:
+            return (frames[k] - frames[j]) / JAAD_BASE_FPS
+    return float('nan')
+
+
 def add_cross_label_jaad(dataset, prediction_frames, max_frames, verbose=False, transition_only=False, seed=99) -> None:
     """
-    Add cross & non-cross(c/nc) labels depends on prediction frame for every frame
+    Add cross & non-cross(c/nc) labels depends on prediction frame for every frame,
+    with the next action (walking at the predicted frame) and time-to-crossing bucket of the auxiliary tasks
     """
     all_cross = 0
     total_samples = 0
@@ -107,6 +88,8 @@ def add_cross_label_jaad(dataset, prediction_frames, max_frames, verbose=False,
             for attribute in ['frames', 'bbox', 'action', 'occlusion', 'behavior', 'traffic_light']:
                 new_sample[attribute] = dataset[idx][attribute][i:j + 1]
             new_sample['label'] = dataset[idx]['cross'][j + prediction_frames]
+            new_sample['next_action'] = dataset[idx]['action'][j + prediction_frames]
+            new_sample['tte_tag'] = tte_bucket(time_to_crossing(frames, dataset[idx]['cross'], j))
             all_cross += new_sample['label']
             for static_attribute in ['video_number', 'attributes']:
                 new_sample[static_attribute] = dataset[idx][static_attribute]
@@ -137,16 +120,19 @@ def build_pedb_dataset_jaad(jaad_anns_path,
                             prediction_frames=PREDICTION_FRAMES, 
                             max_frames=MAX_FRAMES,
                             verbose=False, 
-                            transition_only=False) -> dict:
+                            transition_only=False,
+                            max_occlusion=None,
+                            min_height=None) -> dict:
     """
     Build pedestrian dataset from jaad annotations
+    :param: max_occlusion, min_height: optional frame filters applied before sampling, see get_track_mask
     """
     jaad_anns = pickle.load(open(jaad_anns_path, 'rb'))
     pedb_dataset = {}
     vids = get_split_vids(split_vids_path, image_set, subset)
     fps_step = JAAD_BASE_FPS // fps
     for vid in vids:
-        pedb_info = get_pedb_info_jaad(jaad_anns, vid)
+        pedb_info = get_pedb_info_jaad(jaad_anns, vid, max_occlusion=max_occlusion, min_height=min_height)
         pids = list(pedb_info.keys())
         for idx in pids:
             if len(pedb_info[idx]['action']) > 0:
@@ -159,15 +145,43 @@ def build_pedb_dataset_jaad(jaad_anns_path,
     return intention_seqs
 
 
-def balance(intention_dataset, seed=SEED):
+def cached_pedb_dataset_jaad(cache_dir, jaad_anns_path, split_vids_path, **kwargs):
+    """
+    build_pedb_dataset_jaad through a disk cache: the sequences of an annotation file and setting are built
+    once, then unpickled by every run using them (e.g. the concurrent trials of search.py). Runs building
+    the same missing entry at the same time both write it, atomically.
+    :params: cache_dir: directory of the cache entries, kwargs: arguments of build_pedb_dataset_jaad
+    """
+    anns_stat = os.stat(jaad_anns_path)
+    setting = {k: v for k, v in kwargs.items() if k != 'verbose'}
+    # a modified annotation file gets new entries
+    key = repr((os.path.abspath(jaad_anns_path), anns_stat.st_size, anns_stat.st_mtime_ns,
+                os.path.abspath(split_vids_path), sorted(setting.items())))
+    cache_path = Path(cache_dir) / f'jaad_{kwargs.get("image_set", "all")}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.pkl'
+    if cache_path.exists():
+        with open(cache_path, 'rb') as f:
+            intention_seqs = pickle.load(f)
+        print(f'Loaded {len(intention_seqs)} sequences from {cache_path}')
+        return intention_seqs
+    intention_seqs = build_pedb_dataset_jaad(jaad_anns_path, split_vids_path, **kwargs)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    atomic_save(intention_seqs, cache_path, dump=pickle.dump)
+    return intention_seqs
+
+
+def balance(intention_dataset, seed=SEED, ratio=1.0):
+    """
+    Subsample the dataset once so that #crossing / #non-crossing == ratio
+    """
     random.seed(seed)
     all_labels = [el['label'] for el in intention_dataset]
     labels_stats = Counter(all_labels)
-    max_common = min(labels_stats[0], labels_stats[1])
+    n_noncrossing = min(labels_stats[0], int(labels_stats[1] / ratio))
+    n_crossing = min(labels_stats[1], int(round(ratio * n_noncrossing)))
     crossing_ids = [i for i, sample in enumerate(intention_dataset) if sample['label'] == 1]
     noncrossing_ids = [i for i, sample in enumerate(intention_dataset) if sample['label'] == 0]
-    kept_crossing_ids = random.sample(crossing_ids, max_common)
-    kept_noncrossing_ids = random.sample(noncrossing_ids, max_common)
+    kept_crossing_ids = random.sample(crossing_ids, n_crossing)
+    kept_noncrossing_ids = random.sample(noncrossing_ids, n_noncrossing)
     kept_ids = kept_crossing_ids + kept_noncrossing_ids
     balanced_dataset = [intention_dataset[i] for i in kept_ids]
     print(f"Total number of samples before and after balancing: {len(intention_dataset)}, {len(balanced_dataset)}")
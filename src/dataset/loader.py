@@ -1,13 +1,14 @@
 import os
+import io
 import copy
 import PIL
 import torch
-import torchvision
 import numpy as np
 import math
 
 import logging
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
 
 LOG = logging.getLogger(__name__)
 
@@ -21,6 +22,23 @@ def flip_image_and_bbox(img, anns):
     return img
 
 
+# upper bounds (s) of the time-to-event buckets, longer times fall in the last bucket
+TTE_BUCKETS = [0.45, 0.85, 1.25, 1.65, 2.05]
+
+
+def tte_bucket(tte):
+    """
+    Time-to-event bucket in 0..len(TTE_BUCKETS), -1 when the event does not happen (nan / None)
+    """
+    if tte is None or math.isnan(tte):
+        return -1
+    tte = round(tte, 2)
+    for tag, upper in enumerate(TTE_BUCKETS):
+        if tte < upper:
+            return tag
+    return len(TTE_BUCKETS)
+
+
 def define_path(use_jaad=True, use_pie=True, use_titan=True):
     """
     Define default path to data
@@ -43,6 +61,12 @@ def define_path(use_jaad=True, use_pie=True, use_titan=True):
     return anns_paths, image_dir
     
 
+def to_tensor(img):
+    # torchvision is only imported by the datasets reading frames
+    from torchvision.transforms.functional import to_tensor
+    return to_tensor(img)
+
+
 class ImageList(torch.utils.data.Dataset):
     """
     Basic dataloader for images
@@ -160,7 +184,7 @@ class FrameDataset(torch.utils.data.Dataset):
             img = PIL.Image.open(f).convert('RGB')
         if self.preprocess is not None:
             img, anns = self.preprocess(img, anns)
-        img_tensor = torchvision.transforms.ToTensor()(img)
+        img_tensor = to_tensor(img)
         if label is not None:
             label = torch.tensor(label)
             label = label.to(torch.float32)
@@ -223,7 +247,7 @@ class SimpleSequenceDataset(torch.utils.data.Dataset):
                 img = PIL.Image.open(f).convert('RGB')
             if self.preprocess is not None:
                 img, anns = self.preprocess(img, anns)
-            img_tensors.append(torchvision.transforms.ToTensor()(img))
+            img_tensors.append(to_tensor(img))
             bbox_new.append(anns['bbox'])
         img_tensors = torch.stack(img_tensors)
         sample = {'image': img_tensors, 'bbox': bbox_new, 'id': idx,  'source': source}
@@ -281,7 +305,7 @@ class SequenceDataset(torch.utils.data.Dataset):
                 img = PIL.Image.open(f).convert('RGB')
             if self.preprocess is not None:
                 img, anns = self.preprocess(img, anns)
-            img_tensors.append(torchvision.transforms.ToTensor()(img))
+            img_tensors.append(to_tensor(img))
             bbox_new.append(anns['bbox'])
         img_tensors = torch.stack(img_tensors)
         if label is not None:
@@ -375,7 +399,7 @@ class PaddedSequenceDataset(torch.utils.data.Dataset):
             anns['bbox_ped'] =  copy.deepcopy(anns['bbox'])
             if self.preprocess is not None:
                 img, anns = self.preprocess(img, anns)
-            img_tensors.append(torchvision.transforms.ToTensor()(img))
+            img_tensors.append(to_tensor(img))
             bbox_new.append(anns['bbox'])
             bbox_ped_new.append(anns['bbox_ped'])
     
@@ -399,23 +423,9 @@ class PaddedSequenceDataset(torch.utils.data.Dataset):
         if label is not None:
             label = torch.tensor(label)
             label = label.to(torch.float32)
-        TTE_tag = -1
-        if math.isnan(TTE):
-            pass
-        else:
-            TTE = round(self.samples[idx]["TTE"],2)
-            if TTE < 0.45:
-               TTE_tag = 0
-            elif 0.45 < TTE < 0.85:
-               TTE_tag = 1
-            elif 0.85 < TTE < 1.25:
-               TTE_tag = 2
-            elif 1.25 < TTE < 1.65:
-               TTE_tag = 3
-            elif 1.65 < TTE < 2.05:
-               TTE_tag = 4
-            else:
-               TTE_tag = 5
+        TTE_tag = tte_bucket(TTE)
+        if not math.isnan(TTE):
+            TTE = round(TTE, 2)
         TTE = torch.tensor(TTE).to(torch.float32)
         TTE_tag = torch.tensor(TTE_tag)
         TTE_tag = TTE_tag.to(torch.float32)
@@ -431,42 +441,176 @@ class PaddedSequenceDataset(torch.utils.data.Dataset):
         return len(self.samples.keys())
         
 
+class ImageReader:
+    """
+    Reads and decodes frames concurrently in a pool of threads.
+    File reads of some frames overlap with the decoding of others, which hides most
+    of the latency of a slow (network) filesystem inside a single loader worker.
+    """
+
+    def __init__(self, num_threads=8):
+        self.num_threads = num_threads
+        self._pool = None
+        self._pid = None
+
+    @staticmethod
+    def read(image_path):
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        return PIL.Image.open(io.BytesIO(data)).convert('RGB')
+
+    def submit(self, image_paths):
+        # the pool is created lazily in every (forked) loader worker
+        if self._pool is None or self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.num_threads)
+            self._pid = os.getpid()
+        return [self._pool.submit(self.read, path) for path in image_paths]
+
+    def __getstate__(self):
+        return {'num_threads': self.num_threads, '_pool': None, '_pid': None}
+
+
+class SharedSampleIndex:
+    """
+    Flat storage of intention samples in shared-memory tensors.
+    Loader workers map the same memory instead of each receiving (and touching) a
+    copy of a list of python dicts, so resident memory stays flat with more workers.
+    Indexing returns the sample as a dict, like the original list of samples.
+    """
+    SEQUENCE_KEYS = {'frames': torch.int64, 'bbox': torch.float64, 'action': torch.int64, 'behavior': torch.float32}
+    STRING_KEYS = ['sample_id', 'ped_id', 'video_number']
+    # per-sample labels of the auxiliary tasks, see add_cross_label_jaad
+    TASK_KEYS = ['next_action', 'tte_tag']
+
+    def __init__(self, samples):
+        lengths = [len(sample['frames']) for sample in samples]
+        self.offsets = torch.zeros(len(samples) + 1, dtype=torch.int64)
+        self.offsets[1:] = torch.cumsum(torch.tensor(lengths, dtype=torch.int64), dim=0)
+        self.columns = {}
+        for key, dtype in self.SEQUENCE_KEYS.items():
+            values = [v for sample in samples for v in sample[key]]
+            self.columns[key] = torch.tensor(values, dtype=dtype)
+        self.columns['label'] = torch.tensor([sample['label'] for sample in samples], dtype=torch.int64)
+        self.columns['attributes'] = torch.tensor([sample['attributes'] for sample in samples], dtype=torch.int64)
+        for key in self.TASK_KEYS:
+            if len(samples) > 0 and key in samples[0]:
+                self.columns[key] = torch.tensor([sample[key] for sample in samples], dtype=torch.int64)
+        self.strings = {key: self._encode([sample[key] for sample in samples]) for key in self.STRING_KEYS}
+        for tensor in [self.offsets] + list(self.columns.values()):
+            tensor.share_memory_()
+        for data, offsets in self.strings.values():
+            data.share_memory_()
+            offsets.share_memory_()
+
+    @staticmethod
+    def _encode(strings):
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = torch.zeros(len(encoded) + 1, dtype=torch.int64)
+        offsets[1:] = torch.cumsum(torch.tensor([len(e) for e in encoded], dtype=torch.int64), dim=0)
+        data = torch.frombuffer(bytearray(b''.join(encoded)), dtype=torch.uint8) if offsets[-1] > 0 else torch.zeros(0, dtype=torch.uint8)
+        return data.clone(), offsets
+
+    def _decode(self, key, index):
+        data, offsets = self.strings[key]
+        return bytes(data[offsets[index]:offsets[index + 1]].numpy()).decode('utf-8')
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self):
+            raise IndexError(index)
+        start, end = self.offsets[index].item(), self.offsets[index + 1].item()
+        sample = {key: self._decode(key, index) for key in self.STRING_KEYS}
+        sample['frames'] = self.columns['frames'][start:end].tolist()
+        sample['bbox'] = self.columns['bbox'][start:end].tolist()
+        sample['action'] = self.columns['action'][start:end].tolist()
+        sample['behavior'] = self.columns['behavior'][start:end]
+        sample['label'] = self.columns['label'][index].item()
+        sample['attributes'] = self.columns['attributes'][index]
+        for key in self.TASK_KEYS:
+            if key in self.columns:
+                sample[key] = self.columns[key][index].item()
+        return sample
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
 class IntentionSequenceDataset(torch.utils.data.Dataset):
     """
     Basic dataloader for loading sequence/history samples
     """
 
-    def __init__(self, samples, image_dir, preprocess=None, hflip_p=0.0, load_image=True):
+    def __init__(self, samples, image_dir, preprocess=None, hflip_p=0.0, load_image=True, io_threads=0, read_ahead=0,
+                 shared_index=False):
         """
         :params: samples: pedestrian trajectory samples(dict)
                 image_dir: root dir for images extracted from video clips
                 preprocess: optional preprocessing on image tensors and annotations
+                io_threads: number of threads reading frames concurrently, 0 reads them one after another
+                read_ahead: number of upcoming samples of a batch whose frames are read in advance
+                shared_index: keep the samples in shared-memory tensors (SharedSampleIndex)
         """
-        self.samples = samples
+        self.samples = SharedSampleIndex(samples) if shared_index else samples
         self.image_dir = image_dir
         self.preprocess = preprocess
         self.hflip_p = hflip_p
-        self._to_tensor = torchvision.transforms.ToTensor()
+        self._to_tensor = to_tensor
         self.load_image = load_image
+        self.read_ahead = read_ahead
+        self.reader = ImageReader(io_threads) if io_threads > 0 else None
+
+    def image_paths(self, sample):
+        vid = sample['video_number']
+        return [os.path.join(self.image_dir['JAAD'], vid, '{:05d}.png'.format(f)) for f in sample['frames']]
+
+    def read_images(self, sample):
+        if self.reader is None:
+            return [ImageReader.read(path) for path in self.image_paths(sample)]
+        return [future.result() for future in self.reader.submit(self.image_paths(sample))]
 
     def __getitem__(self, index):
-        sample_id = self.samples[index]['sample_id']
-        frames = self.samples[index]['frames']
-        attributes = torch.tensor(self.samples[index]['attributes'])
-        action = self.samples[index]['action']
-        behavior = torch.tensor(self.samples[index]['behavior'], dtype=torch.float32)
-        bbox = copy.deepcopy(self.samples[index]['bbox'])
-        label = self.samples[index]['label']
+        sample = self.samples[index]
+        images = self.read_images(sample) if self.load_image else None
+        return self.build_sample(sample, images)
+
+    def __getitems__(self, indices):
+        """
+        Batched loading (used by the DataLoader when available): frames of the next
+        `read_ahead` samples are already being read while the current one is processed.
+        """
+        if not self.load_image or self.reader is None:
+            return [self[index] for index in indices]
+        samples = [self.samples[index] for index in indices]
+        pending = {}
+        for k in range(min(self.read_ahead + 1, len(samples))):
+            pending[k] = self.reader.submit(self.image_paths(samples[k]))
+        batch = []
+        for k, sample in enumerate(samples):
+            nxt = k + self.read_ahead + 1
+            if nxt < len(samples):
+                pending[nxt] = self.reader.submit(self.image_paths(samples[nxt]))
+            images = [future.result() for future in pending.pop(k)]
+            batch.append(self.build_sample(sample, images))
+        return batch
+
+    def build_sample(self, sample, images=None):
+        sample_id = sample['sample_id']
+        frames = sample['frames']
+        attributes = torch.as_tensor(sample['attributes'])
+        action = sample['action']
+        behavior = torch.as_tensor(sample['behavior'], dtype=torch.float32)
+        bbox = copy.deepcopy(sample['bbox'])
+        label = sample['label']
         bbox_ped_new = []
         img_tensors = []
         hflip = True if float(torch.rand(1).item()) < self.hflip_p else False
         for i in range(len(frames)):
             anns = {'bbox': bbox[i]}
             if self.load_image:
-                vid = self.samples[index]['video_number']
-                image_path = os.path.join(self.image_dir['JAAD'], vid, '{:05d}.png'.format(frames[i]))
-                with open(image_path, 'rb') as f:
-                    img = PIL.Image.open(f).convert('RGB')
+                img = images[i]
                 if hflip:
                     img = flip_image_and_bbox(img, anns)
                 if self.preprocess is not None:
@@ -478,10 +622,24 @@ class IntentionSequenceDataset(torch.utils.data.Dataset):
         seq_len = len(frames)
         label = torch.tensor(label, dtype=torch.float32)
 
+        # auxiliary task labels: walking at the predicted frame, time-to-crossing bucket (-1: no crossing ahead)
+        tasks = {}
+        if 'next_action' in sample:
+            tasks = {'next_action': torch.tensor(sample['next_action'], dtype=torch.float32),
+                     'tte_tag': torch.tensor(sample['tte_tag'], dtype=torch.int64)}
+
         sample = {'image': img_tensors, 'bbox': bbox_ped_new, 'bbox_ped': bbox_ped_new, 
                    'seq_length': seq_len, 'id':sample_id, 'label': label, 'attributes': attributes, 'action': action, 'behavior': behavior}
+        sample.update(tasks)
 
         return sample
 
     def __len__(self):
         return len(self.samples)
+
+
+def order_windows(samples):
+    """
+    Order sliding-window samples by (video, pedestrian, window start), overlapping windows become neighbours
+    """
+    return sorted(samples, key=lambda s: (s['video_number'], str(s['ped_id']), s['frames'][0]))
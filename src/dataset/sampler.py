@@ -0,0 +1,238 @@
+import numpy as np
+from collections import OrderedDict
+import torch
+
+
+def split_counts(total, weights):
+    """
+    Split an integer total proportionally to weights (largest remainder rounding)
+    """
+    weights = np.asarray(weights, dtype=np.float64)
+    if total <= 0 or weights.sum() == 0:
+        return np.zeros(len(weights), dtype=int)
+    exact = total * weights / weights.sum()
+    counts = np.floor(exact).astype(int)
+    rest = total - counts.sum()
+    if rest > 0:
+        counts[np.argsort(counts - exact, kind='stable')[:rest]] += 1
+    return counts
+
+
+class BalancedSampler(torch.utils.data.Sampler):
+    """
+    Class-balanced sampler, draws a fresh balanced subset of the dataset at every epoch.
+    The dataset itself is left untouched, only indices are resampled.
+    """
+
+    def __init__(self, labels, ratio=1.0, strata=None, seed=0):
+        """
+        :params: labels: binary label of every sample in the dataset
+                ratio: ratio of balanced instances (1/0)
+                strata: optional group of every sample (e.g. video number), each class is drawn
+                        proportionally to the size of its groups
+                seed: random seed, the draw of epoch e uses seed + e
+        """
+        assert ratio > 0, "balancing ratio should be positive"
+        labels = np.asarray(labels).astype(int)
+        self.ratio = ratio
+        self.seed = seed
+        self.epoch = 0
+        # precomputed label index: class -> list of index arrays, one per stratum
+        if strata is None:
+            strata = np.zeros(len(labels), dtype=int)
+        else:
+            _, strata = np.unique(np.asarray(strata), return_inverse=True)
+        self.index = {}
+        for c in [0, 1]:
+            ids = np.flatnonzero(labels == c)
+            order = np.argsort(strata[ids], kind='stable')
+            ids = ids[order]
+            _, starts = np.unique(strata[ids], return_index=True)
+            self.index[c] = np.split(ids, starts[1:]) if ids.size > 0 else []
+        n_pos = int((labels == 1).sum())
+        n_neg = int((labels == 0).sum())
+        # largest subset with n_pos / n_neg == ratio
+        n_neg_kept = min(n_neg, int(n_pos / ratio))
+        n_pos_kept = min(n_pos, int(round(ratio * n_neg_kept)))
+        self.n_kept = {0: n_neg_kept, 1: n_pos_kept}
+
+    @classmethod
+    def from_samples(cls, samples, ratio=1.0, strata_key=None, seed=0):
+        """
+        Build the sampler from a list of intention samples (dicts with a 'label' key)
+        """
+        labels = [s['label'] for s in samples]
+        strata = None if strata_key is None else [s[strata_key] for s in samples]
+        return cls(labels, ratio=ratio, strata=strata, seed=seed)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        kept = []
+        for c in [0, 1]:
+            groups = self.index[c]
+            counts = split_counts(self.n_kept[c], [len(g) for g in groups])
+            for g, k in zip(groups, counts):
+                kept.append(rng.choice(g, size=k, replace=False))
+        kept = np.concatenate(kept) if kept else np.empty(0, dtype=int)
+        rng.shuffle(kept)
+        return iter(kept.tolist())
+
+    def __len__(self):
+        return self.n_kept[0] + self.n_kept[1]
+
+
+class LocalityBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler that keeps the frames read by one batch close together on disk.
+    Samples are grouped by video and ordered by their first frame, cut into chunks of
+    `window` neighbouring samples, and only the order of chunks (and the order inside
+    a chunk) is shuffled. A batch is then made of a few chunks, i.e. a few videos.
+    """
+
+    def __init__(self, videos, frames, batch_size, window=8, sampler=None, drop_last=True,
+                 cache_frames=2048, seed=0):
+        """
+        :params: videos: video number of every sample in the dataset
+                frames: frame numbers of every sample in the dataset
+                batch_size: number of samples in a batch
+                window: number of neighbouring samples kept together (locality window)
+                sampler: optional sampler choosing the indices of an epoch, e.g. BalancedSampler,
+                        all indices are used if None
+                drop_last: drop the last incomplete batch
+                cache_frames: number of frames of the simulated page cache of cache_hit_rate()
+                seed: random seed, the order of epoch e uses seed + e
+        """
+        assert window > 0, "locality window should be positive"
+        self.videos = list(videos)
+        self.frames = [list(f) for f in frames]
+        self.start = np.array([f[0] if len(f) > 0 else 0 for f in self.frames])
+        self.batch_size = batch_size
+        self.window = window
+        self.sampler = sampler
+        self.drop_last = drop_last
+        self.cache_frames = cache_frames
+        self.seed = seed
+        self.epoch = 0
+        _, self.video_ids = np.unique(np.asarray(self.videos), return_inverse=True)
+
+    @classmethod
+    def from_samples(cls, samples, batch_size, **kwargs):
+        """
+        Build the batch sampler from a list of intention samples (dicts with 'video_number' and 'frames')
+        """
+        videos = [s['video_number'] for s in samples]
+        frames = [s['frames'] for s in samples]
+        return cls(videos, frames, batch_size, **kwargs)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        if self.sampler is not None and hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def epoch_order(self, rng):
+        if self.sampler is not None:
+            ids = np.fromiter(iter(self.sampler), dtype=int)
+        else:
+            ids = np.arange(len(self.videos))
+        # group by video, then by time inside the video
+        ids = ids[np.lexsort((self.start[ids], self.video_ids[ids]))]
+        video_change = np.flatnonzero(np.diff(self.video_ids[ids]) != 0) + 1
+        chunks = []
+        for video in np.split(ids, video_change):
+            if video.size == 0:
+                continue
+            # random offset so that chunk borders change between epochs
+            offset = rng.integers(0, min(self.window, video.size))
+            borders = np.arange(offset if offset > 0 else self.window, video.size, self.window)
+            for chunk in np.split(video, borders):
+                if chunk.size > 0:
+                    rng.shuffle(chunk)
+                    chunks.append(chunk)
+        order = rng.permutation(len(chunks))
+        return np.concatenate([chunks[i] for i in order]) if chunks else np.empty(0, dtype=int)
+
+    def estimate_hit_rate(self, ids):
+        """
+        Fraction of frame reads served by a LRU cache of `cache_frames` frames for this order
+        """
+        cache = OrderedDict()
+        hits, reads = 0, 0
+        for i in ids:
+            vid = self.videos[i]
+            for f in self.frames[i]:
+                key = (vid, f)
+                reads += 1
+                if key in cache:
+                    hits += 1
+                    cache.move_to_end(key)
+                else:
+                    cache[key] = True
+                    if len(cache) > self.cache_frames:
+                        cache.popitem(last=False)
+        return hits / reads if reads > 0 else 0.0
+
+    def cache_hit_rate(self, epoch=0):
+        """
+        Estimated cache hit rate of the order of an epoch, the epoch counters are left untouched.
+        A pure python simulation over every frame read: call it once from a script, not every epoch
+        """
+        sampler_epoch = getattr(self.sampler, 'epoch', None)
+        if sampler_epoch is not None:
+            self.sampler.set_epoch(epoch)
+        ids = self.epoch_order(np.random.default_rng(self.seed + epoch)).tolist()
+        if sampler_epoch is not None:
+            self.sampler.set_epoch(sampler_epoch)
+        return self.estimate_hit_rate(ids)
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        ids = self.epoch_order(rng).tolist()
+        for k in range(0, len(ids), self.batch_size):
+            batch = ids[k:k + self.batch_size]
+            if len(batch) < self.batch_size and self.drop_last:
+                break
+            yield batch
+
+    def __len__(self):
+        n = len(self.sampler) if self.sampler is not None else len(self.videos)
+        if self.drop_last:
+            return n // self.batch_size
+        return (n + self.batch_size - 1) // self.batch_size
+
+
+class ResumableBatchSampler(torch.utils.data.Sampler):
+    """
+    Batch sampler of the training loaders: forwards set_epoch to the wrapped (batch) sampler and can
+    start an epoch after its first batches (resume of a mid-epoch snapshot), the indices of the skipped
+    batches are drawn, so the rest of the epoch is unchanged, but their samples are not loaded.
+    """
+
+    def __init__(self, batch_sampler):
+        self.batch_sampler = batch_sampler
+        self.batch_size = batch_sampler.batch_size
+        self.skip = 0
+
+    def set_epoch(self, epoch):
+        # LocalityBatchSampler, or the BalancedSampler of a BatchSampler
+        for sampler in [self.batch_sampler, getattr(self.batch_sampler, 'sampler', None)]:
+            if hasattr(sampler, 'set_epoch'):
+                sampler.set_epoch(epoch)
+                return
+
+    def skip_batches(self, n_batches):
+        # only applies to the next epoch
+        self.skip = n_batches
+
+    def __iter__(self):
+        skip, self.skip = self.skip, 0
+        for k, batch in enumerate(self.batch_sampler):
+            if k >= skip:
+                yield batch
+
+    def __len__(self):
+        return len(self.batch_sampler)
@@ -41,55 +41,102 @@ def get_pedb_ids_jaad(annotations, vid):
     return pedb_ids
 
 
-def get_pedb_info_jaad(annotations, vid):
+# per-frame annotations of one pedestrian track
+TRACK_DTYPE = np.dtype([('frames', np.int64), ('bbox', np.float64, (4,)), ('occlusion', np.int64),
+                        ('action', np.int64), ('cross', np.int64), ('look', np.int64), ('nod', np.int64),
+                        ('hand_gesture', np.int64), ('traffic_light', np.int64)])
+
+
+def get_pedb_track_jaad(annotations, vid, idx) -> np.ndarray:
+    """
+    Get all annotated frames of one pedestrian as a structured array.
+    :param: annotations: JAAD annotations in dictionary form
+            vid : single video id (str)
+            idx : pedestrian id (str)
+    :return: structured array of dtype TRACK_DTYPE, one record per frame
+    """
+    ped = annotations[vid]['ped_annotations'][idx]
+    traffic = annotations[vid]['traffic_annotations']
+    frames = ped['frames']
+    track = np.zeros(len(frames), dtype=TRACK_DTYPE)
+    if len(frames) == 0:
+        return track
+    track['frames'] = frames
+    track['bbox'] = ped['bbox']
+    track['occlusion'] = ped['occlusion']
+    for key in ['action', 'cross', 'look', 'nod', 'hand_gesture']:
+        track[key] = ped['behavior'][key]
+    track['traffic_light'] = [traffic[f]['traffic_light'] for f in frames]
+
+    return track
+
+
+def get_track_mask(track, max_occlusion=1, min_height=None) -> np.ndarray:
+    """
+    Boolean mask of the frames kept in a pedestrian track.
+    :param: track: structured array from get_pedb_track_jaad
+            max_occlusion: highest occlusion tag kept (0: none, 1: partial, 2: full), None keeps all
+            min_height: minimum bbox height in pixels, None keeps all
+    :return: boolean mask, True for the frames to keep
+    """
+    # sanity check if behavior label exists
+    mask = (track['action'] == 0) | (track['action'] == 1)
+    if max_occlusion is not None:
+        mask &= track['occlusion'] <= max_occlusion
+    if min_height is not None:
+        mask &= (track['bbox'][:, 3] - track['bbox'][:, 1]) >= min_height
+
+    return mask
+
+
+def get_pedb_tracks_jaad(annotations, vid, max_occlusion=None, min_height=None) -> dict:
+    """
+    Get the filtered tracks of all pedestrians(with behavior tags) in one video.
+    The fields of every returned track (e.g. track['bbox']) are views of one array.
+    :param: annotations: JAAD annotations in dictionary form
+            vid : single video id (str)
+            max_occlusion, min_height: frame filters, see get_track_mask
+    :return: dictionary of pedestrian id -> structured array of kept frames
+    """
+    tracks = {}
+    for idx in get_pedb_ids_jaad(annotations, vid):
+        track = get_pedb_track_jaad(annotations, vid, idx)
+        tracks[idx] = track[get_track_mask(track, max_occlusion, min_height)]
+
+    return tracks
+
+
+def get_behavior_vectors(track, use_action=True) -> list:
+    """
+    Atomic behavior label [action, look, nod, hand_gesture] for every frame of a track
+    """
+    beh = np.zeros((track.size, 4), dtype=np.int64)
+    if use_action:
+        beh[:, 0] = track['action']
+    beh[:, 1] = track['look']
+    beh[:, 2] = track['nod']
+    beh[:, 3] = track['hand_gesture'] > 0
+
+    return beh.tolist()
+
+
+def get_pedb_info_jaad(annotations, vid, max_occlusion=None, min_height=None):
     """
     Get pedb information,i.e. frames,bbox,occlusion, actions(walking or not),cross behavior.
     :param: annotations: JAAD annotations in dictionary form
             vid : single video id (str)
+            max_occlusion, min_height: optional frame filters, see get_track_mask
     :return: information of all pedestrians in one video
     """
-    ids = get_pedb_ids_jaad(annotations, vid)
+    tracks = get_pedb_tracks_jaad(annotations, vid, max_occlusion, min_height)
     dataset = annotations
     pedb_info = {}
-    for idx in ids:
+    for idx, track in tracks.items():
         pedb_info[idx] = {}
-        pedb_info[idx]['frames'] = []
-        pedb_info[idx]['bbox'] = []
-        pedb_info[idx]['occlusion'] = []
-        pedb_info[idx]['action'] = []
-        pedb_info[idx]['cross'] = []
+        for key in ['frames', 'bbox', 'occlusion', 'action', 'cross', 'traffic_light']:
+            pedb_info[idx][key] = track[key].tolist()
         # process atomic behavior label
-        pedb_info[idx]['behavior'] = []
-        pedb_info[idx]['traffic_light'] = []
-        frames = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['frames'])
-        bbox = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['bbox'])
-        occlusion = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['occlusion'])
-
-        # behavioural data
-        action = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['behavior']['action'])
-        cross = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['behavior']['cross'])
-        nod = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['behavior']['nod'])
-        look = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['behavior']['look'])
-        hand_gesture = copy.deepcopy(dataset[vid]['ped_annotations'][idx]['behavior']['hand_gesture'])
-
-
-        for i in range(len(frames)):
-            if action[i] in [0, 1]:  # sanity check if behavior label exists
-                pedb_info[idx]['action'].append(action[i])
-                pedb_info[idx]['frames'].append(frames[i])
-                pedb_info[idx]['bbox'].append(bbox[i])
-                pedb_info[idx]['occlusion'].append(occlusion[i])
-                pedb_info[idx]['cross'].append(cross[i])
-                beh_vec = [0, 0, 0, 0]
-                beh_vec[0] = action[i]
-                beh_vec[1] = look[i]
-                beh_vec[2] = nod[i]
-                hg = hand_gesture[i]
-                if hg > 0:
-                    beh_vec[3] = 1
-                pedb_info[idx]['behavior'].append(beh_vec)
-                # traffic light
-                pedb_info[idx]['traffic_light'].append(dataset[vid]['traffic_annotations'][frames[i]]['traffic_light'])
+        pedb_info[idx]['behavior'] = get_behavior_vectors(track)
 
         # attribute vector
         # scene description
@@ -101,53 +148,77 @@ def get_pedb_info_jaad(annotations, vid):
             atr_vec[3] = 1
         atr_vec[4] = dataset[vid]['ped_annotations'][idx]['attributes']['traffic_direction']
         atr_vec[5] = dataset[vid]['ped_annotations'][idx]['attributes']['motion_direction']
-        pedb_info[idx]['attributes'] = copy.deepcopy(atr_vec)
+        pedb_info[idx]['attributes'] = atr_vec
 
     return pedb_info
 
 
-def filter_None(x):
-    # Small help function to filter None in list
-    if x is None:
-        return False
-    else:
-        return True
-
-
-def pedb_info_clean_jaad(annotations, vid) -> dict:
+def pedb_info_clean_jaad(annotations, vid, min_height=None) -> dict:
     """
      Remove all frames has occlusion tag = 2 (fully occluded)
          Get pedb information,i.e. frames,bbox,occlusion, actions(walking or not),cross behavior.
     :param: annotations: JAAD annotations in dictionary form
             vid : single video id (str)
+            min_height: optional minimum bbox height of kept frames
     :return: cleaned information of all pedestrians in one video
     """
-    pedb_info = get_pedb_info_jaad(annotations, vid)
-    pids = list(pedb_info.keys())
-    # remove all frames with occlusion tag=2
-    for idx in pids:
-        occ = np.array(pedb_info[idx]['occlusion'])
-        full_occ = np.flatnonzero(occ == 2)
-        # set fully occluded frames to None
-        for i in range(len(full_occ)):
-            pedb_info[idx]['frames'][full_occ[i]] = None
-            pedb_info[idx]['bbox'][full_occ[i]] = None
-            pedb_info[idx]['action'][full_occ[i]] = None
-            pedb_info[idx]['occlusion'][full_occ[i]] = None
-            pedb_info[idx]['cross'][full_occ[i]] = None
-            pedb_info[idx]['behavior'][full_occ[i]] = None
-            pedb_info[idx]['traffic_light'][full_occ[i]] = None
-
-        # filter all None values
-        pedb_info[idx]['frames'] = list(filter(filter_None, pedb_info[idx]['frames']))
-        pedb_info[idx]['bbox'] = list(filter(filter_None, pedb_info[idx]['bbox']))
-        pedb_info[idx]['action'] = list(filter(filter_None, pedb_info[idx]['action']))
-        pedb_info[idx]['occlusion'] = list(filter(filter_None, pedb_info[idx]['occlusion']))
-        pedb_info[idx]['cross'] = list(filter(filter_None, pedb_info[idx]['cross']))
-        pedb_info[idx]['behavior'] = list(filter(filter_None, pedb_info[idx]['behavior']))
-        pedb_info[idx]['traffic_light'] = list(filter(filter_None, pedb_info[idx]['traffic_light']))
+    return get_pedb_info_jaad(annotations, vid, max_occlusion=1, min_height=min_height)
 
-    return pedb_info
+
+def get_trans_indices(action, mode="GO", window=5) -> np.ndarray:
+    """
+    Get indices of frames where a STOP/GO transition happens in one track.
+    A frame i is kept if the action changes at i and the state is stable
+    within `window` frames before and after it.
+    :param: action: per-frame actions of one pedestrian (0: standing, 1: walking)
+            mode: target transition type, "GO" or "STOP"
+            window: number of frames checked on both sides of the transition
+    :return: sorted array of transition frame indices
+    """
+    assert mode in ["GO", "STOP"], "Transition type should be STOP or GO"
+    a = np.asarray(action)
+    n = a.size
+    if n < 2:
+        return np.empty(0, dtype=int)
+    state = 1 if mode == "GO" else 0
+    idx = np.flatnonzero(np.diff(a) == (1 if mode == "GO" else -1)) + 1
+    before = idx - np.minimum(idx, window)
+    after = idx + np.minimum(n - idx - 1, window)
+    keep = (a[before] == 1 - state) & (a[after] == state)
+
+    return idx[keep]
+
+
+def get_state_distances(action, idx, step, state):
+    """
+    Distances (in sparsified frames) from transition frames to the neighbouring state changes.
+    :param: action: per-frame actions of one pedestrian
+            idx: transition frame indices, with action[idx] == state
+            step: sparsification step, 30 // fps
+            state: action state at the transition frames
+    :return: d_pre: number of sparsified frames back to the previous frame in `state`, minus one
+             d_pos: number of sparsified frames forward to the first frame leaving `state`
+    """
+    a = np.asarray(action)
+    idx = np.asarray(idx, dtype=int)
+    d_pre = np.zeros(idx.size, dtype=int)
+    d_pos = np.zeros(idx.size, dtype=int)
+    for r in np.unique(idx % step):
+        sel = np.flatnonzero(idx % step == r)
+        sub = a[r::step]
+        s = idx[sel] // step
+        same = np.flatnonzero(sub == state)
+        other = np.flatnonzero(sub != state)
+        # previous frame (strictly before s) in the same state
+        k = np.searchsorted(same, s, side='left') - 1
+        prev = same[np.maximum(k, 0)] if same.size > 0 else s
+        d_pre[sel] = np.where(k >= 0, s - prev - 1, s)
+        # next frame (from s on) in the other state
+        k = np.searchsorted(other, s, side='left')
+        nxt = other[np.minimum(k, other.size - 1)] if other.size > 0 else s
+        d_pos[sel] = np.where(k < other.size, nxt - s, sub.size - s)
+
+    return d_pre, d_pos
 
 
 def add_trans_label_jaad(dataset, verbose=False) -> None:
@@ -158,33 +229,21 @@ def add_trans_label_jaad(dataset, verbose=False) -> None:
     all_stw = 0  # standing to walking (Go)
     pids = list(dataset.keys())
     for idx in pids:
-        action = dataset[idx]['action']
-        frames = dataset[idx]['frames']
-        n_frames = len(frames)
-        dataset[idx]['next_transition'] = []
-        stw_time = []
-        wts_time = []
-
-        for j in range(len(action) - 1):
-            # stop and go transition
-            if action[j] == 0 and action[j + 1] == 1:
-                all_stw += 1
-                stw_time.append(frames[j + 1])
-            elif action[j] == 1 and action[j + 1] == 0:
-                all_wts += 1
-                wts_time.append(frames[j + 1])
-
-        # merge
-        trans_time = np.array(sorted(stw_time + wts_time))
-        # set transition tag
-        for i in range(n_frames):
-            t_frame = frames[i]
-            future_trans = trans_time[trans_time >= t_frame]
-            if future_trans.size > 0:
-                next_trans = future_trans[0]
-                dataset[idx]['next_transition'].append(next_trans - t_frame)
-            else:
-                dataset[idx]['next_transition'].append(None)
+        action = np.asarray(dataset[idx]['action'])
+        frames = np.asarray(dataset[idx]['frames'])
+        # stop and go transition
+        change = np.diff(action)
+        all_stw += int(np.count_nonzero(change == 1))
+        all_wts += int(np.count_nonzero(change == -1))
+        trans_time = np.sort(frames[1:][change != 0])
+        # set transition tag: distance to the first transition at or after every frame
+        if trans_time.size == 0:
+            dataset[idx]['next_transition'] = [None] * frames.size
+            continue
+        pos = np.searchsorted(trans_time, frames, side='left')
+        next_trans = trans_time[np.minimum(pos, trans_time.size - 1)] - frames
+        dataset[idx]['next_transition'] = [int(d) if p < trans_time.size else None
+                                           for d, p in zip(next_trans, pos)]
 
     if verbose:
         print('----------------------------------------------------------------')
@@ -195,7 +254,8 @@ def add_trans_label_jaad(dataset, verbose=False) -> None:
     return None
 
 
-def build_pedb_dataset_jaad(jaad_anns_path, split_vids_path, image_set="all", subset='default', verbose=False) -> dict:
+def build_pedb_dataset_jaad(jaad_anns_path, split_vids_path, image_set="all", subset='default', verbose=False,
+                            min_height=None) -> dict:
     """
     Build pedestrian dataset from jaad annotations
     """
@@ -203,7 +263,7 @@ def build_pedb_dataset_jaad(jaad_anns_path, split_vids_path, image_set="all", su
     pedb_dataset = {}
     vids = get_split_vids(split_vids_path, image_set, subset)
     for vid in vids:
-        pedb_info = pedb_info_clean_jaad(jaad_anns, vid)
+        pedb_info = pedb_info_clean_jaad(jaad_anns, vid, min_height=min_height)
         pids = list(pedb_info.keys())
         for idx in pids:
             if len(pedb_info[idx]['action']) > 0:
@@ -245,43 +305,30 @@ class JaadTransDataset:
         j = 0
         step = 30 // fps
         t_ahead = step * frame_ahead
+        prefix = "JG_" if mode == "GO" else "JS_"
         for idx in ids:
-            vid_id = copy.deepcopy(dataset[idx]['video_number'])
-            frames = copy.deepcopy(dataset[idx]['frames'])
-            bbox = copy.deepcopy(dataset[idx]['bbox'])
-            action = copy.deepcopy(dataset[idx]['action'])
-            cross = copy.deepcopy(dataset[idx]['cross'])
-            behavior = copy.deepcopy(dataset[idx]['behavior'])
-            traffic_light = copy.deepcopy(dataset[idx]['traffic_light'])
-            attributes = copy.deepcopy(dataset[idx]['attributes'])
-            next_transition = copy.deepcopy(dataset[idx]["next_transition"])
-            for i in range(len(frames)):
-                key = None
-                old_id = None
-                d1 = min(i, 5)
-                d2 = min(len(frames) - i - 1, 5)
-                if mode == "GO":
-                    if next_transition[i] == 0 and action[i] == 1 and action[i - d1] == 0 and action[i + d2] == 1:
-                        j += 1
-                        new_id = "{:04d}".format(j) + "_" + self.name
-                        key = "JG_" + new_id
-                        old_id = f'{idx}/{vid_id}/' + '{:03d}'.format(frames[i])
-                if mode == "STOP":
-                    if next_transition[i] == 0 and action[i] == 0 and action[i - d1] == 1 and action[i + d2] == 0:
-                        j += 1
-                        new_id = "{:04d}".format(j) + "_" + self.name
-                        key = "JS_" + new_id
-                        old_id = f'{idx}/{vid_id}/' + '{:03d}'.format(frames[i])
-                if key is not None and i - t_ahead * step >= 0:
+            vid_id = dataset[idx]['video_number']
+            frames = dataset[idx]['frames']
+            bbox = dataset[idx]['bbox']
+            action = dataset[idx]['action']
+            cross = dataset[idx]['cross']
+            behavior = dataset[idx]['behavior']
+            traffic_light = dataset[idx]['traffic_light']
+            attributes = dataset[idx]['attributes']
+            for i in get_trans_indices(action, mode).tolist():
+                j += 1
+                key = prefix + "{:04d}".format(j) + "_" + self.name
+                old_id = f'{idx}/{vid_id}/' + '{:03d}'.format(frames[i])
+                if i - t_ahead * step >= 0:
                     samples[key] = {}
                     samples[key]["source"] = "JAAD"
                     samples[key]["old_id"] = old_id
                     samples[key]['video_number'] = vid_id
                     samples[key]['frame'] = frames[i - t_ahead]
-                    samples[key]['bbox'] = bbox[i - t_ahead]
+                    samples[key]['bbox'] = copy.copy(bbox[i - t_ahead])
                     samples[key]['action'] = action[i - t_ahead]
                     samples[key]['cross'] = cross[i - t_ahead]
-                    samples[key]['behavior'] = behavior[i - t_ahead]
+                    samples[key]['behavior'] = copy.copy(behavior[i - t_ahead])
                     samples[key]['traffic_light'] = traffic_light[i - t_ahead]
                     samples[key]['attributes'] = attributes
                     samples[key]['frame_ahead'] = frame_ahead
@@ -306,82 +353,44 @@ class JaadTransDataset:
         j = 0
         step = 30 // fps
         assert isinstance(step, int)
+        prefix = "JG_" if mode == "GO" else "JS_"
+        state = 1 if mode == "GO" else 0
         for idx in ids:
-            vid_id = copy.deepcopy(dataset[idx]['video_number'])
-            frames = copy.deepcopy(dataset[idx]['frames'])
-            bbox = copy.deepcopy(dataset[idx]['bbox'])
-            action = copy.deepcopy(dataset[idx]['action'])
-            cross = copy.deepcopy(dataset[idx]['cross'])
-            behavior = copy.deepcopy(dataset[idx]['behavior'])
-            traffic_light = copy.deepcopy(dataset[idx]['traffic_light'])
-            attributes = copy.deepcopy(dataset[idx]['attributes'])
-            next_transition = copy.deepcopy(dataset[idx]["next_transition"])
-            for i in range(len(frames)):
-                key = None
-                old_id = None
-                d1 = min(i, 5)
-                d2 = min(len(frames) - i - 1, 5)
-                # use all data, don't care go or stop
-                if mode == "GO":
-                    if next_transition[i] == 0 and action[i] == 1 and action[i - d1] == 0 and action[i + d2] == 1:
-                        j += 1
-                        new_id = "{:04d}".format(j) + "_" + self.name
-                        key = "JG_" + new_id
-                        old_id = idx
-                        ae = np.array(action[i::-step]) # reversed actions up to the current frame
-                        ce = np.array(np.nonzero(ae == 1)) # is walking
-                        # distance to the previous frame (sparsified) when the pedestrian starts walking
-                        d_pre = ce[0][1] - 1 if ce.size > 1 else len(ae) - 1 #
-                        ap = np.array(action[i::step])
-                        cp = np.array(np.nonzero(ap == 0))
-                        # distance to the next frame (sparsified) when the pedestrian stops walking
-                        d_pos = cp[0][0] if cp.size > 0 else len(ap)
-                if mode == "STOP":
-                    if next_transition[i] == 0 and action[i] == 0 and action[i - d1] == 1 and action[i + d2] == 0:
-                        j += 1
-                        new_id = "{:04d}".format(j) + "_" + self.name
-                        key = "JS_" + new_id
-                        old_id = idx
-                        ae = np.array(action[i::-step])
-                        ce = np.array(np.nonzero(ae == 0))
-                        d_pre = ce[0][1] - 1 if ce.size > 1 else len(ae) - 1
-                        ap = np.array(action[i::step])
-                        cp = np.array(np.nonzero(ap == 1))
-                        d_pos = cp[0][0] if cp.size > 0 else len(ap)
-                if key is not None:
-                    if max_frames is None:
-                        t = None
-                    else:
-                        t = i - max_frames * step if (i - max_frames * step >= 0) else None
-                    i = i + min(post_frames, d_pos) * step
-                    samples[key] = {}
-                    samples[key]["source"] = "JAAD"
-                    samples[key]["old_id"] = old_id
-                    samples[key]['video_number'] = vid_id
-                    # take every step-th frame from 0 to i
-                    samples[key]['frame'] = frames[i:t:-step]
-                    samples[key]['frame'].reverse()
-
-                    samples[key]['bbox'] = bbox[i:t:-step]
-                    samples[key]['bbox'].reverse()
-
-                    samples[key]['action'] = action[i:t:-step]
-                    samples[key]['action'].reverse()
-
-                    samples[key]['cross'] = cross[i:t:-step]
-                    samples[key]['cross'].reverse()
-
-                    samples[key]['behavior'] = behavior[i:t:-step]
-                    samples[key]['behavior'].reverse()
-
-                    samples[key]['traffic_light'] = traffic_light[i:t:-step]
-                    samples[key]['traffic_light'].reverse()
-
-                    samples[key]['attributes'] = attributes
-                    samples[key]['pre_state'] = d_pre
-                    samples[key]['post_state'] = d_pos
-                    samples[key]['type'] = mode
-                    samples[key]['fps'] = fps
+            vid_id = dataset[idx]['video_number']
+            frames = dataset[idx]['frames']
+            bbox = dataset[idx]['bbox']
+            action = dataset[idx]['action']
+            cross = dataset[idx]['cross']
+            behavior = dataset[idx]['behavior']
+            traffic_light = dataset[idx]['traffic_light']
+            attributes = dataset[idx]['attributes']
+            trans_idx = get_trans_indices(action, mode)
+            # distances (sparsified) to the previous/next change of state around every transition
+            d_pres, d_poss = get_state_distances(action, trans_idx, step, state)
+            for i, d_pre, d_pos in zip(trans_idx.tolist(), d_pres.tolist(), d_poss.tolist()):
+                j += 1
+                key = prefix + "{:04d}".format(j) + "_" + self.name
+                if max_frames is None:
+                    t = None
+                else:
+                    t = i - max_frames * step if (i - max_frames * step >= 0) else None
+                i = i + min(post_frames, d_pos) * step
+                samples[key] = {}
+                samples[key]["source"] = "JAAD"
+                samples[key]["old_id"] = idx
+                samples[key]['video_number'] = vid_id
+                # take every step-th frame from 0 to i
+                samples[key]['frame'] = frames[i:t:-step][::-1]
+                samples[key]['bbox'] = [copy.copy(b) for b in bbox[i:t:-step][::-1]]
+                samples[key]['action'] = action[i:t:-step][::-1]
+                samples[key]['cross'] = cross[i:t:-step][::-1]
+                samples[key]['behavior'] = [copy.copy(b) for b in behavior[i:t:-step][::-1]]
+                samples[key]['traffic_light'] = traffic_light[i:t:-step][::-1]
+                samples[key]['attributes'] = attributes
+                samples[key]['pre_state'] = d_pre
+                samples[key]['post_state'] = d_pos
+                samples[key]['type'] = mode
+                samples[key]['fps'] = fps
         if verbose:
             keys = list(samples.keys())
             pids = []
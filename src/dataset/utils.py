@@ -1,5 +1,59 @@
-from src.dataset.loader import define_path
-from torch.utils.data import DataLoader
+import functools
+import torch
+from src.dataset.loader import define_path, IntentionSequenceDataset
+from src.dataset.intention.jaad_dataset import build_pedb_dataset_jaad, cached_pedb_dataset_jaad, balance
+from src.dataset.sampler import BalancedSampler, LocalityBatchSampler, ResumableBatchSampler
+from src.transform.preprocess import ImageTransform, CropBoxWithBackgroud, Compose
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
+
+MEAN = [0.3104, 0.2813, 0.2973]
+STD = [0.1761, 0.1722, 0.1673]
+
+
+def crop_transform(train=False):
+    """
+    Crop of the pedestrian with its background, color jitter on the training set, normalization
+    """
+    import torchvision
+    jitter = [torchvision.transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.1)] if train else []
+    return Compose([
+                    CropBoxWithBackgroud(size=224),
+                    ImageTransform(
+                        torchvision.transforms.Compose(jitter + [
+                            torchvision.transforms.ToTensor(),
+                            torchvision.transforms.Normalize(MEAN, STD),
+                        ]),
+                    ),
+                   ])
+
+
+def prepare_intention_data(anns_paths, image_dir, args, image_set, load_image=True, max_frames=None):
+    """
+    Intention dataset of one split for the train_*.py scripts: the training set is balanced once
+    (or every epoch by the sampler with --epoch-balancing), the val set is balanced, the test set is kept as is
+    :params: max_frames: length of the windows, args.max_frames by default
+    """
+    build = build_pedb_dataset_jaad
+    if getattr(args, 'anns_cache_dir', ''):
+        build = functools.partial(cached_pedb_dataset_jaad, args.anns_cache_dir)
+    intent_sequences = build(
+        anns_paths["JAAD"]["anns"], 
+        anns_paths["JAAD"]["split"], 
+        image_set=image_set, 
+        fps=args.fps, 
+        prediction_frames=args.pred,
+        max_frames=max_frames or args.max_frames, 
+        verbose=True)
+    if image_set == "train" and not getattr(args, 'epoch_balancing', False):
+        intent_sequences = balance(intent_sequences, seed=args.seed, ratio=args.balancing_ratio)
+    elif image_set == "val":
+        intent_sequences = balance(intent_sequences, seed=args.seed)
+
+    transform = crop_transform(train=image_set == 'train') if load_image else None
+    ds = IntentionSequenceDataset(intent_sequences, image_dir=image_dir, hflip_p = 0.5, preprocess=transform, load_image=load_image,
+                                  io_threads=getattr(args, 'io_threads', 0), read_ahead=getattr(args, 'read_ahead', 0),
+                                  shared_index=getattr(args, 'shared_index', False))
+    return ds
 
 def build_dataloaders(args, prepare_data, **kwargs):
     print('Start annotation loading -->', 'JAAD:')
@@ -11,7 +65,26 @@ def build_dataloaders(args, prepare_data, **kwargs):
     val_ds = prepare_data(anns_paths, image_dir, args, "val", **kwargs)
     test_ds = prepare_data(anns_paths, image_dir, args, "test", **kwargs)
 
-    train_loader = DataLoader(train_ds, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, pin_memory=True, drop_last=True)
+    # the order of epoch e only depends on seed + e (see Trainer.set_loader_epoch), so that resumed runs replay it
+    generator = torch.Generator()
+    generator.manual_seed(args.seed)
+    train_sampler = None
+    if getattr(args, 'epoch_balancing', False):
+        # fresh class-balanced draw of the full training set at every epoch
+        strata_key = None if args.balance_strata == 'none' else args.balance_strata
+        train_sampler = BalancedSampler.from_samples(train_ds.samples, ratio=args.balancing_ratio,
+                                                     strata_key=strata_key, seed=args.seed)
+    if getattr(args, 'locality_window', 0) > 0:
+        # batches made of neighbouring samples from a few videos, friendlier to the page cache
+        batch_sampler = LocalityBatchSampler.from_samples(train_ds.samples, args.batch_size, window=args.locality_window,
+                                                          sampler=train_sampler, drop_last=True, seed=args.seed)
+        if getattr(args, 'report_cache_hits', False):
+            print(f'Locality sampler: estimated frame cache hit rate {batch_sampler.cache_hit_rate():.3f}')
+    else:
+        sampler = train_sampler if train_sampler is not None else RandomSampler(train_ds, generator=generator)
+        batch_sampler = BatchSampler(sampler, args.batch_size, drop_last=True)
+    train_loader = DataLoader(train_ds, batch_sampler=ResumableBatchSampler(batch_sampler), generator=generator,
+                              num_workers=args.num_workers, pin_memory=True)
     val_loader = DataLoader(val_ds, batch_size=1, shuffle=False, num_workers=args.num_workers, pin_memory=True)
     test_loader = DataLoader(test_ds, batch_size=1, shuffle=False, num_workers=args.num_workers, pin_memory=True)
 
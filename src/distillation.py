@@ -0,0 +1,71 @@
+import os
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from src.checkpoint import atomic_save
+
+EPS = 1e-6
+
+
+def to_logit(probs):
+    # the models end with a sigmoid, distillation works on the logits
+    return torch.logit(probs.float(), eps=EPS)
+
+
+@torch.no_grad()
+def compute_teacher_logits(teacher_fn, loader, device):
+    """
+    Run the teacher once over a loader
+    :params: teacher_fn: function (batch, device) -> crossing probabilities (B,)
+            loader: loader of intention samples, its batches carry the sample 'id'
+    :return: dict sample id -> teacher logit
+    """
+    logits = {}
+    for inputs in tqdm(loader):
+        probs = teacher_fn(inputs, device).view(-1)
+        for sample_id, logit in zip(inputs['id'], to_logit(probs).cpu()):
+            logits[sample_id] = logit
+    return logits
+
+
+def load_teacher_cache(cache_path, build_teacher, loader, device, meta):
+    """
+    Teacher logits cached on disk, computed only when the cache is missing or was built
+    with another teacher / data setting
+    :params: build_teacher: function returning the teacher_fn of compute_teacher_logits,
+                    only called (teacher loaded) when the cache has to be computed
+            meta: dict describing the teacher and the samples (checkpoint, pred, max_frames, ...)
+    """
+    if os.path.exists(cache_path):
+        cache = torch.load(cache_path)
+        if cache['meta'] == meta:
+            print(f'Loaded {len(cache["logits"])} teacher outputs from {cache_path}')
+            return cache['logits']
+        print(f'Teacher cache {cache_path} was built with another setting, recomputing it')
+    print('Computing teacher outputs')
+    logits = compute_teacher_logits(build_teacher(), loader, device)
+    # concurrent runs (e.g. search trials) may compute the same cache, readers never see a partial file
+    atomic_save({'meta': meta, 'logits': logits}, cache_path)
+    print(f'Saved {len(logits)} teacher outputs to {cache_path}')
+    return logits
+
+
+def lookup_teacher(logits, sample_ids, device):
+    missing = [i for i in sample_ids if i not in logits]
+    assert not missing, f'no teacher output for samples {missing[:5]}, delete the teacher cache to rebuild it'
+    return torch.stack([logits[i] for i in sample_ids]).to(device).view(-1, 1)
+
+
+def distillation_loss(student_probs, targets, teacher_logits, alpha=0.5, temperature=2.0):
+    """
+    alpha * BCE(student, labels) + (1 - alpha) * T^2 * BCE(student / T, teacher / T)
+    :params: student_probs: sigmoid outputs of the student (B, 1)
+            targets: hard labels (B, 1)
+            teacher_logits: cached teacher logits (B, 1)
+    :return: total, hard and soft loss
+    """
+    student_logits = to_logit(student_probs)
+    hard_loss = F.binary_cross_entropy_with_logits(student_logits, targets)
+    soft_targets = torch.sigmoid(teacher_logits / temperature)
+    soft_loss = F.binary_cross_entropy_with_logits(student_logits / temperature, soft_targets) * temperature ** 2
+    return alpha * hard_loss + (1 - alpha) * soft_loss, hard_loss, soft_loss
@@ -1,11 +1,15 @@
 import torch
 import os
 import shutil
+from pathlib import Path
+from src.checkpoint import atomic_save, snapshot_to_cpu, inference_path, to_inference, load_checkpoint, \
+    module_state, checkpoint_metadata
+from src.model.pruning import apply_pruning_config
 
 #based on https://github.com/Bjarten/early-stopping-pytorch/blob/master/pytorchtools.py
 class EarlyStopping:
     """Early stops the training if validation loss doesn't improve after a given patience."""
-    def __init__(self, checkpoint, patience=7, verbose=False, delta=0, min_loss=torch.inf):
+    def __init__(self, checkpoint, patience=7, verbose=False, delta=0, min_loss=torch.inf, top_k=1, writer=None):
         """
         :param
             patience (int): How long to wait after last time validation loss improved.
@@ -14,6 +18,10 @@ class EarlyStopping:
                             Default: False
             delta (float): Minimum change in the monitored quantity to qualify as an improvement.
                             Default: 0
+            top_k (int): Number of best checkpoints kept, the best one at checkpoint and the next ones
+                            at <checkpoint>_epoch<e>.pt. Default: 1
+            writer (CheckpointWriter): Background writer of the checkpoints, saved on the calling thread if None.
+                            Default: None
         """
         self.patience = patience
         self.verbose = verbose
@@ -22,6 +30,11 @@ class EarlyStopping:
         self.early_stop = False
         self.delta = delta
         self.checkpoint = checkpoint
+        self.top_k = top_k
+        self.writer = writer
+        self.best_epoch = None
+        # paths of the previous best checkpoints, best first
+        self.kept = []
 
     def __call__(self, score, model, optimizer, epoch):
 
@@ -38,6 +51,23 @@ class EarlyStopping:
             self.best_score = score
             self.counter = 0
 
+    def state_dict(self):
+        return {'counter': self.counter, 'best_score': self.best_score, 'early_stop': self.early_stop,
+                'checkpoint': str(self.checkpoint), 'best_epoch': self.best_epoch, 'kept': list(self.kept)}
+
+    def load_state_dict(self, state):
+        self.counter = state['counter']
+        self.best_score = state['best_score']
+        self.early_stop = state['early_stop']
+        self.checkpoint = state['checkpoint']
+        self.best_epoch = state.get('best_epoch')
+        self.kept = state.get('kept', [])
+
+    def wait(self):
+        # the checkpoints are on disk
+        if self.writer is not None:
+            self.writer.wait()
+
     def save_checkpoint(self, score, model, optimizer, epoch):
         """
         Saves model when validation loss decrease.
@@ -55,15 +85,66 @@ class EarlyStopping:
             cp_dict['encoder_state_dict'] = model['encoder'].state_dict()
         if 'decoder' in model:
             cp_dict['decoder_state_dict'] = model['decoder'].state_dict()
+        if 'prune_config' in model:
+            # channels kept in the pruned encoder backbone, see src/model/pruning.py
+            cp_dict['prune_config'] = model['prune_config']
+
+        # the previous best moves to its epoch file, the oldest kept one is removed
+        previous, removed = None, []
+        if self.top_k > 1 and self.best_epoch is not None:
+            checkpoint = Path(self.checkpoint)
+            previous = checkpoint.with_name(f'{checkpoint.stem}_epoch{self.best_epoch}{checkpoint.suffix}')
+            self.kept.insert(0, str(previous))
+            removed, self.kept = self.kept[self.top_k - 1:], self.kept[:self.top_k - 1]
+        self.best_epoch = epoch
+        if self.writer is not None:
+            self.writer.submit(_write_best, snapshot_to_cpu(cp_dict), self.checkpoint, previous, removed)
+        else:
+            _write_best(cp_dict, self.checkpoint, previous, removed)
+
+
+def _keep_copy(src, dst):
+    # hard link (a copy where links are not supported) under a temporary name, then rename: src stays in place
+    tmp = Path(dst).with_name(f'{Path(dst).name}.{os.getpid()}.tmp')
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
 
-        torch.save(cp_dict, self.checkpoint)
+def _write_best(cp_dict, checkpoint, previous, removed):
+    """
+    The previous best is kept as its epoch file (with its weights only copy) before the new best replaces it
+    atomically: a job killed at any point leaves a complete checkpoint at the best-model path
+    """
+    if previous is not None and os.path.exists(checkpoint):
+        _keep_copy(checkpoint, previous)
+        if os.path.exists(inference_path(checkpoint)):
+            _keep_copy(inference_path(checkpoint), inference_path(previous))
+    atomic_save(cp_dict, checkpoint)
+    # weights only copy for the evaluation / serving
+    atomic_save(to_inference(cp_dict), inference_path(checkpoint))
+    for path in removed:
+        for file in [path, inference_path(path)]:
+            if os.path.exists(file):
+                os.remove(file)
         
 
 def load_from_checkpoint(model, save_path):
-    device = torch.device('cpu') if not torch.cuda.is_available() else torch.device('cuda')
-    checkpoint = torch.load(save_path, map_location=device)
+    """
+    Load the modules of the model dict and best_thr from a training or inference (.weights.pt) checkpoint,
+    the checkpoint is memory mapped: only the tensors of these modules are read
+    """
+    checkpoint = load_checkpoint(save_path)
+    metadata = checkpoint_metadata(checkpoint)
     if 'encoder' in model:
-        model['encoder'].load_state_dict(checkpoint['encoder_state_dict'])
+        if metadata.get('prune_config'):
+            apply_pruning_config(model['encoder'].backbone, metadata['prune_config'])
+            model['prune_config'] = metadata['prune_config']
+        model['encoder'].load_state_dict(module_state(checkpoint, 'encoder'))
     if 'decoder' in model:
-        model['decoder'].load_state_dict(checkpoint['decoder_state_dict'])
-    model['best_thr'] = checkpoint['best_thr']
+        model['decoder'].load_state_dict(module_state(checkpoint, 'decoder'))
+    model['best_thr'] = metadata['best_thr']
@@ -0,0 +1,214 @@
+import atexit
+import csv
+import datetime
+import json
+import queue
+import threading
+import time
+from pathlib import Path
+import numpy as np
+
+LOGGERS = ['wandb', 'jsonl', 'csv', 'none']
+WANDB_PROJECT = 'dlav-intention-prediction'
+# runs of the local backends: logs/<run name>/metrics.jsonl (or .csv) and config.json
+LOG_DIR = Path('./logs')
+# arrays (e.g. the predictions of an epoch) are logged as bin counts, not element by element
+HISTOGRAM_BINS = 64
+
+_logger = None
+
+
+class Histogram:
+    """
+    Fixed size summary of an array: counts of HISTOGRAM_BINS bins, computed on the training thread
+    """
+    def __init__(self, values, bins=HISTOGRAM_BINS):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.counts, self.edges = np.histogram(values[np.isfinite(values)], bins=bins)
+
+    def to_dict(self):
+        return {'counts': self.counts.tolist(), 'edges': self.edges.tolist()}
+
+
+def _to_json(value):
+    if isinstance(value, Histogram):
+        return value.to_dict()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+class LoggerBackend:
+    """
+    Destination of the metrics, write() is called by the logging thread with batches of (time, metrics) records
+    """
+    def __init__(self, args, run_type, run_id=None, name=''):
+        self.run_id = run_id or name or f'{run_type}-{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}'
+        self.run_name = self.run_id
+
+    def write(self, records):
+        pass
+
+    def close(self):
+        pass
+
+
+class WandbBackend(LoggerBackend):
+    def __init__(self, args, run_type, run_id=None, name=''):
+        import wandb
+        self.wandb = wandb
+        wandb.init(project=WANDB_PROJECT, config=args, id=run_id, name=name or None, resume='allow' if run_id else None)
+        # offline runs have no name
+        self.run_id, self.run_name = wandb.run.id, wandb.run.name or wandb.run.id
+        # define our custom x axis metric
+        for setup in ['train', 'val']:
+            wandb.define_metric(f"{setup}/epoch")
+            wandb.define_metric(f"{setup}/*", step_metric=f"{setup}/epoch")
+
+    def write(self, records):
+        for _, metrics in records:
+            self.wandb.log({k: self.wandb.Histogram(np_histogram=(v.counts, v.edges)) if isinstance(v, Histogram) else v
+                            for k, v in metrics.items()})
+
+    def close(self):
+        self.wandb.finish()
+
+
+class JsonlBackend(LoggerBackend):
+    """
+    One json line per log call in logs/<run name>/metrics.jsonl, appended to by resumed runs
+    """
+    file_name = 'metrics.jsonl'
+
+    def __init__(self, args, run_type, run_id=None, name=''):
+        super().__init__(args, run_type, run_id, name)
+        self.run_dir = LOG_DIR / self.run_name
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+        (self.run_dir / 'config.json').write_text(json.dumps({**vars(args), 'run_type': run_type}, default=str, indent=2))
+        self.file = open(self.run_dir / self.file_name, 'a', newline='')
+
+    def write(self, records):
+        self.file.write(''.join(json.dumps({'time': t, **metrics}, default=_to_json) + '\n' for t, metrics in records))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CsvBackend(JsonlBackend):
+    """
+    time, metric, value rows in logs/<run name>/metrics.csv, histograms are not written
+    """
+    file_name = 'metrics.csv'
+
+    def __init__(self, args, run_type, run_id=None, name=''):
+        super().__init__(args, run_type, run_id, name)
+        self.writer = csv.writer(self.file)
+        if self.file.tell() == 0:
+            self.writer.writerow(['time', 'metric', 'value'])
+
+    def write(self, records):
+        self.writer.writerows([t, k, v] for t, metrics in records for k, v in metrics.items() if not isinstance(v, Histogram))
+        self.file.flush()
+
+
+BACKENDS = {'wandb': WandbBackend, 'jsonl': JsonlBackend, 'csv': CsvBackend, 'none': LoggerBackend}
+
+
+class MetricsLogger:
+    """
+    log() only queues the metrics, a background thread hands them to the backend in batches:
+    serialization, file and network I/O stay out of the training steps
+    """
+    def __init__(self, backend, flush_every=5.0, max_batch=256):
+        """
+        :params: flush_every: seconds a record may wait for others before the batch is written
+                 max_batch: maximum number of records written at once
+        """
+        self.backend = backend
+        self.flush_every = flush_every
+        self.max_batch = max_batch
+        self.records = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name='metrics-logger', daemon=True)
+        self.thread.start()
+
+    def _next_batch(self):
+        # records logged up to flush_every seconds after the first one, a flush request ends the batch early
+        batch = [self.records.get()]
+        deadline = time.monotonic() + self.flush_every
+        while len(batch) < self.max_batch and not isinstance(batch[-1], threading.Event):
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.records.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            records = [r for r in batch if not isinstance(r, threading.Event)]
+            try:
+                if records and self.error is None:
+                    self.backend.write(records)
+            except Exception as e:
+                self.error = e
+            for r in batch:
+                if isinstance(r, threading.Event):
+                    r.set()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('metrics logging failed') from error
+
+    def log(self, metrics):
+        self._raise()
+        self.records.put((time.time(), dict(metrics)))
+
+    def flush(self):
+        # block until every logged record is written
+        done = threading.Event()
+        self.records.put(done)
+        done.wait()
+        self._raise()
+
+    def close(self):
+        self.flush()
+        self.backend.close()
+
+
+def init_run(args, run_type, run_id=None, name=''):
+    """
+    Start logging the metrics of a run to the backend args.logger, pending metrics are written at exit
+    :params: run_id: run to continue (resumed training)
+             name: name of a new run, chosen by the backend if empty
+    :return: run name
+    """
+    global _logger
+    finish()
+    backend = BACKENDS[getattr(args, 'logger', 'wandb')](args, run_type, run_id, name)
+    _logger = MetricsLogger(backend)
+    atexit.unregister(finish)
+    atexit.register(finish)
+    return backend.run_name
+
+
+def log(metrics):
+    # metrics logged before init_run (e.g. a bare evaluation) are dropped
+    if _logger is not None:
+        _logger.log(metrics)
+
+
+def run_id():
+    return _logger.backend.run_id if _logger is not None else None
+
+
+def finish():
+    global _logger
+    if _logger is not None:
+        logger, _logger = _logger, None
+        logger.close()
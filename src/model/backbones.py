@@ -0,0 +1,65 @@
+import os
+import socket
+from pathlib import Path
+import torch
+
+# torchvision constructor and ImageNet weights of the encoder backbones (the files of the former pretrained=True)
+BACKBONES = {
+    'resnet18': ('resnet18', 'https://download.pytorch.org/models/resnet18-f37072fd.pth'),
+    'mobilenetsmall': ('mobilenet_v3_small', 'https://download.pytorch.org/models/mobilenet_v3_small-047dcff4.pth'),
+    'mobilenetbig': ('mobilenet_v3_large', 'https://download.pytorch.org/models/mobilenet_v3_large-8738ca79.pth'),
+}
+# local directory of the weight files (e.g. resnet18-f37072fd.pth), searched before the torch hub cache
+WEIGHTS_DIR_ENV = 'PRETRAINED_WEIGHTS_DIR'
+# set to 1 on nodes without network: missing weight files fail immediately instead of being downloaded
+OFFLINE_ENV = 'PRETRAINED_OFFLINE'
+DOWNLOAD_TIMEOUT = 30
+
+
+def weight_dirs():
+    dirs = [Path(os.environ[WEIGHTS_DIR_ENV])] if os.environ.get(WEIGHTS_DIR_ENV) else []
+    return dirs + [Path(torch.hub.get_dir()) / 'checkpoints']
+
+
+def pretrained_state_dict(url):
+    """
+    State dict of the torchvision weights at url, read from the local weight directories, downloaded
+    (to the first of them) only when they are missing and the node is not offline
+    """
+    file_name = os.path.basename(url)
+    for weights_dir in weight_dirs():
+        if (weights_dir / file_name).exists():
+            return torch.load(weights_dir / file_name, map_location='cpu')
+    if os.environ.get(OFFLINE_ENV, '0') == '1':
+        raise FileNotFoundError(f'{file_name} not found in {", ".join(map(str, weight_dirs()))} and {OFFLINE_ENV}=1, '
+                                f'copy it from {url} into {WEIGHTS_DIR_ENV}')
+    target = weight_dirs()[0] / file_name
+    target.parent.mkdir(parents=True, exist_ok=True)
+    print(f'Downloading {url} to {target}')
+    # a node without network fails after the timeout instead of hanging
+    default_timeout = socket.getdefaulttimeout()
+    socket.setdefaulttimeout(DOWNLOAD_TIMEOUT)
+    try:
+        torch.hub.download_url_to_file(url, str(target), progress=False)
+    except OSError as e:
+        raise RuntimeError(f'could not download {url}, copy it into {WEIGHTS_DIR_ENV} '
+                           f'or set {OFFLINE_ENV}=1 on nodes without network') from e
+    finally:
+        socket.setdefaulttimeout(default_timeout)
+    return torch.load(target, map_location='cpu')
+
+
+def build_backbone(name, pretrained=True):
+    """
+    torchvision backbone of the CNN encoders
+    :params: pretrained: load the ImageNet weights, False when a checkpoint overwrites them anyway
+                        (evaluation, export, resumed / fine-tuned models): no file or network access
+    """
+    # torchvision is only imported when a CNN is built, not by the recurrent models
+    import torchvision
+    constructor, url = BACKBONES[name]
+    # random initialization, without any download
+    backbone = getattr(torchvision.models, constructor)()
+    if pretrained:
+        backbone.load_state_dict(pretrained_state_dict(url))
+    return backbone
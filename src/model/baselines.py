@@ -1,8 +1,6 @@
 import torch
-import torchvision
 import torch.nn as nn
 import torch.nn.functional as F
-from torchvision.ops import RoIAlign
 from .basenet import *
 
 
@@ -48,6 +46,7 @@ class Res18RoI(torch.nn.Module):
         self.act = torch.nn.Sigmoid()
 
     def forward(self, imgs, bboxes):
+        from torchvision.ops import RoIAlign
         feature_maps = self.resnet(imgs)
         fa = RoIAlign(output_size=(7, 7), spatial_scale=1 / 8,
                       sampling_ratio=2, aligned=True)
@@ -85,18 +84,8 @@ class DecoderRNN_PV(nn.Module):
 
     def forward(self, x_pv, x_lengths):        
         # N, T, n = x_3d.size()
-        # use input of descending length
-        packed_x1_RNN = torch.nn.utils.rnn.pack_padded_sequence(x_pv, x_lengths, 
-                                                                batch_first=True, enforce_sorted=False)
-        self.RNN.flatten_parameters()
-        
-        packed_RNN_out_1, _ = self.RNN(packed_x1_RNN, None)
-        """ None represents zero initial hidden state. RNN_out has shape=(batch, time_step, output_size) """
-
-        RNN_out_1, _ = torch.nn.utils.rnn.pad_packed_sequence(packed_RNN_out_1, batch_first=True)
-        RNN_out_1 = RNN_out_1.contiguous()
-        # choose RNN_out at the last time step
-        output_1 = RNN_out_1[:, -1, :]
+        # RNN output at the last valid time step of every sequence
+        output_1 = encode_sequence(self.RNN, x_pv, x_lengths)
         xpv = self.fc1(output_1)
         xpv = F.relu(xpv)
         xpv = self.dropout(xpv)
@@ -1,6 +1,6 @@
 import logging
 import torch
-import torchvision.models
+from concurrent.futures import ThreadPoolExecutor
 
 LOG = logging.getLogger(__name__)
 
@@ -23,6 +23,100 @@ def freeze_bn(module):
 def set_conv2d_stride1(module):
     if isinstance(module, torch.nn.modules.conv.Conv2d):
         module.stride = (1,1)  
+
+
+def sort_by_length(x_lengths, device):
+    """
+    Permutation sorting a batch by decreasing sequence length, computed once and shared by all branches
+    :return: sorted lengths (cpu), sorting indices and inverse indices (on device)
+    """
+    lengths = torch.as_tensor(x_lengths, dtype=torch.int64).cpu()
+    sorted_lengths, sorted_idx = torch.sort(lengths, descending=True)
+    unsorted_idx = torch.argsort(sorted_idx)
+    return sorted_lengths, sorted_idx.to(device), unsorted_idx.to(device)
+
+
+def pack_sorted(x, sorted_lengths, sorted_idx):
+    """
+    Pack a padded batch_first tensor with a precomputed sorting permutation
+    """
+    return torch.nn.utils.rnn.pack_padded_sequence(x.index_select(0, sorted_idx), sorted_lengths,
+                                                   batch_first=True, enforce_sorted=True)
+
+
+def encode_sequence(rnn, x, x_lengths, permutation=None):
+    """
+    Run a batch_first RNN over a padded batch and return the output of the last valid
+    time step of every sequence (last layer of h_n), without building the padded output.
+    :param: rnn: nn.LSTM / nn.GRU with batch_first=True
+            x: padded input (batch, time_step, input_size)
+            x_lengths: valid length of every sequence
+            permutation: optional result of sort_by_length, shared between branches on the same lengths
+    :return: tensor (batch, hidden_size)
+    """
+    if permutation is None:
+        permutation = sort_by_length(x_lengths, x.device)
+    sorted_lengths, sorted_idx, unsorted_idx = permutation
+    if hasattr(rnn, 'flatten_parameters'):
+        # dynamically quantized LSTMs have no cudnn weights to flatten
+        rnn.flatten_parameters()
+    # None represents zero initial hidden state
+    _, h_n = rnn(pack_sorted(x, sorted_lengths, sorted_idx), None)
+    if isinstance(h_n, tuple):
+        h_n = h_n[0]
+    return h_n[-1].index_select(0, unsorted_idx)
+
+
+def gather_last_valid(rnn, x, x_lengths):
+    """
+    Same result as encode_sequence, written without packing (plain tensor ops) so that
+    the graph can be traced / exported with dynamic batch and sequence axes.
+    Steps after the valid length do not influence earlier outputs of a unidirectional RNN.
+    """
+    out, _ = rnn(x)
+    last = (x_lengths.to(out.device).long() - 1).clamp(min=0)
+    return out[torch.arange(out.size(0), device=out.device), last]
+
+
+# thread pools of run_parallel, by number of workers
+_BRANCH_POOLS = {}
+
+
+def run_parallel(fns):
+    """
+    Run independent branches concurrently: in threads on CPU, on separate streams on GPU.
+    Grad mode and autocast are thread-local, so they are forwarded to the worker threads.
+    On CPU the branch threads share the intra-op threads: at most torch.get_num_threads() of them.
+    """
+    use_streams = torch.cuda.is_available()
+    workers = 4 if use_streams else min(4, torch.get_num_threads())
+    if workers < 2:
+        return [fn() for fn in fns]
+    if workers not in _BRANCH_POOLS:
+        _BRANCH_POOLS[workers] = ThreadPoolExecutor(max_workers=workers)
+    grad_enabled = torch.is_grad_enabled()
+    device_type = 'cuda' if use_streams else 'cpu'
+    autocast_enabled = torch.is_autocast_enabled(device_type)
+    autocast_dtype = torch.get_autocast_dtype(device_type)
+    if use_streams:
+        current = torch.cuda.current_stream()
+        streams = [torch.cuda.Stream() for _ in fns]
+
+    def run(k, fn):
+        with torch.set_grad_enabled(grad_enabled), \
+                torch.autocast(device_type, dtype=autocast_dtype, enabled=autocast_enabled):
+            if not use_streams:
+                return fn()
+            streams[k].wait_stream(current)
+            with torch.cuda.stream(streams[k]):
+                return fn()
+
+    futures = [_BRANCH_POOLS[workers].submit(run, k, fn) for k, fn in enumerate(fns)]
+    outputs = [future.result() for future in futures]
+    if use_streams:
+        for stream in streams:
+            current.wait_stream(stream)
+    return outputs
         
         
 class ResnetBlocks():
@@ -0,0 +1,134 @@
+import inspect
+import json
+import torch
+import torch.nn as nn
+from .basenet import gather_last_valid
+
+EXPORT_FORMATS = ['torchscript', 'onnx']
+# metadata stored next to the graph, read back by src/runtime.py
+METADATA_FILE = 'metadata.json'
+
+
+def last_frame(x, x_lengths):
+    # (B, T, ...) -> (B, ...), element at the last valid step of every sequence
+    last = (x_lengths.long() - 1).clamp(min=0)
+    return x[torch.arange(x.size(0), device=x.device), last]
+
+
+class CNNOnlyExport(nn.Module):
+    """
+    Res18Classifier without the per-frame loop: (images, lengths) -> crossing probability (B,)
+    """
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, images, lengths):
+        probs = self.encoder.forward_batched(images, lengths)
+        return last_frame(probs, lengths).view(-1)
+
+
+class RNNOnlyExport(nn.Module):
+    """
+    RNNClassifier without packing: (pv, lengths) -> crossing probability (B,)
+    """
+
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, pv, lengths):
+        RNN_out = gather_last_valid(self.decoder.RNN, pv, lengths)
+        return self.decoder.classification_head(RNN_out).view(-1)
+
+
+class HybridExport(nn.Module):
+    """
+    CNN encoder + DecoderRNN_IMBS without per-frame loop and packing:
+    (images, pv, behavior, scene, lengths) -> crossing probability (B,)
+    """
+
+    def __init__(self, encoder, decoder):
+        super().__init__()
+        self.encoder = encoder
+        self.decoder = decoder
+
+    def forward(self, images, pv, behavior, scene, lengths):
+        xc_3d = self.encoder.forward_batched(images, lengths)
+        output_0 = gather_last_valid(self.decoder.RNN_0, xc_3d, lengths)
+        output_1 = gather_last_valid(self.decoder.RNN_1, pv, lengths)
+        output_2 = gather_last_valid(self.decoder.RNN_2, behavior, lengths)
+        return self.decoder.fuse(output_0, output_1, output_2, scene.to(output_2.dtype)).view(-1)
+
+
+def build_export_module(mode, model):
+    """
+    Wrap the model dict of eval_hybrid.build_model into a single exportable module
+    """
+    if mode == 'cnn_only':
+        module = CNNOnlyExport(model['encoder'])
+    elif mode == 'rnn_only':
+        module = RNNOnlyExport(model['decoder'])
+    elif mode == 'hybrid':
+        module = HybridExport(model['encoder'], model['decoder'])
+    else:
+        raise ValueError(f'invalid mode {mode}')
+    return module.eval()
+
+
+def example_inputs(mode, batch_size=2, max_frames=5, image_size=(224, 448), device='cpu'):
+    """
+    Dummy inputs in the layout produced by unpack_batch, used for tracing
+    :return: ordered dict input name -> tensor
+    """
+    lengths = torch.full((batch_size,), max_frames, dtype=torch.long, device=device)
+    lengths[-1] = max(1, max_frames - 1)
+    images = torch.randn(batch_size, max_frames, 3, *image_size, device=device)
+    pv = torch.randn(batch_size, max_frames, 8, device=device)
+    behavior = torch.randn(batch_size, max_frames, 4, device=device)
+    scene = torch.zeros(batch_size, 5, device=device)
+    if mode == 'cnn_only':
+        inputs = {'images': images, 'lengths': lengths}
+    elif mode == 'rnn_only':
+        inputs = {'pv': pv, 'lengths': lengths}
+    else:
+        inputs = {'images': images, 'pv': pv, 'behavior': behavior, 'scene': scene, 'lengths': lengths}
+    return inputs
+
+
+def dynamic_axes(input_names):
+    axes = {'probs': {0: 'batch'}}
+    for name in input_names:
+        axes[name] = {0: 'batch'} if name in ['scene', 'lengths'] else {0: 'batch', 1: 'time'}
+    return axes
+
+
+def export(module, inputs, save_path, export_format='torchscript', metadata=None, opset=17):
+    """
+    Trace the module with the example inputs and save a single graph with dynamic batch / time axes
+    :params: module: module from build_export_module
+            inputs: ordered dict from example_inputs
+            save_path: output file (.pt for torchscript, .onnx for onnx)
+            metadata: json serialisable dict (mode, best_thr, input names) stored with the graph
+    """
+    metadata = dict(metadata or {})
+    metadata['inputs'] = list(inputs.keys())
+    args = tuple(inputs.values())
+    with torch.no_grad():
+        if export_format == 'torchscript':
+            traced = torch.jit.trace(module, args, check_trace=False)
+            traced = torch.jit.freeze(traced)
+            torch.jit.save(traced, save_path, _extra_files={METADATA_FILE: json.dumps(metadata)})
+        elif export_format == 'onnx':
+            # the graph is traced like the torchscript export, newer torch versions default to the dynamo exporter
+            kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+            torch.onnx.export(module, args, save_path, input_names=list(inputs.keys()), output_names=['probs'],
+                              dynamic_axes=dynamic_axes(inputs.keys()), opset_version=opset, **kwargs)
+            import onnx
+            graph = onnx.load(save_path)
+            entry = graph.metadata_props.add()
+            entry.key, entry.value = METADATA_FILE, json.dumps(metadata)
+            onnx.save(graph, save_path)
+        else:
+            raise ValueError(f'invalid export format, please choose from {", ".join(EXPORT_FORMATS)}')
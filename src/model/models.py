@@ -1,16 +1,30 @@
+import functools
 import torch
-import torchvision
 import torch.nn as nn
 import torch.nn.functional as F
-from .basenet import *
-from .baselines import *
-from ..utils import *
+from torch.utils.checkpoint import checkpoint
+from .basenet import encode_sequence, run_parallel, sort_by_length
+from ..checkpoint import load_checkpoint, module_state
+from .backbones import build_backbone
+
+
+def _checkpointed_forward(forward, x):
+    if torch.is_grad_enabled():
+        return checkpoint(forward, x, use_reentrant=False)
+    return forward(x)
 
 
 class CNNEncoder(nn.Module):
     def __init__(self, activation='relu'):
         super().__init__()
         self.activation = F.relu if activation == 'relu' else F.sigmoid
+        self.channels_last = False
+
+    def to_channels_last(self):
+        # NHWC weights and frames, faster convolutions with cudnn / onednn (especially in bf16 / fp16)
+        self.channels_last = True
+        self.backbone.to(memory_format=torch.channels_last)
+        return self
 
     def freeze_backbone(self,n_layer=None):
         total_layers=len(list(self.backbone.children()))
@@ -20,6 +34,24 @@ class CNNEncoder(nn.Module):
                 para.requires_grad = False
         print(f"freeze {n_layer} layers out of {total_layers} layers")
 
+    def unfreeze_backbone(self, n_layer):
+        # the last n_layer children of the backbone with weights are trained again (resnet18: 1 -> layer4)
+        children = [child for child in self.backbone.children() if len(list(child.parameters()))]
+        for child in children[len(children) - n_layer:] if n_layer > 0 else []:
+            for para in child.parameters():
+                para.requires_grad = True
+        print(f"unfreeze {min(n_layer, len(children))} layers out of {len(children)} layers with weights")
+
+    def checkpoint_backbone(self):
+        """
+        Activation checkpointing of the trainable children of the backbone: their activations are recomputed
+        in the backward pass instead of being kept for every frame of the batch. The backbone must stay in
+        eval mode (batch norm running stats would be updated twice).
+        """
+        for child in self.backbone.children():
+            if any(para.requires_grad for para in child.parameters()):
+                child.forward = functools.partial(_checkpointed_forward, child.forward)
+
     def turn_off_running_stats(self):
         
         def _turn_off_running_stats_recursive(module):    
@@ -34,6 +66,29 @@ class CNNEncoder(nn.Module):
         _turn_off_running_stats_recursive(self.backbone)
 
 
+    def embed_frames(self, frames):
+        # (N, C, H, W) -> (N, CNN latent dim)
+        if self.channels_last:
+            frames = frames.contiguous(memory_format=torch.channels_last)
+        x = self.backbone(frames)
+        x = self.fc(x)
+        x = self.activation(x)
+        return x.view(x.size(0), -1) # flatten output of conv
+
+    def forward_batched(self, x_5d, x_lengths):
+        """
+        Same embeddings as forward, but all valid frames of the batch go through the backbone at once.
+        Output is padded with zeros to the full time dimension of x_5d.
+        """
+        batch_size, time_steps = x_5d.size(0), x_5d.size(1)
+        lengths = x_lengths if torch.is_tensor(x_lengths) else torch.as_tensor(x_lengths)
+        lengths = lengths.to(x_5d.device).view(-1, 1)
+        valid = (torch.arange(time_steps, device=x_5d.device).view(1, -1) < lengths).flatten()
+        embed = self.embed_frames(x_5d.flatten(0, 1)[valid])
+        x_padded = torch.zeros(batch_size * time_steps, embed.size(1), dtype=embed.dtype, device=embed.device)
+        x_padded[valid] = embed
+        return x_padded.view(batch_size, time_steps, -1)
+
     def forward(self, x_5d, x_lengths):
         x_seq = []
         batch_size = x_5d.size(0)
@@ -41,10 +96,7 @@ class CNNEncoder(nn.Module):
             cnn_embed_seq = []
             for t in range(x_lengths[i]):
                 img = x_5d[i, t, :, :, :]
-                x = self.backbone(torch.unsqueeze(img,dim=0))  
-                x = self.fc(x)
-                x = self.activation(x)
-                x = x.view(x.size(0), -1) # flatten output of conv
+                x = self.embed_frames(torch.unsqueeze(img,dim=0))
                 cnn_embed_seq.append(x)                    
             # swap time and sample dim such that (sample dim=1, time dim, CNN latent dim)
             embed_seq = torch.stack(cnn_embed_seq, dim=0).transpose_(0, 1)
@@ -65,9 +117,9 @@ class Res18CropEncoder(CNNEncoder):
     
 
 class Res18Classifier(CNNEncoder):
-    def __init__(self, CNN_embed_dim=256, activation='relu'):
+    def __init__(self, CNN_embed_dim=256, activation='relu', pretrained=True):
         super().__init__(activation=activation)
-        self.backbone = torchvision.models.resnet18(pretrained=True)
+        self.backbone = build_backbone('resnet18', pretrained=pretrained)
         self.backbone.fc = torch.nn.Identity()
         self.fc = nn.Sequential(
             nn.Linear(512, CNN_embed_dim),
@@ -87,42 +139,12 @@ class MobilenetCropEncoder(CNNEncoder):
         self.fc = nn.Linear(in_features, CNN_embed_dim)
 
 
-class RNNClassifier(nn.Module):
-    def __init__(self, input_size, rnn_embeding_size=256, classification_head_size=128, drop_p=0.5, h_RNN_layers=1):
-        super().__init__()
-        self.threshold = 0.5
-    
-        self.RNN = nn.LSTM(
-            input_size=input_size,
-            hidden_size=rnn_embeding_size,        
-            num_layers=h_RNN_layers,       
-            batch_first=True,       #  (batch, time_step, input_size)
-        )
-
-        self.classification_head = nn.Sequential(
-            nn.Linear(rnn_embeding_size, classification_head_size),
-            nn.ReLU(),
-            nn.Dropout(p=drop_p),
-            nn.Linear(classification_head_size, 1),
-            nn.Sigmoid()
-        )
-
-    def forward(self, input_seq, seq_lengths):  
-        packed_inputs = torch.nn.utils.rnn.pack_padded_sequence(input_seq, seq_lengths, 
-                                                                batch_first=True, enforce_sorted=False)
-        self.RNN.flatten_parameters()
-        packed_RNN_out, _ = self.RNN(packed_inputs, None)
-        RNN_out, _ = torch.nn.utils.rnn.pad_packed_sequence(packed_RNN_out, batch_first=True)
-        RNN_out = RNN_out[:, -1, :].contiguous()
-        pred = self.classification_head(RNN_out).unsqueeze(-1)
-        return pred
-
-
 class CRNNClassifier(nn.Module):
-    def __init__(self, pos_vel_embedding_size, cnn_embedding_size, rnn_embeding_size=256, classification_head_size=128, drop_p=0.5, h_RNN_layers=1):
+    def __init__(self, pos_vel_embedding_size, cnn_embedding_size, rnn_embeding_size=256, classification_head_size=128, drop_p=0.5, h_RNN_layers=1,
+                 pretrained=True):
         super().__init__()
     
-        res18= torchvision.models.resnet18(pretrained=True)
+        res18 = build_backbone('resnet18', pretrained=pretrained)
         res18.fc = torch.nn.Identity()
         self.cnn_encoder = Res18CropEncoder(resnet=res18, CNN_embed_dim=cnn_embedding_size)
 
@@ -149,26 +171,17 @@ class CRNNClassifier(nn.Module):
         )
 
     def from_pretrained(self, cnn_encoder_path, position_velocity_rnn_path):
-        self.cnn_encoder.load_state_dict(torch.load(cnn_encoder_path)['encoder_state_dict'])
-        self.position_rnn.load_state_dict(torch.load(position_velocity_rnn_path)['decoder_state_dict'])
+        self.cnn_encoder.load_state_dict(module_state(load_checkpoint(cnn_encoder_path), 'encoder'))
+        self.position_rnn.load_state_dict(module_state(load_checkpoint(position_velocity_rnn_path), 'decoder'))
 
     def forward(self, image_seq, pos_vel_seq, seq_lengths):  
         padded_image_inputs = self.cnn_encoder(image_seq, seq_lengths)
 
-        packed_image_inputs = torch.nn.utils.rnn.pack_padded_sequence(padded_image_inputs, seq_lengths, batch_first=True, enforce_sorted=False)
-        packed_pos_vel_inputs = torch.nn.utils.rnn.pack_padded_sequence(pos_vel_seq, seq_lengths, 
-                                                                batch_first=True, enforce_sorted=False)
-        
-        self.image_rnn.flatten_parameters()
-        self.position_rnn.flatten_parameters()
-
-        packed_image_rnn_out, _ = self.image_rnn(packed_image_inputs, None)
-        packed_pos_vel_rnn_out, _ = self.position_rnn(packed_pos_vel_inputs, None)
-
-        image_rnn_out, _ = torch.nn.utils.rnn.pad_packed_sequence(packed_image_rnn_out, batch_first=True)
-        pos_vel_rnn_out, _ = torch.nn.utils.rnn.pad_packed_sequence(packed_pos_vel_rnn_out, batch_first=True)
+        permutation = sort_by_length(seq_lengths, pos_vel_seq.device)
+        image_rnn_out = encode_sequence(self.image_rnn, padded_image_inputs, seq_lengths, permutation)
+        pos_vel_rnn_out = encode_sequence(self.position_rnn, pos_vel_seq, seq_lengths, permutation)
 
-        combined_out = torch.cat((image_rnn_out, pos_vel_rnn_out), dim=-1)[:, -1, :].contiguous()
+        combined_out = torch.cat((image_rnn_out, pos_vel_rnn_out), dim=-1)
         pred = self.classification_head(combined_out)
         return pred
 
@@ -194,53 +207,16 @@ class RNNClassifier(nn.Module):
         )
 
     def forward(self, input_seq, seq_lengths):  
-
-        packed_inputs = torch.nn.utils.rnn.pack_padded_sequence(input_seq, seq_lengths, 
-                                                                batch_first=True, enforce_sorted=False)
-        # TODO: why?
-        self.RNN.flatten_parameters()
-        packed_RNN_out, _ = self.RNN(packed_inputs, None)
-        RNN_out, _ = torch.nn.utils.rnn.pad_packed_sequence(packed_RNN_out, batch_first=True)
-        RNN_out = RNN_out[:, -1, :].contiguous()
-        pred = self.classification_head(RNN_out).unsqueeze(-1)
-        return pred
-
-class RNNClassifier(nn.Module):
-    def __init__(self, input_size, rnn_embeding_size=256, classification_head_size=128, drop_p=0.2, h_RNN_layers=1):
-        super().__init__()
-        self.threshold = 0.5
-    
-        self.RNN = nn.LSTM(
-            input_size=input_size,
-            hidden_size=rnn_embeding_size,        
-            num_layers=h_RNN_layers,       
-            batch_first=True,       #  (batch, time_step, input_size)
-        )
-
-        self.classification_head = nn.Sequential(
-            nn.Linear(rnn_embeding_size, classification_head_size),
-            nn.ReLU(),
-            nn.Dropout(p=drop_p),
-            nn.Linear(classification_head_size, 1),
-            nn.Sigmoid()
-        )
-
-    def forward(self, input_seq, seq_lengths):  
-
-        packed_inputs = torch.nn.utils.rnn.pack_padded_sequence(input_seq, seq_lengths, 
-                                                                batch_first=True, enforce_sorted=False)
-        # TODO: why?
-        self.RNN.flatten_parameters()
-        packed_RNN_out, _ = self.RNN(packed_inputs, None)
-        RNN_out, _ = torch.nn.utils.rnn.pad_packed_sequence(packed_RNN_out, batch_first=True)
-        RNN_out = RNN_out[:, -1, :].contiguous()
+        RNN_out = encode_sequence(self.RNN, input_seq, seq_lengths)
         pred = self.classification_head(RNN_out).unsqueeze(-1)
         return pred
 
 class DecoderRNN_IMBS(nn.Module):
     def __init__(self, CNN_embeded_size=256, h_RNN_layers=1, h_RNN_0=256, h_RNN_1=64,
-                 h_RNN_2=16, h_FC0_dim=128, h_FC1_dim=64, h_FC2_dim=86, drop_p=0.2):
+                 h_RNN_2=16, h_FC0_dim=128, h_FC1_dim=64, h_FC2_dim=86, drop_p=0.2, fused=False):
         super().__init__()
+        # fused: run the three branches concurrently
+        self.fused = fused
         self.CNN_embeded_size= CNN_embeded_size
         self.h_RNN_0 = h_RNN_0
         self.h_RNN_1 = h_RNN_1
@@ -280,35 +256,24 @@ class DecoderRNN_IMBS(nn.Module):
         self.act = nn.Sigmoid()
 
     def forward(self, xc_3d, xp_3d, xb_3d, xs_2d, x_lengths):  
+        # the three branches share one sort/pack permutation
+        permutation = sort_by_length(x_lengths, xp_3d.device)
+        branches = [lambda rnn=rnn, x=x: encode_sequence(rnn, x, x_lengths, permutation)
+                    for rnn, x in [(self.RNN_0, xc_3d), (self.RNN_1, xp_3d), (self.RNN_2, xb_3d)]]
+        if self.fused:
+            output_0, output_1, output_2 = run_parallel(branches)
+        else:
+            output_0, output_1, output_2 = [branch() for branch in branches]
+        return self.fuse(output_0, output_1, output_2, xs_2d)
+
+    def fuse(self, output_0, output_1, output_2, xs_2d):
+        x = self.trunk(output_0, output_1, output_2, xs_2d)
+        x = self.fc3(x)
+        x = self.act(x)
+        return x
 
-        packed_x0_RNN = torch.nn.utils.rnn.pack_padded_sequence(xc_3d, x_lengths, 
-                                                                batch_first=True, enforce_sorted=False)
-        packed_x1_RNN = torch.nn.utils.rnn.pack_padded_sequence(xp_3d, x_lengths, 
-                                                                batch_first=True, enforce_sorted=False)
-        packed_x2_RNN = torch.nn.utils.rnn.pack_padded_sequence(xb_3d, x_lengths, 
-                                                                batch_first=True, enforce_sorted=False)
-        self.RNN_0.flatten_parameters()
-        self.RNN_1.flatten_parameters()
-        self.RNN_2.flatten_parameters()
-
-        # None represents zero initial hidden state. RNN_out has shape=(batch, time_step, output_size) 
-        packed_RNN_out_0, _ = self.RNN_0(packed_x0_RNN, None)
-        packed_RNN_out_1, _ = self.RNN_1(packed_x1_RNN, None)
-        packed_RNN_out_2, _ = self.RNN_2(packed_x2_RNN, None)
-
-        RNN_out_0, _ = torch.nn.utils.rnn.pad_packed_sequence(packed_RNN_out_0, batch_first=True)
-        RNN_out_0 = RNN_out_0.contiguous()
-        RNN_out_1, _ = torch.nn.utils.rnn.pad_packed_sequence(packed_RNN_out_1, batch_first=True)
-        RNN_out_1 = RNN_out_1.contiguous()
-        RNN_out_2, _ = torch.nn.utils.rnn.pad_packed_sequence(packed_RNN_out_2, batch_first=True)
-        RNN_out_2 = RNN_out_2.contiguous()
-    
-        # choose RNN_out at the last time step
-        output_0 = RNN_out_0[:, -1, :]
-        output_1 = RNN_out_1[:, -1, :]
-        output_2 = RNN_out_2[:, -1, :]
-        
-        # 
+    def trunk(self, output_0, output_1, output_2, xs_2d):
+        # hybrid fusion of the last-step embeddings of every branch and the scene description
         x0 = self.fc0(output_0)
         x0 = F.relu(x0)
         x0 = self.dropout(x0)
@@ -319,28 +284,47 @@ class DecoderRNN_IMBS(nn.Module):
         x_ipvb = torch.cat((x1, output_2, xs_2d), dim=1)
         x = self.fc2(x_ipvb)
         x = F.relu(x)
-        x = self.fc3(x)
-        x = self.act(x)
         return x
 
-def build_encoder_res18(args, hidden_dim=256, activation='relu'):
+
+class MultiTaskDecoderRNN_IMBS(DecoderRNN_IMBS):
+    """
+    Hybrid decoder with heads for crossing, next action (walking at the predicted frame) and time-to-crossing
+    bucket on top of the shared LSTMs and fusion layers: one encoder / decoder pass for the three predictions.
+    The crossing head is fc3, a DecoderRNN_IMBS state dict loads with strict=False.
+    """
+    def __init__(self, n_tte_buckets=6, **kwargs):
+        super().__init__(**kwargs)
+        self.n_tte_buckets = n_tte_buckets
+        self.fc_action = nn.Linear(self.h_FC2_dim, 1)
+        self.fc_tte = nn.Linear(self.h_FC2_dim, n_tte_buckets)
+
+    def fuse(self, output_0, output_1, output_2, xs_2d):
+        """
+        :return: crossing probability (B, 1), walking probability (B, 1), time-to-crossing bucket logits (B, n_tte_buckets)
+        """
+        x = self.trunk(output_0, output_1, output_2, xs_2d)
+        return self.act(self.fc3(x)), self.act(self.fc_action(x)), self.fc_tte(x)
+
+def build_encoder_res18(args, hidden_dim=256, activation='relu', pretrained=True):
     """
     Construct CNN encoder with resnet-18 backbone
+    :params: pretrained: ImageNet weights of the backbone, not needed when a checkpoint is loaded next
     """
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     if args.backbone == 'mobilenetsmall':
         print('Using mobilenetv3 small as cnn encoder!!')
         # small mobilev3 model
-        mobilev3_cpu = torchvision.models.mobilenet_v3_small(pretrained=True)
+        mobilev3_cpu = build_backbone('mobilenetsmall', pretrained=pretrained)
         cnn_gpu = mobilev3_cpu.to(device)
     elif args.backbone == 'mobilenetbig':
         print('Using mobilenetv3 big as cnn encoder!!')
         # big mobilev3 model
-        mobilev3_cpu = torchvision.models.mobilenet_v3_large(pretrained=True)
+        mobilev3_cpu = build_backbone('mobilenetbig', pretrained=pretrained)
         cnn_gpu = mobilev3_cpu.to(device)
     else:
         print('Using resnet18 cnn encoder!!')
-        res18= torchvision.models.resnet18(pretrained=True)
+        res18 = build_backbone('resnet18', pretrained=pretrained)
         # remove last fc
         res18.fc = torch.nn.Identity()
         cnn_gpu = res18.to(device)
@@ -0,0 +1,51 @@
+import contextlib
+import torch
+
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+
+
+def resolve_precision(precision, device):
+    """
+    Check that the requested precision can run on the device:
+    fp16 autocast is only used on cuda, bf16 is used instead on cpu
+    """
+    assert precision in PRECISIONS, f'invalid precision, please choose from {", ".join(PRECISIONS)}'
+    if precision == 'fp16' and device.type != 'cuda':
+        print('fp16 autocast needs a cuda device, using bf16 instead')
+        precision = 'bf16'
+    if precision == 'bf16' and device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        print('bf16 is not supported by this gpu, using fp16 instead')
+        precision = 'fp16'
+    return precision
+
+
+def autocast(device, precision='fp32'):
+    """
+    Autocast context of the precision mode, does nothing for fp32.
+    Losses should be computed outside of it on float outputs.
+    """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    dtype = torch.float16 if precision == 'fp16' else torch.bfloat16
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def build_grad_scaler(device, precision='fp32'):
+    # loss scaling is only needed for fp16, bf16 keeps the fp32 exponent range
+    enabled = precision == 'fp16' and device.type == 'cuda'
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def setup_precision(args, device, encoder=None):
+    """
+    Apply the --precision / --channels-last options of a script
+    :params: encoder: CNNEncoder converted to channels-last memory format if requested
+    :return: effective precision and grad scaler
+    """
+    precision = resolve_precision(getattr(args, 'precision', 'fp32'), device)
+    if encoder is not None and getattr(args, 'channels_last', False):
+        encoder.to_channels_last()
+    print(f'Precision: {precision}, channels last: {getattr(args, "channels_last", False)}')
+    return precision, build_grad_scaler(device, precision)
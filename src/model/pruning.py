@@ -0,0 +1,126 @@
+import copy
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+
+
+def prunable_units(backbone):
+    """
+    Channel groups of the backbone that can be removed without touching the residual stream:
+    - resnet BasicBlock: output channels of conv1 (input channels of conv2)
+    - mobilenetv3 InvertedResidual: expanded channels (expand conv, depthwise conv, squeeze-excitation, projection)
+    :return: ordered dict unit name -> (kind, module)
+    """
+    units = OrderedDict()
+    for name, module in backbone.named_modules():
+        kind = type(module).__name__
+        if kind == 'BasicBlock':
+            units[name] = ('basic', module)
+        elif kind == 'InvertedResidual' and module.block[0][0].groups == 1:
+            # blocks without an expand conv start with the depthwise conv, their width is the residual width
+            units[name] = ('inverted', module)
+    return units
+
+
+def unit_channels(kind, module):
+    return module.conv1.out_channels if kind == 'basic' else module.block[0][0].out_channels
+
+
+def channel_importance(kind, module):
+    # L1 norm of the filters producing the channels
+    conv = module.conv1 if kind == 'basic' else module.block[0][0]
+    return conv.weight.detach().abs().sum(dim=(1, 2, 3))
+
+
+def _slice_conv(conv, out_idx=None, in_idx=None):
+    depthwise = conv.groups > 1 and conv.groups == conv.in_channels
+    weight, bias = conv.weight.detach(), None if conv.bias is None else conv.bias.detach()
+    if out_idx is not None:
+        weight = weight[out_idx]
+        bias = None if bias is None else bias[out_idx]
+    if in_idx is not None and not depthwise:
+        weight = weight[:, in_idx]
+    out_channels = weight.size(0)
+    in_channels = out_channels if depthwise else weight.size(1) * conv.groups
+    new = nn.Conv2d(in_channels, out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                    dilation=conv.dilation, groups=out_channels if depthwise else conv.groups, bias=bias is not None)
+    new.weight.data.copy_(weight)
+    if bias is not None:
+        new.bias.data.copy_(bias)
+    # keep frozen layers frozen
+    for param in new.parameters():
+        param.requires_grad = conv.weight.requires_grad
+    return new.to(conv.weight.device)
+
+
+def _slice_bn(bn, idx):
+    new = nn.BatchNorm2d(len(idx), eps=bn.eps, momentum=bn.momentum, affine=bn.affine,
+                         track_running_stats=bn.track_running_stats)
+    if bn.affine:
+        new.weight.data.copy_(bn.weight.detach()[idx])
+        new.bias.data.copy_(bn.bias.detach()[idx])
+        new.weight.requires_grad = new.bias.requires_grad = bn.weight.requires_grad
+    if bn.track_running_stats and bn.running_mean is not None:
+        new.running_mean.copy_(bn.running_mean[idx])
+        new.running_var.copy_(bn.running_var[idx])
+        new.num_batches_tracked.copy_(bn.num_batches_tracked)
+    new.train(bn.training)
+    return new.to(bn.weight.device if bn.affine else idx.device)
+
+
+def prune_unit(kind, module, keep_idx):
+    """
+    Physically remove the channels of a unit that are not in keep_idx (in place)
+    """
+    keep_idx = keep_idx.to(module.conv1.weight.device if kind == 'basic' else module.block[0][0].weight.device)
+    if kind == 'basic':
+        module.conv1 = _slice_conv(module.conv1, out_idx=keep_idx)
+        module.bn1 = _slice_bn(module.bn1, keep_idx)
+        module.conv2 = _slice_conv(module.conv2, in_idx=keep_idx)
+        return
+    expand, depthwise = module.block[0], module.block[1]
+    expand[0] = _slice_conv(expand[0], out_idx=keep_idx)
+    expand[1] = _slice_bn(expand[1], keep_idx)
+    depthwise[0] = _slice_conv(depthwise[0], out_idx=keep_idx)
+    depthwise[1] = _slice_bn(depthwise[1], keep_idx)
+    for layer in module.block[2:]:
+        if type(layer).__name__ == 'SqueezeExcitation':
+            layer.fc1 = _slice_conv(layer.fc1, in_idx=keep_idx)
+            layer.fc2 = _slice_conv(layer.fc2, out_idx=keep_idx)
+        else:
+            # projection conv
+            layer[0] = _slice_conv(layer[0], in_idx=keep_idx)
+
+
+def prune_backbone(backbone, ratios):
+    """
+    Structured channel pruning of a copy of the backbone
+    :params: ratios: dict unit name -> fraction of channels removed, the channels with the
+                    smallest L1 filter norm are removed first
+    :return: pruned backbone and pruning config (unit name -> number of kept channels)
+    """
+    backbone = copy.deepcopy(backbone)
+    units = prunable_units(backbone)
+    config = {}
+    for name, ratio in ratios.items():
+        kind, module = units[name]
+        n_channels = unit_channels(kind, module)
+        n_keep = max(1, int(round(n_channels * (1 - ratio))))
+        if n_keep == n_channels:
+            continue
+        keep_idx = torch.argsort(channel_importance(kind, module), descending=True)[:n_keep].sort().values
+        prune_unit(kind, module, keep_idx)
+        config[name] = n_keep
+    return backbone, config
+
+
+def apply_pruning_config(backbone, config):
+    """
+    Shrink the layers of a freshly built backbone to the shapes of a pruned checkpoint (in place),
+    the weights are then loaded from the state dict
+    """
+    units = prunable_units(backbone)
+    for name, n_keep in config.items():
+        kind, module = units[name]
+        prune_unit(kind, module, torch.arange(n_keep))
+    return backbone
@@ -0,0 +1,87 @@
+import copy
+import io
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic, get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+
+def calibration_frames(loader, n_batches):
+    """
+    Yield the valid cropped frames (N, C, H, W) of the first n_batches batches of an intention loader
+    """
+    for step, inputs in enumerate(loader):
+        if step >= n_batches:
+            break
+        images, seq_len = inputs['image'], inputs['seq_length']
+        valid = torch.arange(images.size(1)).view(1, -1) < torch.as_tensor(seq_len).view(-1, 1)
+        yield images.flatten(0, 1)[valid.flatten()]
+
+
+@torch.no_grad()
+def quantize_backbone(backbone, calib_frames, engine='x86'):
+    """
+    Static int8 quantization of a conv backbone (FX graph mode), calibrated on real crops
+    :params: backbone: fp32 backbone in eval mode, left untouched
+            calib_frames: iterable of frame batches (N, C, H, W)
+            engine: quantized engine of the target cpu, x86/fbgemm for servers, qnnpack for arm
+    :return: quantized backbone taking fp32 frames
+    """
+    torch.backends.quantized.engine = engine
+    backbone = copy.deepcopy(backbone).cpu().eval()
+    prepared, n_frames = None, 0
+    for frames in calib_frames:
+        if prepared is None:
+            prepared = prepare_fx(backbone, get_default_qconfig_mapping(engine), example_inputs=(frames[:1],))
+        prepared(frames)
+        n_frames += frames.size(0)
+    assert prepared is not None, "no calibration frames"
+    print(f'Calibrated backbone on {n_frames} frames')
+    return convert_fx(prepared)
+
+
+def quantize_model(model, calib_frames=None, engine='x86'):
+    """
+    Post-training quantization of an eval model dict (see eval_hybrid.build_model):
+    dynamic int8 for every nn.LSTM / nn.Linear, static int8 for the conv backbone of the encoder
+    :return: new model dict on cpu, the fp32 model is left untouched
+    """
+    torch.backends.quantized.engine = engine
+    q_model = {k: v for k, v in model.items() if k not in ['encoder', 'decoder']}
+    if 'decoder' in model:
+        q_model['decoder'] = quantize_dynamic(model['decoder'].cpu().eval(), {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+    if 'encoder' in model:
+        encoder = quantize_dynamic(model['encoder'].cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+        if calib_frames is not None:
+            encoder.backbone = quantize_backbone(model['encoder'].backbone, calib_frames, engine=engine)
+        q_model['encoder'] = encoder
+    return q_model
+
+
+def model_size_mb(model):
+    # serialized size of the state dicts of the model dict
+    size = 0
+    for k in ['encoder', 'decoder']:
+        if k in model:
+            buffer = io.BytesIO()
+            torch.save(model[k].state_dict(), buffer)
+            size += buffer.tell()
+    return size / 2 ** 20
+
+
+@torch.no_grad()
+def benchmark(module, inputs, n_iter=20, warmup=3):
+    """
+    Median latency (ms) of a module from src.model.export on fixed inputs
+    """
+    args = tuple(inputs.values())
+    for _ in range(warmup):
+        module(*args)
+    timings = []
+    for _ in range(n_iter):
+        start = time.perf_counter()
+        module(*args)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000
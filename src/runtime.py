@@ -0,0 +1,59 @@
+"""
+Lightweight runtime for graphs produced by export_model.py.
+Only torch (and onnxruntime for .onnx graphs) is imported: no wandb, sklearn or torchvision.
+"""
+import json
+import torch
+from src.model.export import METADATA_FILE
+
+
+class ExportedModel:
+    """
+    Exported crossing intention model, called with the inputs listed in metadata['inputs']
+    (layout of unpack_batch) and returning the crossing probabilities (B,)
+    """
+
+    def __init__(self, path, device=None, num_threads=None):
+        """
+        :params: path: .pt (torchscript) or .onnx graph
+                device: torch device for torchscript graphs, cuda if available by default
+                num_threads: intra-op threads of the runtime, library default if None
+        """
+        self.path = path
+        self.is_onnx = path.endswith('.onnx')
+        if self.is_onnx:
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=onnxruntime.get_available_providers())
+            self.metadata = json.loads(self.session.get_modelmeta().custom_metadata_map.get(METADATA_FILE, '{}'))
+            self.device = torch.device('cpu')
+        else:
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            self.device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+            extra_files = {METADATA_FILE: ''}
+            self.module = torch.jit.load(path, map_location=self.device, _extra_files=extra_files)
+            self.module.eval()
+            self.metadata = json.loads(extra_files[METADATA_FILE] or '{}')
+        self.input_names = self.metadata.get('inputs', [])
+        self.best_thr = self.metadata.get('best_thr', 0.5)
+        self.mode = self.metadata.get('mode')
+
+    @torch.no_grad()
+    def __call__(self, *args, **kwargs):
+        inputs = dict(zip(self.input_names, args))
+        inputs.update(kwargs)
+        if self.is_onnx:
+            feed = {name: torch.as_tensor(inputs[name]).cpu().numpy() for name in self.input_names}
+            return torch.from_numpy(self.session.run(['probs'], feed)[0])
+        return self.module(*[torch.as_tensor(inputs[name]).to(self.device) for name in self.input_names])
+
+    def predict(self, *args, **kwargs):
+        # binary crossing decision with the threshold selected on the validation set
+        return (self(*args, **kwargs) > self.best_thr).long()
+
+
+def load_exported(path, device=None, num_threads=None):
+    return ExportedModel(path, device=device, num_threads=num_threads)
@@ -0,0 +1,435 @@
+import time
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from src.checkpoint import CheckpointWriter, capture_rng_state, restore_rng_state, resume_path, save_resume_state, \
+    load_resume_state, to_device
+from src.early_stopping import EarlyStopping
+from src import logger
+from src.model.precision import PRECISIONS, autocast
+from src.utils import find_best_threshold, log_metrics, log_to_stdout, print_eval_metrics
+
+# batch entries the models use on the cpu (lengths of pack_padded_sequence / python loops, sample ids)
+HOST_KEYS = ['seq_length', 'id']
+
+
+def add_trainer_args(parser):
+    """
+    Options of the training engine and of its data pipeline, shared by the train_*.py scripts
+    """
+    parser.add_argument('--precision', default='fp32', type=str, choices=PRECISIONS,
+                        help='autocast precision of the forward passes (bf16 on cpu, fp16 on gpu)')
+    parser.add_argument('--channels-last', default=False, action='store_true',
+                        help='run the CNN encoder in channels-last memory format')
+    parser.add_argument('--accumulation-steps', default=1, type=int,
+                        help='number of batches whose gradients are summed before an optimizer step')
+    parser.add_argument('--val-every', default=1, type=int,
+                        help='validation / checkpoint cadence in epochs')
+    parser.add_argument('--logger', default='wandb', type=str, choices=logger.LOGGERS,
+                        help='metrics logging backend, jsonl / csv write logs/<run>/metrics.* without network (none: no logging)')
+    parser.add_argument('--run-name', default='', type=str,
+                        help='name of the run (checkpoint and log directory), given by the logging backend by default')
+    parser.add_argument('--skip-test', default=False, action='store_true',
+                        help='stop after training, without the test set evaluation (e.g. hyperparameter search trials)')
+    parser.add_argument('--anns-cache-dir', default='', type=str,
+                        help='directory caching the built annotation sequences, shared by runs with the same data setting')
+    parser.add_argument('--resume', default='', type=str,
+                        help='resume state file (<checkpoint>.resume.pt) of an interrupted run to continue')
+    parser.add_argument('--snapshot-every', default=0, type=int,
+                        help='number of training batches between mid-epoch resume snapshots (0: end of epochs only)')
+    parser.add_argument('--keep-top-k', default=1, type=int,
+                        help='number of best checkpoints kept (the best one, then <checkpoint>_epoch<e>.pt)')
+    parser.add_argument('--sync-checkpoints', default=False, action='store_true',
+                        help='write the checkpoints on the training thread instead of a background writer')
+    parser.add_argument('--epoch-balancing', default=False, action='store_true',
+                        help='keep the full training set and draw a new balanced subset every epoch')
+    parser.add_argument('--balance-strata', default='none', type=str, choices=['none', 'video_number', 'ped_id'],
+                        help='draw every class proportionally to these groups when using --epoch-balancing')
+    parser.add_argument('--locality-window', default=0, type=int,
+                        help='number of neighbouring samples of a video kept together in training batches (0: plain shuffle)')
+    parser.add_argument('--report-cache-hits', default=False, action='store_true',
+                        help='print the frame cache hit rate of the --locality-window order, simulated once at start-up')
+    parser.add_argument('-nw', '--num-workers', default=4, type=int, help='number of workers for data loading')
+    parser.add_argument('--io-threads', default=0, type=int, help='number of threads reading frames inside every loader worker')
+    parser.add_argument('--read-ahead', default=0, type=int, help='number of upcoming samples of a batch read in advance')
+    parser.add_argument('--shared-index', default=False, action='store_true',
+                        help='keep dataset samples in shared-memory tensors instead of per-worker copies of python dicts')
+    return parser
+
+
+def build_early_stopping(args, save_path):
+    """
+    Early stopping of the train_*.py scripts, checkpoints written by a background writer unless --sync-checkpoints
+    """
+    writer = None if args.sync_checkpoints else CheckpointWriter()
+    return EarlyStopping(checkpoint=save_path, patience=args.early_stopping_patience, verbose=True,
+                         top_k=args.keep_top_k, writer=writer)
+
+
+def batch_to_device(batch, device):
+    if torch.is_tensor(batch):
+        return batch.to(device, non_blocking=True)
+    if isinstance(batch, dict):
+        return {k: v if k in HOST_KEYS else batch_to_device(v, device) for k, v in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(batch_to_device(v, device) for v in batch)
+    return batch
+
+
+def _record_stream(batch, stream):
+    # memory of the tensors copied on the side stream must not be reused before the main stream is done with them
+    if torch.is_tensor(batch):
+        batch.record_stream(stream)
+    elif isinstance(batch, dict):
+        for v in batch.values():
+            _record_stream(v, stream)
+    elif isinstance(batch, (list, tuple)):
+        for v in batch:
+            _record_stream(v, stream)
+
+
+def prefetch(loader, device):
+    """
+    Batches of the loader with their tensors already on the device: on cuda the host to device
+    copy of the next batch runs on a side stream while the current batch is processed
+    (pinned memory loaders, see build_dataloaders). Batches are yielded as they are on cpu.
+    """
+    if device.type != 'cuda':
+        yield from loader
+        return
+    stream = torch.cuda.Stream()
+    batches = iter(loader)
+
+    def load():
+        batch = next(batches, None)
+        if batch is not None:
+            with torch.cuda.stream(stream):
+                batch = batch_to_device(batch, device)
+        return batch
+
+    upcoming = load()
+    while upcoming is not None:
+        torch.cuda.current_stream().wait_stream(stream)
+        batch = upcoming
+        _record_stream(batch, torch.cuda.current_stream())
+        upcoming = load()
+        yield batch
+
+
+def _float(outputs):
+    # losses and metrics are computed in fp32 outside of autocast
+    if isinstance(outputs, (list, tuple)):
+        return type(outputs)(o.float() for o in outputs)
+    return outputs.float()
+
+
+class ModelAdapter:
+    """
+    What differs between the training modes, the Trainer does the rest:
+    - train state of the modules of the model dict (frozen backbones stay in eval mode)
+    - forward pass on a batch
+    - loss (crossing BCE by default) and crossing probabilities used for the metrics
+    """
+    # the train_*.py run name and the checkpoint prefix
+    name = None
+
+    def train(self, model):
+        raise NotImplementedError
+
+    def eval(self, model):
+        for module in model.values():
+            if isinstance(module, torch.nn.Module):
+                module.eval()
+
+    def forward(self, model, inputs, device):
+        """
+        :return: model outputs, crossing probabilities (B, 1) unless scores is overridden
+        """
+        raise NotImplementedError
+
+    def scores(self, outputs):
+        return outputs.view(-1, 1)
+
+    def loss(self, outputs, targets, inputs, train=True):
+        """
+        :params: targets: crossing labels (B, 1)
+                train: training loss, the validation loss can differ (e.g. without distillation)
+        :return: loss and dict of its parts logged next to it
+        """
+        return F.binary_cross_entropy(self.scores(outputs), targets), {}
+
+    def metrics(self):
+        """
+        Optional accumulator of extra metrics over an epoch, with update(outputs, inputs) and log(mode, step)
+        """
+        return None
+
+
+class Trainer:
+    """
+    Training engine of the train_*.py scripts: epoch loops with mixed precision and gradient accumulation,
+    predictions / losses accumulated on the device (one transfer per epoch), batches copied ahead of time,
+    validation / checkpoint cadence, early stopping and test evaluation
+    """
+    def __init__(self, adapter, model, optimizer, device, scheduler=None, precision='fp32', scaler=None,
+                 accumulation_steps=1):
+        self.adapter = adapter
+        self.model = model
+        self.optimizer = optimizer
+        self.device = device
+        self.scheduler = scheduler
+        self.precision = precision
+        self.scaler = scaler
+        self.accumulation_steps = max(1, accumulation_steps)
+        self.snapshot_every = 0
+        self.loader_seed = None
+
+    def forward(self, inputs):
+        with autocast(self.device, self.precision):
+            outputs = self.adapter.forward(self.model, inputs, self.device)
+        return _float(outputs)
+
+    def targets(self, inputs):
+        return inputs['label'].to(self.device, non_blocking=True).view(-1, 1)
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+    def optimizer_step(self, n_samples=None):
+        """
+        :params: n_samples: number of samples of the accumulated batches, their gradients (of losses
+                    weighted by the batch sizes) are divided by it to get the gradient of the mean loss
+        """
+        if n_samples is not None:
+            if self.scaler is not None:
+                self.scaler.unscale_(self.optimizer)
+            for group in self.optimizer.param_groups:
+                for param in group['params']:
+                    if param.grad is not None:
+                        param.grad.div_(n_samples)
+        if self.scaler is not None:
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        else:
+            self.optimizer.step()
+        self.optimizer.zero_grad()
+
+    def new_totals(self):
+        # what an epoch accumulates, on the device
+        return {'step': 0, 'loss': torch.zeros((), device=self.device), 'parts': {}, 'preds': [], 'tgts': [],
+                'metrics': self.adapter.metrics()}
+
+    def run_epoch(self, loader, train, totals=None, snapshot=None):
+        """
+        One pass over the loader
+        :params: totals: accumulators of the first batches of the epoch (resume of a mid-epoch snapshot), these
+                    batches are skipped
+                snapshot: function (totals) called every snapshot_every training batches
+        :return: mean loss, mean loss parts, crossing probabilities and labels (numpy), extra metrics
+        """
+        totals = totals if totals is not None else self.new_totals()
+        start_step = totals['step']
+        if start_step > 0:
+            loader.batch_sampler.skip_batches(start_step)
+        metrics = totals['metrics']
+        n_steps = len(loader)
+        accumulate = train and self.accumulation_steps > 1
+        n_accumulated = 0
+        if train:
+            self.optimizer.zero_grad()
+        batches = prefetch(loader, self.device)
+        for step, inputs in enumerate(tqdm(batches, total=n_steps, initial=start_step), start=start_step):
+            targets = self.targets(inputs)
+            with torch.set_grad_enabled(train):
+                outputs = self.forward(inputs)
+                loss, parts = self.adapter.loss(outputs, targets, inputs, train=train)
+            if accumulate:
+                # the gradients of accumulation_steps batches make one step, every batch weighs its number of
+                # samples so that a smaller last batch / last group gets the gradient of one large batch
+                self.backward(loss * targets.size(0))
+                n_accumulated += targets.size(0)
+                if (step + 1) % self.accumulation_steps == 0 or step + 1 == n_steps:
+                    self.optimizer_step(n_accumulated)
+                    n_accumulated = 0
+            elif train:
+                self.backward(loss)
+                self.optimizer_step()
+
+            totals['loss'] += loss.detach()
+            for k, v in parts.items():
+                totals['parts'][k] = totals['parts'].get(k, 0.0) + v.detach()
+            totals['preds'].append(self.adapter.scores(outputs).detach().view(-1))
+            totals['tgts'].append(targets.detach().view(-1))
+            if metrics is not None:
+                metrics.update(outputs, inputs)
+            totals['step'] = step + 1
+            # snapshot_every is a multiple of accumulation_steps: no gradient is pending
+            if train and snapshot is not None and self.snapshot_every and (step + 1) % self.snapshot_every == 0 \
+                    and step + 1 < n_steps:
+                snapshot(totals)
+
+        epoch_loss = totals['loss'].item() / n_steps
+        epoch_parts = {k: float(v) / n_steps for k, v in totals['parts'].items()}
+        preds, tgts = torch.cat(totals['preds']).cpu().numpy(), torch.cat(totals['tgts']).cpu().numpy()
+        return epoch_loss, epoch_parts, preds, tgts, metrics
+
+    def train_epoch(self, loader, epoch, totals=None, snapshot=None):
+        # sklearn is imported when used, importing the trainer stays cheap (e.g. prune_encoder)
+        from sklearn.metrics import f1_score, average_precision_score
+        self.adapter.train(self.model)
+        epoch_loss, parts, preds, tgts, metrics = self.run_epoch(loader, train=True, totals=totals, snapshot=snapshot)
+
+        logger.log({'train/loss': epoch_loss, **{f'train/{k}': v for k, v in parts.items()}, 'train/epoch': epoch + 1})
+        if metrics is not None:
+            metrics.log('train', epoch + 1)
+        train_score = average_precision_score(tgts, preds)
+        best_thr = self.model['best_thr']
+        f1 = f1_score(tgts, preds > best_thr)
+        log_metrics(tgts, preds, best_thr, f1, train_score, 'train', epoch + 1)
+
+        return epoch_loss
+
+    @torch.no_grad()
+    def val_epoch(self, loader, epoch):
+        from sklearn.metrics import average_precision_score
+        # switch to evaluate mode
+        self.adapter.eval(self.model)
+        epoch_loss, parts, preds, tgts, metrics = self.run_epoch(loader, train=False)
+
+        logger.log({'val/loss': epoch_loss, **{f'val/{k}': v for k, v in parts.items()}, 'val/epoch': epoch + 1})
+        if metrics is not None:
+            metrics.log('val', epoch + 1)
+        best_thr, best_f1 = find_best_threshold(preds, tgts)
+        self.model['best_thr'] = best_thr
+
+        val_score = average_precision_score(tgts, preds)
+        log_metrics(tgts, preds, best_thr, best_f1, val_score, 'val', epoch + 1)
+
+        return epoch_loss, best_f1
+
+    @torch.no_grad()
+    def evaluate(self, loader):
+        # swith to evaluate mode
+        self.adapter.eval(self.model)
+        _, _, preds, tgts, metrics = self.run_epoch(loader, train=False)
+
+        best_thr = self.model['best_thr']
+        f1, ap = print_eval_metrics(tgts, preds, best_thr)
+        log_metrics(tgts, preds, best_thr, f1, ap, 'test', 0)
+        if metrics is not None:
+            metrics.log('test', 0)
+        return f1, ap
+
+    def scheduler_step(self, val_f1):
+        if self.scheduler is None:
+            return
+        lrs = [group['lr'] for group in self.optimizer.param_groups]
+        self.scheduler.step(val_f1)
+        for lr, group in zip(lrs, self.optimizer.param_groups):
+            if group['lr'] != lr:
+                print(f'Reducing learning rate from {lr:.2e} to {group["lr"]:.2e}')
+
+    def set_loader_epoch(self, loader, epoch):
+        # the sample order (and the seeds of the loader workers) of an epoch only depends on the epoch
+        if loader.generator is not None:
+            if self.loader_seed is None:
+                self.loader_seed = loader.generator.initial_seed()
+            loader.generator.manual_seed(self.loader_seed + epoch)
+        if hasattr(loader.batch_sampler, 'set_epoch'):
+            loader.batch_sampler.set_epoch(epoch)
+
+    def state_dict(self, epoch, early_stopping, best_f1, total_time, totals=None):
+        """
+        Everything needed to continue the run bit-exactly from the start of epoch (or from its first
+        totals['step'] batches)
+        """
+        state = {'epoch': epoch, 'best_f1': best_f1, 'total_time': total_time, 'loader_seed': self.loader_seed,
+                 'best_thr': self.model['best_thr'], 'prune_config': self.model.get('prune_config'),
+                 'modules': {k: m.state_dict() for k, m in self.model.items() if isinstance(m, torch.nn.Module)},
+                 'optimizer': self.optimizer.state_dict(),
+                 'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+                 'scaler': self.scaler.state_dict() if self.scaler is not None else None,
+                 'early_stopping': early_stopping.state_dict(), 'checkpoint': str(early_stopping.checkpoint),
+                 'run_id': logger.run_id(), 'rng': capture_rng_state()}
+        if totals is not None:
+            state['totals'] = {**totals, 'preds': [torch.cat(totals['preds'])], 'tgts': [torch.cat(totals['tgts'])]}
+        return state
+
+    def load_state_dict(self, state, early_stopping):
+        for k, module_state in state['modules'].items():
+            self.model[k].load_state_dict(module_state)
+        self.model['best_thr'] = state['best_thr']
+        if state['prune_config'] is not None:
+            self.model['prune_config'] = state['prune_config']
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None and state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        if self.scaler is not None and state['scaler'] is not None:
+            self.scaler.load_state_dict(state['scaler'])
+        early_stopping.load_state_dict(state['early_stopping'])
+        self.loader_seed = state['loader_seed']
+
+    def fit(self, train_loader, val_loader, epochs, early_stopping, val_every=1, resume='', snapshot_every=0):
+        """
+        Train for epochs, validation / early stopping checkpoint every val_every epochs and after the last one.
+        The resume state (<checkpoint>.resume.pt) is written after every epoch and every snapshot_every batches.
+        :params: resume: resume state file of an interrupted run, continued where it stopped
+        :return: last epoch
+        """
+        # snapshots are taken after an optimizer step
+        self.snapshot_every = -(-snapshot_every // self.accumulation_steps) * self.accumulation_steps
+        state_path = resume_path(early_stopping.checkpoint)
+        total_time = 0.0
+        best_f1 = 0.0
+        start_epoch, totals = 0, None
+        if resume:
+            state = load_resume_state(resume)
+            self.load_state_dict(state, early_stopping)
+            start_epoch, best_f1, total_time = state['epoch'], state['best_f1'], state['total_time']
+            # the epoch accumulators live on the device
+            totals = to_device(state['totals'], self.device) if state.get('totals') else None
+            state_path = resume_path(early_stopping.checkpoint)
+            print(f'Resuming from {resume}: epoch {start_epoch}' + (f', batch {totals["step"]}' if totals else ''))
+            restore_rng_state(state['rng'])
+            if early_stopping.early_stop:
+                print(f'Early stopping after {start_epoch - 1} epochs...')
+                start_epoch = epochs
+
+        def snapshot(epoch_totals):
+            save_resume_state(state_path, self.state_dict(epoch, early_stopping, best_f1,
+                                                          total_time + time.time() - start_epoch_time, epoch_totals),
+                              early_stopping.writer)
+
+        epoch = start_epoch - 1
+        for epoch in range(start_epoch, epochs):
+            start_epoch_time = time.time()
+            self.set_loader_epoch(train_loader, epoch)
+            train_loss = self.train_epoch(train_loader, epoch, totals=totals, snapshot=snapshot)
+            totals = None
+            if (epoch + 1) % val_every == 0 or epoch + 1 == epochs:
+                val_loss, val_f1 = self.val_epoch(val_loader, epoch)
+                best_f1 = max(best_f1, val_f1)
+                self.scheduler_step(val_f1)
+                early_stopping(val_f1, self.model, self.optimizer, epoch)
+                logger.log({"val/best_f1": best_f1, "val/epoch": epoch})
+                end_epoch_time = time.time() - start_epoch_time
+                total_time += end_epoch_time
+                save_resume_state(state_path, self.state_dict(epoch + 1, early_stopping, best_f1, total_time),
+                                  early_stopping.writer)
+                if early_stopping.early_stop:
+                    print(f'Early stopping after {epoch} epochs...')
+                    break
+                log_to_stdout(epoch, train_loss, val_loss, val_f1, end_epoch_time)
+            else:
+                total_time += time.time() - start_epoch_time
+                save_resume_state(state_path, self.state_dict(epoch + 1, early_stopping, best_f1, total_time),
+                                  early_stopping.writer)
+
+        early_stopping.wait()
+        print('\n', '**************************************************************')
+        print(f'End training at epoch {epoch}')
+        print('total time: {:.2f}'.format(total_time))
+        return epoch
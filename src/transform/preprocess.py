@@ -137,5 +137,6 @@ class Normalization(Preprocess):
         self.mean=[]
         self.std=[]
     def __call__(self,image,anns):
-        image=transforms.Normalize(self.mean, self.std)(image) # normalization
+        from torchvision.transforms import Normalize
+        image=Normalize(self.mean, self.std)(image) # normalization
         return image,anns
\ No newline at end of file
@@ -2,7 +2,6 @@ import PIL
 import torch
 import copy
 import numpy as np
-import torchvision.transforms as transforms
 
 
 def img_pad(img, mode='warp', size=224):
@@ -163,7 +162,8 @@ def resize(image, bbox, resize_ratio):
     new_width = int(w * resize_ratio)
     new_height = int(h * resize_ratio)
 
-    image_new = transforms.Resize((new_height, new_width))(image)
+    from torchvision.transforms import Resize
+    image_new = Resize((new_height, new_width))(image)
     bbox_new = np.array(bbox) * resize_ratio
     # print('after: ', bbox_new)
     return image_new, bbox_new.tolist()
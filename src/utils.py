@@ -1,62 +1,14 @@
 import torch
 import os
 import numpy as np
-from sklearn.metrics import f1_score, precision_score, recall_score, classification_report, average_precision_score
 import random
-import wandb
+from collections import OrderedDict
 from pathlib import Path
 import datetime
+from src.checkpoint import read_resume_meta
+from src import logger
+
 
-def save_to_checkpoint(save_path, epoch, model, optimizer, scheduler=None, verbose=True):
-    # save checkpoint to disk
-    d_sche = None
-    if scheduler is not None:
-        d_sche = scheduler.state_dict()
-    if save_path is not None:
-        checkpoint = {'epoch': epoch + 1,
-                      'model': model.state_dict(),
-                      'optimizer': optimizer.state_dict(),
-                      'scheduler': d_sche
-                      }
-        torch.save(checkpoint, '{}_epoch_{}.pt'.format(save_path, epoch))
-
-    if verbose:
-        print("saved model at epoch {}".format(epoch))
-
-        
-def load_from_checkpoint(checkpoint_path, model, optimizer = None, scheduler = None, verbose = True):
-    """Loads model from checkpoint, loads optimizer and scheduler too if not None, 
-       and returns epoch and iteration of the checkpoints
-    """
-    if not os.path.exists(checkpoint_path):
-        raise ("File does not exist {}".format(checkpoint_path))
-        
-    if torch.cuda.is_available():
-        checkpoint = torch.load(checkpoint_path)
-    else:
-        checkpoint = torch.load(checkpoint_path,map_location='cpu')
-        
-    check_keys = list(checkpoint.keys())
-
-    model.load_state_dict(checkpoint['model']) 
-    
-    if 'optimizer' in check_keys:
-        if optimizer is not None:
-            optimizer.load_state_dict(checkpoint['optimizer'])
-
-    if 'scheduler' in check_keys:
-        if scheduler is not None:
-            scheduler.load_state_dict(checkpoint['scheduler'])
-  
-    if 'epoch' in check_keys:
-        epoch = checkpoint['epoch']
-       
-    if verbose: # optional printing
-        print(f"Loaded model from checkpoint {checkpoint_path}")
-
-    return epoch
-    
-# ---------------------------------------------------------------------
 def reshape_bbox(bbox_list, device):
     new_bbox_list = []
     for j in range(len(bbox_list)):
@@ -128,11 +80,70 @@ def reshape_anns(anns_list, device):
     return anns_list
 
 
-def count_parameters(model):
-    return sum(p.numel() for p in model.parameters() if p.requires_grad)
+def count_parameters(model, trainable_only=True):
+    return sum(p.numel() for p in model.parameters() if p.requires_grad or not trainable_only)
+
+
+@torch.no_grad()
+def count_flops(model, *inputs):
+    """
+    Multiply-accumulate count of the Conv2d and Linear layers for one forward pass on inputs
+    """
+    flops = []
+
+    def conv_hook(module, x, y):
+        kernel = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+        flops.append(y.numel() * kernel)
+
+    def linear_hook(module, x, y):
+        flops.append(y.numel() * module.in_features)
+
+    hooks = []
+    for module in model.modules():
+        if isinstance(module, torch.nn.Conv2d):
+            hooks.append(module.register_forward_hook(conv_hook))
+        elif isinstance(module, torch.nn.Linear):
+            hooks.append(module.register_forward_hook(linear_hook))
+    model(*inputs)
+    for hook in hooks:
+        hook.remove()
+    return sum(flops)
+
+
+class LRUCache:
+    """
+    Bounded key -> value store evicting the least recently used entry
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
 
 
 def find_best_threshold(preds, targets):
+    # sklearn is imported where used: evaluation / serving only import torch and the models
+    from sklearn.metrics import f1_score
     best_f1 = 0
     best_thr = None
     for thr in np.linspace(0, 1, 50):
@@ -145,17 +156,18 @@ def find_best_threshold(preds, targets):
 
 
 def log_metrics(targets, preds, best_thr, best_f1, ap, mode, step):
+    from sklearn.metrics import precision_score, recall_score
     binarized_preds = (preds > best_thr).astype(int)
     precision = precision_score(targets, binarized_preds)
     recall = recall_score(targets, binarized_preds)
 
-    wandb.log({f'{mode}/precision': precision , 
-               f'{mode}/recall': recall, 
-               f'{mode}/f1': best_f1, 
-               f'{mode}/AP': ap, 
-               f'{mode}/best_thr': best_thr,
-               f"{mode}/preds": wandb.Histogram(preds),
-               f'{mode}/epoch': step}, commit=True)
+    logger.log({f'{mode}/precision': precision ,
+                f'{mode}/recall': recall,
+                f'{mode}/f1': best_f1,
+                f'{mode}/AP': ap,
+                f'{mode}/best_thr': best_thr,
+                f"{mode}/preds": logger.Histogram(preds),
+                f'{mode}/epoch': step})
     
     print('------------------------------------------------')
     print(f'Mode: {mode}')
@@ -177,19 +189,15 @@ def log_to_stdout(epoch, train_loss, val_loss, val_f1, end_epoch_time):
     print('--------------------------------------------------------', '\n')
 
 
-def setup_wandb(args, run_type):
+def setup_logging(args, run_type):
+    """
+    Start the metrics logging of a run with the --logger backend (wandb, jsonl, csv or none)
+    :return: run name, also the checkpoint directory of the run
+    """
     args.run_type = run_type
-    wandb.init(
-        project="dlav-intention-prediction",
-        config=args,
-    )
-    run_name = wandb.run.name
-
-    # define our custom x axis metric
-    for setup in ['train', 'val']:
-        wandb.define_metric(f"{setup}/epoch")
-        wandb.define_metric(f"{setup}/*", step_metric=f"{setup}/epoch")
-    return run_name
+    # a resumed run keeps logging to its run
+    run_id = read_resume_meta(args.resume)['run_id'] if getattr(args, 'resume', '') else None
+    return logger.init_run(args, run_type, run_id, name=getattr(args, 'run_name', ''))
 
 
 def seed_torch(seed=1):
@@ -205,6 +213,10 @@ def seed_torch(seed=1):
 
 
 def prepare_cp_path(args, run_name, run_mode):
+    if getattr(args, 'resume', ''):
+        save_path = read_resume_meta(args.resume)['checkpoint']
+        print(f'Resumed run, saving the model to: {save_path}')
+        return Path(save_path)
     cp_dir = Path(f'./checkpoints/{run_name}')
     cp_dir.mkdir(parents=True, exist_ok=True)
     save_path = cp_dir / f'{run_mode}_lr{args.lr}_wd{args.wd}_JAAD_pred{args.pred}_bs{args.batch_size}_{datetime.datetime.now().strftime("%Y%m%d%H%M")}.pt'
@@ -213,7 +225,8 @@ def prepare_cp_path(args, run_name, run_mode):
 
 
 def prep_pred_storage(loader):
-    batch_size = loader.batch_size
+    # loaders built with a batch_sampler have no batch_size of their own
+    batch_size = loader.batch_size if loader.batch_size is not None else loader.batch_sampler.batch_size
     n_steps = len(loader)
 
     preds = np.zeros(n_steps * batch_size)
@@ -222,6 +235,7 @@ def prep_pred_storage(loader):
 
 
 def print_eval_metrics(tgts, preds, best_thr):
+    from sklearn.metrics import average_precision_score, classification_report, f1_score
     ap = average_precision_score(tgts, preds)
     f1 = f1_score(tgts, preds > best_thr)
     preds = preds > best_thr
@@ -1,27 +1,18 @@
 import argparse
-import time
-from tqdm import tqdm
 import torch
-import numpy as np
-from src.dataset.loader import IntentionSequenceDataset, define_path
-from src.transform.preprocess import ImageTransform, Compose, ResizeFrame, CropBoxWithBackgroud
-import torchvision
-from src.utils import prep_pred_storage, print_eval_metrics, count_parameters, find_best_threshold, seed_torch, setup_wandb, log_metrics, prepare_cp_path, log_to_stdout
-from src.dataset.utils import build_dataloaders
+from src.utils import count_parameters, seed_torch, setup_logging, prepare_cp_path
+from src.dataset.utils import build_dataloaders, prepare_intention_data
 from src.model.models import Res18Classifier
-from src.dataset.intention.jaad_dataset import build_pedb_dataset_jaad, balance, unpack_batch
-from sklearn.metrics import classification_report, f1_score, average_precision_score
-import wandb
-from src.early_stopping import EarlyStopping, load_from_checkpoint
+from src.dataset.intention.jaad_dataset import unpack_batch
+from src.early_stopping import load_from_checkpoint
+from src.model.precision import setup_precision
+from src.trainer import ModelAdapter, Trainer, add_trainer_args, build_early_stopping
 
 
 # only training the CNN on a signle frame
 MAX_FRAMES = 1
 OUTPUT_DIM = 1
 
-MEAN = [0.3104, 0.2813, 0.2973]
-STD = [0.1761, 0.1722, 0.1673]
-
 def get_args():
     parser = argparse.ArgumentParser(description='Train hybrid model')
     parser.add_argument('--jaad', default=True, action='store_true',
@@ -36,7 +27,7 @@ def get_args():
                         help='random seed for sampling')
     parser.add_argument('--encoder-type', default='CC', type=str,
                         help='encoder for images, CC(crop-context) or RC(roi-context)')
-    parser.add_argument('--encoder-pretrained', default=False, 
+    parser.add_argument('--encoder-pretrained', default=False,
                         help='load pretrained encoder')
     parser.add_argument('--cnn-embed-dim', default=256, type=int, 
                         help='load pretrained encoder')
@@ -52,145 +43,48 @@ def get_args():
                         help='Weight decay', dest='wd')
     parser.add_argument('--early-stopping-patience', default=3, type=int,)
     parser.add_argument("--backbone", type=str, default="resnet18")
-    parser.add_argument('-nw', '--num-workers', default=4, type=int, help='number of workers for data loading')
+    add_trainer_args(parser)
     args = parser.parse_args()
 
     return args
 
 
-def train_epoch(loader, model, criterion, optimizer, device, epoch):
-    encoder_CNN = model['encoder']
-    encoder_CNN.fc.train()
-
-    epoch_loss = 0.0
-    preds, tgts, n_steps, batch_size = prep_pred_storage(loader)
-
-    for step, inputs in enumerate(tqdm(loader)):
-        images, seq_len, _, _, _, targets = unpack_batch(inputs, device)
-        outputs_CNN = encoder_CNN(images, seq_len).squeeze(-1)
-        loss = criterion(outputs_CNN, targets.view(-1, 1))
-
-        preds[step * batch_size: (step + 1) * batch_size] = outputs_CNN.detach().cpu().squeeze()
-        tgts[step * batch_size: (step + 1) * batch_size] = targets.detach().cpu().squeeze()
-
-        # record loss
-        optimizer.zero_grad()
-        curr_loss = loss.item()
-        epoch_loss += curr_loss
-        loss.backward()
-        optimizer.step()
-
-    epoch_loss /= n_steps
-    wandb.log({'train/loss': epoch_loss, 'train/epoch': epoch + 1}, commit=True)
-    train_score = average_precision_score(tgts, preds)
-    best_thr = model['best_thr']
-    f1 = f1_score(tgts, preds > best_thr)
-    log_metrics(tgts, preds, best_thr, f1, train_score, 'train', epoch + 1)
-
-    return epoch_loss 
+class CNNAdapter(ModelAdapter):
+    """
+    Res18Classifier on the last frame, only its fc layers are trained
+    """
+    name = 'cnn_only'
 
-@torch.no_grad()
-def val_epoch(loader, model, criterion, device, epoch):
-    encoder_CNN = model['encoder']
-    # switch to evaluate mode 
-    encoder_CNN.fc.eval()
+    def train(self, model):
+        model['encoder'].fc.train()
 
-    epoch_loss = 0.0
-    preds, tgts, n_steps, batch_size = prep_pred_storage(loader)
+    def eval(self, model):
+        model['encoder'].fc.eval()
 
-    for step, inputs in enumerate(tqdm(loader)):
-        images, seq_len, _, _, _, targets = unpack_batch(inputs, device)
+    def forward(self, model, inputs, device):
+        images, seq_len, _, _, _, _ = unpack_batch(inputs, device)
+        return model['encoder'](images, seq_len).squeeze(-1)
 
-        outputs_CNN = encoder_CNN(images, seq_len).squeeze(-1)
 
-        preds[step * batch_size: (step + 1) * batch_size] = outputs_CNN.detach().cpu().squeeze()
-        tgts[step * batch_size: (step + 1) * batch_size] = targets.detach().cpu().squeeze()
-
-        loss = criterion(outputs_CNN, targets.view(-1, 1))
-        curr_loss = loss.item()
-        epoch_loss += curr_loss
-
-    epoch_loss /= n_steps
-    wandb.log({'val/loss': epoch_loss, 'val/epoch': epoch + 1})
-    best_thr, best_f1 = find_best_threshold(preds, tgts)
-    model['best_thr'] = best_thr
-
-    val_score = average_precision_score(tgts, preds)
-    log_metrics(tgts, preds, best_thr, best_f1, val_score, 'val', epoch + 1)
-
-    return epoch_loss , best_f1
-
-
-@torch.no_grad()
-def eval_model(loader, model, device):
-    # swith to evaluate mode
-    encoder_CNN = model['encoder']
-    encoder_CNN.fc.eval()
-    
-    preds, tgts, _, batch_size = prep_pred_storage(loader)
-
-    for step, inputs in enumerate(tqdm(loader)):
-        images, seq_len, _, _, _, targets = unpack_batch(inputs, device)
-        outputs_CNN = encoder_CNN(images, seq_len).squeeze(-1)
-        preds[step * batch_size: (step + 1) * batch_size] = outputs_CNN.detach().cpu().squeeze()
-        tgts[step * batch_size: (step + 1) * batch_size] = targets.detach().cpu().squeeze()
-
-    best_thr = model['best_thr']
-    f1, ap = print_eval_metrics(tgts, preds, best_thr)
-    log_metrics(tgts, preds, best_thr, f1, ap, 'test', 0)
-
-
-def prepare_data(anns_paths, image_dir, args, image_set,load_image=True):
-    intent_sequences = build_pedb_dataset_jaad(
-        anns_paths["JAAD"]["anns"], 
-        anns_paths["JAAD"]["split"], 
-        image_set=image_set, 
-        fps=args.fps, 
-        prediction_frames=args.pred, 
-        max_frames=MAX_FRAMES,
-        verbose=True)
-    if not image_set == "test":
-        intent_sequences = balance(intent_sequences, seed=args.seed)
-
-    crop_with_background = CropBoxWithBackgroud(size=224)
-    if image_set == 'train':
-        TRANSFORM = Compose([
-                             crop_with_background,
-                             ImageTransform(
-                                 torchvision.transforms.Compose([
-                                     torchvision.transforms.ColorJitter(brightness=0.2, contrast=0.2, saturation=0.2, hue=0.1),
-                                     torchvision.transforms.ToTensor(),
-                                     torchvision.transforms.Normalize(MEAN, STD),
-                                 ]),
-                             ),
-                           ])
-    else:
-        TRANSFORM = Compose([
-                             crop_with_background,
-                             ImageTransform(
-                                 torchvision.transforms.Compose([
-                                     torchvision.transforms.ToTensor(), 
-                                     torchvision.transforms.Normalize(MEAN, STD),
-                                 ]),
-                             ) 
-                            ])
-        
-    ds = IntentionSequenceDataset(intent_sequences, image_dir=image_dir, hflip_p = 0.5, preprocess=TRANSFORM)
-    return ds
+def prepare_data(anns_paths, image_dir, args, image_set, load_image=True):
+    return prepare_intention_data(anns_paths, image_dir, args, image_set, load_image=load_image, max_frames=MAX_FRAMES)
 
 
 def main():
     args = get_args()
     seed_torch(args.seed)
-    run_mode = "rnn_only"
-    run_name = setup_wandb(args, run_mode)
+    adapter = CNNAdapter()
+    run_mode = adapter.name
+    run_name = setup_logging(args, run_mode)
 
     # loading data
     train_loader, val_loader, test_loader = build_dataloaders(args, prepare_data, load_image=True)
    
     # construct and load model  
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    encoder_res18 = Res18Classifier(CNN_embed_dim=args.cnn_embed_dim, activation="sigmoid").to(device)
+    # a resumed run restores the whole encoder from its resume state
+    encoder_res18 = Res18Classifier(CNN_embed_dim=args.cnn_embed_dim, activation="sigmoid",
+                                    pretrained=not args.resume).to(device)
     # encoder_res18.turn_off_running_stats()
     print(f'Number of cnnencoder parameters: encoder: {count_parameters(encoder_res18)}') 
     # freeze CNN-encoder during training
@@ -198,45 +92,30 @@ def main():
     encoder_res18.eval()
     print(f'Number of trainable parameters: encoder: {count_parameters(encoder_res18)}')
     model = {'encoder': encoder_res18,'best_thr': 0.5}
+    precision, scaler = setup_precision(args, device, encoder=encoder_res18)
     
     # training settings
-    criterion = torch.nn.BCELoss().to(device)
     cnn_params = list(encoder_res18.fc.parameters())
     optimizer = torch.optim.Adam(cnn_params, lr=args.lr, weight_decay=args.wd)
-    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=0.5, patience=3, verbose=True)
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=0.5, patience=3)
+    trainer = Trainer(adapter, model, optimizer, device, scheduler=scheduler, precision=precision, scaler=scaler,
+                      accumulation_steps=args.accumulation_steps)
  
     print(f'train loader : {len(train_loader)}')
     print(f'val loader : {len(val_loader)}')
-    total_time = 0.0
     
     print(f'Start training, cnn-lstm-model, initail lr={args.lr}, weight-decay={args.wd}, training batch size={args.batch_size}')
     save_path = prepare_cp_path(args, run_name, run_mode)
-    early_stopping = EarlyStopping(checkpoint=save_path, patience=args.early_stopping_patience, verbose=True)
-
-    # start training
-    best_f1 = 0.0
-    for epoch in range(args.epochs):
-        start_epoch_time = time.time()
-        train_loss = train_epoch(train_loader, model, criterion, optimizer, device, epoch)
-        val_loss, val_f1 = val_epoch(val_loader, model, criterion, device, epoch)
-        best_f1 = max(best_f1, val_f1)
-        scheduler.step(val_f1)
-        early_stopping(val_f1, model, optimizer, epoch)
-        wandb.log({"val/best_f1": best_f1, "val/epoch": epoch})
-        if early_stopping.early_stop:
-            print(f'Early stopping after {epoch} epochs...')
-            break
-        end_epoch_time = time.time() - start_epoch_time
-        log_to_stdout(epoch, train_loss, val_loss, val_f1, end_epoch_time)
-        total_time += end_epoch_time
-    print('\n', '**************************************************************')
-    print(f'End training at epoch {epoch}')
-    print('total time: {:.2f}'.format(total_time))
+    early_stopping = build_early_stopping(args, save_path)
+    trainer.fit(train_loader, val_loader, args.epochs, early_stopping, val_every=args.val_every,
+                resume=args.resume, snapshot_every=args.snapshot_every)
+    if args.skip_test:
+        return
 
     load_from_checkpoint(model, save_path)
     print(f'Test loader : {len(test_loader)}')
     print(f'Start evaluation on test set')
-    eval_model(test_loader, model, device)
+    trainer.evaluate(test_loader)
 
 
 if __name__ == '__main__':
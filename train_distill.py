@@ -0,0 +1,177 @@
+import argparse
+import os
+import torch
+from types import SimpleNamespace
+from src.dataset.loader import IntentionSequenceDataset, define_path
+from src.utils import count_parameters, seed_torch, setup_logging, prepare_cp_path
+from src.model.models import RNNClassifier
+from src.model.baselines import DecoderRNN_PV
+from src.model.precision import PRECISIONS, autocast, resolve_precision, setup_precision
+from src.dataset.utils import build_dataloaders
+from src.dataset.intention.jaad_dataset import unpack_batch
+from src.distillation import load_teacher_cache, lookup_teacher, distillation_loss
+from src.early_stopping import load_from_checkpoint
+from eval_hybrid import build_model, IMAGE_TRANSFORM
+from train_rnn import prepare_data
+from src.trainer import ModelAdapter, Trainer, add_trainer_args, build_early_stopping
+
+INPUT_DIM = 8
+STUDENTS = ['rnn', 'pv']
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Distill the hybrid model into a motion-only model')
+    parser.add_argument('--jaad', default=True, action='store_true',
+                        help='use JAAD dataset')
+    parser.add_argument('--fps', default=5, type=int,
+                        metavar='FPS', help='sampling rate(fps)')
+    parser.add_argument('--pred', default=5, type=int,
+                        help='prediction length, predicting-ahead time')
+    parser.add_argument('--max-frames', default=5, type=int,
+                        help='maximum number of frames in histroy sequence')
+    parser.add_argument('--balancing-ratio', default=1.0, type=float,
+                        help='ratio of balanced instances(1/0)')
+    parser.add_argument('--seed', default=99, type=int,
+                        help='random seed for sampling')
+    parser.add_argument('--teacher-path', type=str, required=True,
+                        help='path to the hybrid model checkpoint (EarlyStopping format) used as teacher')
+    parser.add_argument('--teacher-cache', default='', type=str,
+                        help='file of the cached teacher outputs, next to the teacher checkpoint by default')
+    parser.add_argument('--teacher-batch-size', default=16, type=int,
+                        help='batch size used to compute the teacher outputs')
+    parser.add_argument('--teacher-precision', default='fp32', type=str, choices=PRECISIONS,
+                        help='autocast precision of the teacher forward passes')
+    parser.add_argument('--student', default='rnn', type=str, choices=STUDENTS,
+                        help='student model, rnn (RNNClassifier) or pv (DecoderRNN_PV)')
+    parser.add_argument('--alpha', default=0.5, type=float,
+                        help='weight of the hard label loss, 1 - alpha for the teacher loss')
+    parser.add_argument('--temperature', default=2.0, type=float,
+                        help='distillation temperature applied to the logits')
+    parser.add_argument('-lr', '--learning-rate', default=1e-4, type=float,
+                        metavar='LR', help='initial learning rate', dest='lr')
+    parser.add_argument('-b', '--batch-size', default=4, type=int,
+                        metavar='N', help='mini-batch size (default: 4)')
+    parser.add_argument('-e', '--epochs', default=10, type=int,
+                        help='number of epochs to train')
+    parser.add_argument('-wd', '--weight-decay', metavar='WD', type=float, default=1e-5,
+                        help='Weight decay', dest='wd')
+    parser.add_argument('--early-stopping-patience', default=3, type=int,)
+    parser.add_argument("--backbone", type=str, default="resnet18",
+                        help='backbone of the teacher CNN encoder')
+    add_trainer_args(parser)
+    args = parser.parse_args()
+
+    return args
+
+
+def build_student(args, device):
+    if args.student == 'pv':
+        return DecoderRNN_PV(h_RNN=256, h_FC_dim=128, drop_p=0.2).to(device)
+    return RNNClassifier(input_size=INPUT_DIM, rnn_embeding_size=256, classification_head_size=128).to(device)
+
+
+def build_teacher(args, device):
+    """
+    Hybrid teacher loaded from its checkpoint
+    :return: function (batch, device) -> crossing probabilities
+    """
+    teacher_args = SimpleNamespace(mode='hybrid', backbone=args.backbone, fused_decoder=False)
+    teacher, _, _ = build_model(teacher_args)
+    load_from_checkpoint(teacher, args.teacher_path)
+    encoder_CNN, decoder_RNN = teacher['encoder'].eval(), teacher['decoder'].eval()
+    precision = resolve_precision(args.teacher_precision, device)
+
+    def teacher_fn(inputs, device):
+        images, seq_len, pv, scene, behavior, _ = unpack_batch(inputs, device)
+        with autocast(device, precision):
+            outputs_CNN = encoder_CNN(images, seq_len)
+            outputs_RNN = decoder_RNN(xc_3d=outputs_CNN, xp_3d=pv, xb_3d=behavior, xs_2d=scene, x_lengths=seq_len)
+        return outputs_RNN.float()
+
+    return teacher_fn
+
+
+def build_teacher_logits(args, train_ds, device):
+    """
+    Teacher outputs on the training samples, computed once and cached on disk
+    """
+    cache_path = args.teacher_cache or os.path.splitext(args.teacher_path)[0] + f'_teacher_pred{args.pred}_mf{args.max_frames}.pt'
+    meta = {'teacher': os.path.abspath(args.teacher_path), 'teacher_mtime': os.path.getmtime(args.teacher_path),
+            'fps': args.fps, 'pred': args.pred, 'max_frames': args.max_frames, 'seed': args.seed,
+            'balancing_ratio': args.balancing_ratio, 'n_samples': len(train_ds)}
+    _, image_dir = define_path(use_jaad=args.jaad, use_pie=False, use_titan=False)
+    # teacher sees the frames without augmentation
+    teacher_ds = IntentionSequenceDataset(list(train_ds.samples), image_dir=image_dir, preprocess=IMAGE_TRANSFORM,
+                                          load_image=True, io_threads=args.io_threads)
+    teacher_loader = torch.utils.data.DataLoader(teacher_ds, batch_size=args.teacher_batch_size, shuffle=False,
+                                                 num_workers=args.num_workers)
+    return load_teacher_cache(cache_path, lambda: build_teacher(args, device), teacher_loader, device, meta)
+
+
+class DistillAdapter(ModelAdapter):
+    """
+    Motion-only student trained on the labels and on the cached teacher outputs,
+    validated on the labels only
+    """
+    name = 'distill'
+
+    def __init__(self, teacher_logits, alpha=0.5, temperature=2.0):
+        self.teacher_logits = teacher_logits
+        self.alpha = alpha
+        self.temperature = temperature
+
+    def train(self, model):
+        model['decoder'].train()
+
+    def forward(self, model, inputs, device):
+        _, seq_len, pos_vel, _, _, _ = unpack_batch(inputs, device)
+        return model['decoder'](pos_vel, seq_len).view(-1, 1)
+
+    def loss(self, outputs, targets, inputs, train=True):
+        if not train:
+            return super().loss(outputs, targets, inputs, train)
+        teacher = lookup_teacher(self.teacher_logits, inputs['id'], targets.device)
+        loss, hard_loss, soft_loss = distillation_loss(outputs, targets, teacher, alpha=self.alpha, temperature=self.temperature)
+        return loss, {'hard_loss': hard_loss, 'soft_loss': soft_loss}
+
+
+def main():
+    args = get_args()
+    seed_torch(args.seed)
+    run_mode = DistillAdapter.name
+    run_name = setup_logging(args, run_mode)
+
+    # loading data, the student only needs the bounding boxes
+    train_loader, val_loader, test_loader = build_dataloaders(args, prepare_data, load_image=False)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    teacher_logits = build_teacher_logits(args, train_loader.dataset, device)
+    adapter = DistillAdapter(teacher_logits, alpha=args.alpha, temperature=args.temperature)
+
+    # construct student
+    student = build_student(args, device)
+    model = {'decoder': student, 'best_thr': 0.5}
+    print(f'Number of trainable parameters: student ({args.student}): {count_parameters(student)}')
+    precision, scaler = setup_precision(args, device)
+
+    # training settings
+    optimizer = torch.optim.Adam(student.parameters(), lr=args.lr, weight_decay=args.wd)
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=0.5, patience=3)
+    trainer = Trainer(adapter, model, optimizer, device, scheduler=scheduler, precision=precision, scaler=scaler,
+                      accumulation_steps=args.accumulation_steps)
+
+    print(f'Start training, {run_mode} model, alpha={args.alpha}, temperature={args.temperature}, initial lr={args.lr}, weight-decay={args.wd}, training batch size={args.batch_size}')
+    save_path = prepare_cp_path(args, run_name, run_mode)
+    early_stopping = build_early_stopping(args, save_path)
+    trainer.fit(train_loader, val_loader, args.epochs, early_stopping, val_every=args.val_every,
+                resume=args.resume, snapshot_every=args.snapshot_every)
+    if args.skip_test:
+        return
+
+    load_from_checkpoint(model, save_path)
+    print(f'Start evaluation on test set')
+    trainer.evaluate(test_loader)
+
+
+if __name__ == '__main__':
+    print('start')
+    main()
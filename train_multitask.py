@@ -0,0 +1,181 @@
+import torch
+import argparse
+import numpy as np
+import torch.nn.functional as F
+from train_hybrid import HybridAdapter, prepare_data
+from src.dataset.loader import TTE_BUCKETS
+from src.model.models import build_encoder_res18, MultiTaskDecoderRNN_IMBS
+from src.dataset.utils import build_dataloaders
+from src.utils import count_parameters, seed_torch, setup_logging, prepare_cp_path
+from src.early_stopping import load_from_checkpoint
+from src.checkpoint import load_checkpoint, module_state
+from src import logger
+from src.model.precision import setup_precision
+from src.trainer import Trainer, add_trainer_args, build_early_stopping
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Train multi-task hybrid model (crossing, next action, time-to-crossing)')
+    parser.add_argument('--jaad', default=True, action='store_true',
+                        help='use JAAD dataset')
+    parser.add_argument('--fps', default=5, type=int,
+                        metavar='FPS', help='sampling rate(fps)')
+    parser.add_argument('--max-frames', default=5, type=int,
+                        help='maximum number of frames in histroy sequence')
+    parser.add_argument('--pred', default=10, type=int,
+                        help='prediction length, predicting-ahead time')
+    parser.add_argument('--balancing-ratio', default=1.0, type=float,
+                        help='ratio of balanced instances(1/0)')
+    parser.add_argument('--seed', default=99, type=int,
+                        help='random seed for sampling')
+    parser.add_argument('--hybrid-path', default='', type=str,
+                        help='hybrid model checkpoint initializing the encoder and the shared decoder layers')
+    parser.add_argument('--cross-weight', default=1.0, type=float,
+                        help='weight of the crossing loss')
+    parser.add_argument('--action-weight', default=0.5, type=float,
+                        help='weight of the next action (walking) loss')
+    parser.add_argument('--tte-weight', default=0.5, type=float,
+                        help='weight of the time-to-crossing bucket loss')
+    parser.add_argument('-lr', '--learning-rate', default=1e-4, type=float,
+                        metavar='LR', help='initial learning rate', dest='lr')
+    parser.add_argument('-b', '--batch-size', default=4, type=int,
+                        metavar='N', help='mini-batch size (default: 4)')
+    parser.add_argument('-e', '--epochs', default=10, type=int,
+                        help='number of epochs to train')
+    parser.add_argument('-wd', '--weight-decay', metavar='WD', type=float, default=1e-4,
+                        help='Weight decay', dest='wd')
+    parser.add_argument('--early-stopping-patience', default=3, type=int,)
+    parser.add_argument("--backbone", type=str, default="resnet18")
+    add_trainer_args(parser)
+    args = parser.parse_args()
+
+    return args
+
+
+def multitask_loss(outputs, targets, weights):
+    """
+    Weighted sum of the crossing / next action BCE and of the time-to-crossing bucket cross-entropy
+    (samples without a crossing ahead, bucket -1, are ignored)
+    :return: total loss and loss of every task
+    """
+    (p_cross, p_action, tte_logits), (y_cross, y_action, y_tte) = outputs, targets
+    loss_cross = F.binary_cross_entropy(p_cross, y_cross)
+    loss_action = F.binary_cross_entropy(p_action, y_action)
+    valid = y_tte >= 0
+    # a batch without any crossing ahead gives no tte gradient
+    loss_tte = F.cross_entropy(tte_logits[valid], y_tte[valid]) if valid.any() else tte_logits.sum() * 0.0
+    losses = (loss_cross, loss_action, loss_tte)
+    return sum(w * l for w, l in zip(weights, losses)), losses
+
+
+class TaskMetrics:
+    """
+    Predictions of the next action and time-to-crossing heads over an epoch
+    """
+    def __init__(self):
+        self.action_preds, self.action_tgts, self.tte_preds, self.tte_tgts = [], [], [], []
+
+    def update(self, outputs, inputs):
+        self.action_preds.append(outputs[1].detach().view(-1))
+        self.action_tgts.append(inputs['next_action'].view(-1))
+        self.tte_preds.append(outputs[2].detach().argmax(dim=-1))
+        self.tte_tgts.append(inputs['tte_tag'].view(-1))
+
+    def compute(self):
+        from sklearn.metrics import f1_score, average_precision_score
+        action_preds, action_tgts = torch.cat(self.action_preds).cpu().numpy(), torch.cat(self.action_tgts).cpu().numpy()
+        tte_preds, tte_tgts = torch.cat(self.tte_preds).cpu().numpy(), torch.cat(self.tte_tgts).cpu().numpy()
+        valid = tte_tgts >= 0
+        return {'action_f1': f1_score(action_tgts, action_preds > 0.5),
+                'action_AP': average_precision_score(action_tgts, action_preds),
+                'tte_acc': float(np.mean(tte_preds[valid] == tte_tgts[valid])) if valid.any() else float('nan'),
+                # off by at most one bucket (0.4s)
+                'tte_acc1': float(np.mean(np.abs(tte_preds[valid] - tte_tgts[valid]) <= 1)) if valid.any() else float('nan')}
+
+    def log(self, mode, step):
+        metrics = self.compute()
+        logger.log({**{f'{mode}/{k}': v for k, v in metrics.items()}, f'{mode}/epoch': step})
+        if mode != 'train':
+            print(f'Next action: F1: {metrics["action_f1"]:.3f}, AP: {metrics["action_AP"]:.3f}, '
+                  f'time-to-crossing buckets {TTE_BUCKETS}s: accuracy {metrics["tte_acc"]:.3f}, '
+                  f'within one bucket {metrics["tte_acc1"]:.3f}')
+
+
+class MultiTaskAdapter(HybridAdapter):
+    """
+    Hybrid model with the crossing, next action and time-to-crossing heads of MultiTaskDecoderRNN_IMBS,
+    the crossing probability drives the metrics and the model selection
+    """
+    name = 'multitask'
+
+    def __init__(self, weights):
+        self.weights = weights
+
+    def scores(self, outputs):
+        return outputs[0].view(-1, 1)
+
+    def loss(self, outputs, targets, inputs, train=True):
+        device = targets.device
+        task_targets = (targets, inputs['next_action'].to(device).view(-1, 1), inputs['tte_tag'].to(device).view(-1))
+        loss, losses = multitask_loss(outputs, task_targets, self.weights)
+        return loss, dict(zip(['loss_cross', 'loss_action', 'loss_tte'], losses))
+
+    def metrics(self):
+        return TaskMetrics()
+
+
+def main():
+    args = get_args()
+    seed_torch(args.seed)
+
+    adapter = MultiTaskAdapter(weights=(args.cross_weight, args.action_weight, args.tte_weight))
+    run_mode = adapter.name
+    run_name = setup_logging(args, run_mode)
+
+    # loading data
+    train_loader, val_loader, test_loader = build_dataloaders(args, prepare_data, load_image=True)
+
+    # construct and load model
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    encoder_res18 = build_encoder_res18(args, pretrained=not (args.hybrid_path or args.resume))
+    decoder_lstm = MultiTaskDecoderRNN_IMBS(n_tte_buckets=len(TTE_BUCKETS) + 1, CNN_embeded_size=256, h_RNN_0=256, h_RNN_1=64,
+                                            h_RNN_2=16, h_FC0_dim=128, h_FC1_dim=64, h_FC2_dim=86, drop_p=0.2).to(device)
+    if args.hybrid_path:
+        # the auxiliary heads start from scratch
+        checkpoint = load_checkpoint(args.hybrid_path)
+        encoder_res18.load_state_dict(module_state(checkpoint, 'encoder'))
+        missing, _ = decoder_lstm.load_state_dict(module_state(checkpoint, 'decoder'), strict=False)
+        print(f'Initialized from {args.hybrid_path}, new layers: {missing}')
+
+    # freeze CNN-encoder during training
+    encoder_res18.eval()
+    encoder_res18.freeze_backbone()
+    print(f'Number of trainable parameters: decoder: {count_parameters(decoder_lstm)}, encoder train: {count_parameters(encoder_res18)}')
+
+    model = {'encoder': encoder_res18, 'decoder': decoder_lstm, 'best_thr': 0.5}
+    precision, scaler = setup_precision(args, device, encoder=encoder_res18)
+
+    # training settings
+    crnn_params = list(encoder_res18.fc.parameters()) + list(decoder_lstm.parameters())
+    optimizer = torch.optim.Adam(crnn_params, lr=args.lr, weight_decay=args.wd)
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='max', factor=0.5, patience=3)
+    trainer = Trainer(adapter, model, optimizer, device, scheduler=scheduler, precision=precision, scaler=scaler,
+                      accumulation_steps=args.accumulation_steps)
+
+    print(f'Start training, multi-task PVIBS-lstm-model, loss weights (cross, action, tte)={adapter.weights}, initail lr={args.lr}, '
+          f'weight-decay={args.wd}, mf={args.max_frames}, training batch size={args.batch_size}')
+    save_path = prepare_cp_path(args, run_name, run_mode)
+    # model selection on the crossing F1, the main task
+    early_stopping = build_early_stopping(args, save_path)
+    trainer.fit(train_loader, val_loader, args.epochs, early_stopping, val_every=args.val_every,
+                resume=args.resume, snapshot_every=args.snapshot_every)
+    if args.skip_test:
+        return
+
+    load_from_checkpoint(model, save_path)
+    print(f'Start evaluation on test set')
+    trainer.evaluate(test_loader)
+
+
+if __name__ == '__main__':
+    main()